@@ -0,0 +1,103 @@
+import os
+
+from collections import defaultdict, namedtuple
+import json
+
+from constants import *
+
+# Possible actions:
+# copy (always from source to target),
+# delta (from source to target, only writing the blocks that differ from the file in the compare directory, copied if that is not possible)
+# delete (always in target)
+# hardlink (always from compare directory to target directory)
+# rename (always in target) (2-variate) (only needed for move detection)
+# hardlink2 (alway from compare directory to target directory) (2-variate) (only needed for move detection)
+# dedup (from an identical file in any backup in backup_root_dir to target directory, copied from source if that fails) (2-variate) (only needed for the content index)
+#
+# name is relative to the target directory target (the name of the directory of a source directory in the backup, None in older action files).
+# fromName is the second path of the 2-variate actions, relative to the target directory (rename), compare directory (hardlink2)
+# or backup_root_dir (dedup).
+# isDirectory and size are taken from the walk, so applying the actions does not have to stat the files again.
+# htmlFlags only changes how the action is displayed in actions.html.
+Action = namedtuple("Action", ["type", "name", "isDirectory", "size", "htmlFlags", "target", "fromName"], defaults = [None, None, None, None, None])
+
+# The action file has one JSON object per line ({"type": ..., "params": {...}}), so it can be written while the actions are generated
+# and read (and applied) one action at a time. The last line ({"actions": <count>, "bytes": <size of the copied files>}) is only written
+# once all actions were generated.
+def actionToJson(action):
+    params = {"name": action.name}
+    for key in ["isDirectory", "size", "htmlFlags", "target", "fromName"]:
+        if getattr(action, key) is not None:
+            params[key] = getattr(action, key)
+    return json.dumps({"type": action.type, "params": params})
+
+def actionFromJson(obj):
+    return Action(obj["type"], **obj["params"])
+
+# The number of bytes applying the action copies
+def copiedBytes(action):
+    if (action.type == "copy" or action.type == "delta") and not action.isDirectory:
+        return action.size or 0
+    return 0
+
+class ActionFileWriter:
+    def __init__(self, path):
+        self.file = open(path, "w", encoding = "utf-8")
+        self.count = 0
+        self.bytes = 0
+        self.histogram = defaultdict(int)
+
+    def write(self, action):
+        self.file.write(actionToJson(action) + "\n")
+        self.count += 1
+        self.bytes += copiedBytes(action)
+        self.histogram[action.type] += 1
+
+    def close(self):
+        self.file.write(json.dumps({"actions": self.count, "bytes": self.bytes}) + "\n")
+        self.file.close()
+
+# Raises a FileNotFoundError saying so if the backup directory has no action file
+# (it is deleted after applying the actions without save_actionfile)
+def checkActionFile(backupDirectory):
+    if not os.path.isfile(os.path.join(backupDirectory, ACTIONS_FILENAME)) and not os.path.isfile(os.path.join(backupDirectory, LEGACY_ACTIONS_FILENAME)):
+        raise FileNotFoundError("There is no action file in " + backupDirectory)
+
+# Yields the actions from the action file in a backup directory
+def readActionFile(backupDirectory):
+    checkActionFile(backupDirectory)
+    path = os.path.join(backupDirectory, ACTIONS_FILENAME)
+    if os.path.isfile(path):
+        with open(path, encoding = "utf-8") as actionFile:
+            for line in actionFile:
+                obj = json.loads(line)
+                if "type" not in obj:
+                    break
+                yield actionFromJson(obj)
+    else:
+        # Older versions wrote a single JSON array
+        with open(os.path.join(backupDirectory, LEGACY_ACTIONS_FILENAME), encoding = "utf-8") as actionFile:
+            for obj in json.load(actionFile):
+                yield actionFromJson(obj)
+
+# Returns the number of actions in the action file of a backup directory and the number of bytes they copy,
+# or None if generating them was interrupted. The number of bytes is None for action files of older versions that do not know the sizes.
+def actionTotals(backupDirectory):
+    checkActionFile(backupDirectory)
+    path = os.path.join(backupDirectory, ACTIONS_FILENAME)
+    if os.path.isfile(path):
+        count = 0
+        lastLine = None
+        with open(path, "rb") as actionFile:
+            for line in actionFile:
+                count += 1
+                lastLine = line
+        try:
+            trailer = json.loads(lastLine) if lastLine is not None else None
+        except ValueError:
+            trailer = None
+        if trailer is None or "type" in trailer or trailer.get("actions") != count - 1:
+            return None
+        return count - 1, trailer.get("bytes")
+    with open(os.path.join(backupDirectory, LEGACY_ACTIONS_FILENAME), encoding = "utf-8") as actionFile:
+        return len(json.load(actionFile)), None
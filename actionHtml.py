@@ -0,0 +1,101 @@
+import os
+
+import json
+import logging
+import shutil
+
+from actionFile import copiedBytes
+from constants import *
+
+# actions.html only holds the overview and the code showing the actions. The rows are written to script files in the directory
+# ACTIONSHTML_DATA_DIRNAME next to it, CHUNK_ROWS rows per file, and the page only loads the files of the rows that are scrolled into view.
+# A new directory is a single row with the number of actions in it and their size, its contents are only loaded when it is expanded.
+CHUNK_ROWS = 5000
+
+HTML_FLAGS = ["emptyFolder", "inNewDir"]
+
+# Writes a list of rows ([type, htmlFlags or 0, name(, group)]) to <directory>/<stream>_<chunk number>.js, every file calls actionChunk
+class RowChunkWriter:
+    def __init__(self, directory, stream):
+        self.directory = directory
+        self.stream = stream
+        self.rows = []
+        self.count = 0
+
+    # Returns the position of the row in the list
+    def add(self, row):
+        self.rows.append(row)
+        self.count += 1
+        if len(self.rows) == CHUNK_ROWS:
+            self.flush()
+        return self.count - 1
+
+    def flush(self):
+        if len(self.rows) == 0:
+            return
+        chunk = (self.count - 1) // CHUNK_ROWS
+        with open(os.path.join(self.directory, self.stream + "_" + str(chunk) + ".js"), "w", encoding = "utf-8") as chunkFile:
+            chunkFile.write("actionChunk(" + json.dumps(self.stream) + ", " + str(chunk) + ", " + json.dumps(self.rows, separators = (",", ":")) + ");\n")
+        self.rows = []
+
+# Writes actions.html to path and the rows to the directory ACTIONSHTML_DATA_DIRNAME next to it: an overview (histogram maps action types
+# to their number) and a list of the actions, except the ones with a type in excludedActionTypes.
+# The actions are streamed, so this needs the same memory for any number of actions (apart from the list of new directories).
+def writeActionHtml(path, actions, histogram, excludedActionTypes):
+    templatePath = os.path.join(os.path.dirname(os.path.abspath(__file__)), "template.html")
+    with open(templatePath, "r") as templateFile:
+        template = templateFile.read()
+
+    dataDirectory = os.path.join(os.path.dirname(path), ACTIONSHTML_DATA_DIRNAME)
+    # Left over from writing it before
+    if os.path.isdir(dataDirectory):
+        shutil.rmtree(dataDirectory)
+    os.makedirs(dataDirectory)
+
+    rows = RowChunkWriter(dataDirectory, "rows")
+    # The contents of the new directories, one list per target, so the contents of a directory are always next to each other
+    contents = {}
+    # [list of the contents, position of the first row in it, number of rows, bytes copied]
+    groups = []
+    # {target: (index in groups, name) of the last new directory}
+    newDirectories = {}
+    for action in actions:
+        if action.type in excludedActionTypes:
+            continue
+        if action.htmlFlags is not None and action.htmlFlags not in HTML_FLAGS:
+            logging.error("Unknown html flags for action html: " + str(action.htmlFlags))
+        newDirectory = newDirectories.get(action.target)
+        # Copies of moved files are held back until the end of a source, they are only in the list of their directory if no other new directory came since
+        if action.htmlFlags == "inNewDir" and newDirectory is not None and action.name.startswith(newDirectory[1] + os.sep):
+            group = groups[newDirectory[0]]
+            contents[action.target].add([action.type, action.htmlFlags, action.name[len(newDirectory[1]) + 1:]])
+            group[2] += 1
+            group[3] += copiedBytes(action)
+            continue
+
+        name = action.name if action.target is None else os.path.join(action.target, action.name)
+        if action.fromName is not None:
+            # The files of dedup actions can be in any backup
+            fromName = action.fromName if action.target is None or action.type == "dedup" else os.path.join(action.target, action.fromName)
+            name = fromName + " \u2192 " + name
+        if action.type == "copy" and action.isDirectory and action.htmlFlags is None:
+            if action.target not in contents:
+                contents[action.target] = RowChunkWriter(dataDirectory, "t" + str(len(contents)))
+            newDirectories[action.target] = (len(groups), action.name)
+            groups.append([contents[action.target].stream, contents[action.target].count, 0, 0])
+            rows.add([action.type, 0, name, len(groups) - 1])
+        else:
+            rows.add([action.type, action.htmlFlags or 0, name])
+
+    rows.flush()
+    for writer in contents.values():
+        writer.flush()
+    with open(os.path.join(dataDirectory, "groups.js"), "w", encoding = "utf-8") as groupsFile:
+        groupsFile.write("var actionGroups = " + json.dumps(groups, separators = (",", ":")) + ";\n")
+
+    report = {"rows": rows.count, "chunkRows": CHUNK_ROWS, "directory": ACTIONSHTML_DATA_DIRNAME, "separator": os.sep}
+    actionOverviewHTML = " | ".join(map(lambda k_v: k_v[0] + "(" + str(k_v[1]) + ")", histogram.items()))
+    with open(path, "w", encoding = "utf-8") as actionHTMLFile:
+        actionHTMLFile.write(template.replace("<!-- OVERVIEW -->", actionOverviewHTML)
+                             .replace("<!-- ACTIONDATA -->", "<script>var report = " + json.dumps(report) + ";</script>\n"
+                                      + "        <script src=\"" + ACTIONSHTML_DATA_DIRNAME + "/groups.js\"></script>"))
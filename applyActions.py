@@ -1,96 +1,395 @@
 import os, sys
 
+from concurrent.futures import ThreadPoolExecutor, wait
 import json
 import shutil
 import logging
+import threading
+import time
 
+from actionFile import actionTotals, copiedBytes, readActionFile
+import catalog
 from constants import *
+from fileOperations import deltaCopy, getCopyFunction, hardlink
+from hashCache import BlockHashCache
+from journal import ActionJournal
+import manifest
+import metrics
 
-# From here: https://github.com/sid0/ntfs/blob/master/ntfsutils/hardlink.py
-import ctypes
-from ctypes import WinError
-from ctypes.wintypes import BOOL
-CreateHardLink = ctypes.windll.kernel32.CreateHardLinkW
-CreateHardLink.argtypes = [ctypes.c_wchar_p, ctypes.c_wchar_p, ctypes.c_void_p]
-CreateHardLink.restype = BOOL
+# Action files written by older versions do not know whether the action is about a directory
+def isDirectory(action, path):
+    if action.isDirectory is not None:
+        return action.isDirectory
+    return os.path.isdir(path)
 
-def hardlink(source, link_name):
-    res = CreateHardLink(link_name, source, None)
-    if res == 0:
-        raise WinError()
+# Returns the source, compare and target directories of a backup from its metadata, as a dictionary mapping the name of the target directory
+# (the target of its actions) to {"name", "sourceDirectory", "compareDirectory", "targetDirectory"}.
+# Backups of older versions only had one source directory and their actions have no target.
+def backupSources(metadata):
+    if "sources" in metadata:
+        return {source["name"]: source for source in metadata["sources"]}
+    return {None: {"name": None, "sourceDirectory": metadata["sourceDirectory"], "compareDirectory": metadata["compareDirectory"],
+                   "targetDirectory": metadata["targetDirectory"]}}
 
-def executeActionList(metadataDirectory, actions):
+# Whether one of the paths is inside the other one (or they are the same)
+def pathsOverlap(a, b):
+    return a == b or a.startswith(b + os.sep) or b.startswith(a + os.sep)
+
+# Copies at least this large get threads of their own, so a few huge files and many small files do not hold each other up
+LARGE_FILE_SIZE = 64 * 1024 * 1024
+
+# Applies actions on a pool of threads (or directly, with a single thread).
+# Every directory is created only once, before anything is put into it.
+# A delete waits for all running actions inside (or above) the deleted path and vice versa, so deleting a subtree never races copies into it.
+# Applied actions are recorded in the journal by their index. When resuming, actions that might have been applied (partially) by the
+# interrupted run are checked against the target directory first.
+# sources are the directories of the targets of the actions (see backupSources). The actions of different targets can be interleaved.
+# backupRootDirectory is the directory the fromName of dedup actions is relative to.
+# delta actions compare blocks of deltaBlockSize bytes, whose digests are saved in blockHashes (a BlockHashCache or None).
+class ActionExecutor:
+    def __init__(self, sources, threads, copyFile, journal, resuming = False, backupRootDirectory = None, deltaBlockSize = None, blockHashes = None):
+        self.sources = sources
+        self.backupRootDirectory = backupRootDirectory
+        self.deltaBlockSize = deltaBlockSize
+        self.blockHashes = blockHashes
+        self.targetDirectories = set(source["targetDirectory"] for source in sources.values())
+        self.copyFile = copyFile
+        self.journal = journal
+        self.resuming = resuming
+
+        self.createdDirectories = set()
+        self.directoryLock = threading.Lock()
+
+        self.lock = threading.Lock()
+        self.completed = 0
+        self.errors = 0
+        # running actions: id -> (paths in the target directory, is a delete, future)
+        self.running = {}
+        self.nextId = 0
+        # target -> the last deleted directory in it
+        self.lastDeletedDirectories = {}
+
+        if threads > 1:
+            largeThreads = max(1, threads // 4)
+            self.largePool = ThreadPoolExecutor(max_workers = largeThreads, thread_name_prefix = "apply_large")
+            self.smallPool = ThreadPoolExecutor(max_workers = max(1, threads - largeThreads), thread_name_prefix = "apply")
+            # Limits the number of queued small actions. Large ones are few enough to queue them all.
+            self.smallSlots = threading.BoundedSemaphore(threads * 16)
+        else:
+            self.largePool = self.smallPool = None
+
+    def ensureDirectory(self, path):
+        with self.directoryLock:
+            if path in self.createdDirectories:
+                return
+            os.makedirs(path, exist_ok = True)
+            while path not in self.createdDirectories and path not in self.targetDirectories:
+                self.createdDirectories.add(path)
+                path = os.path.dirname(path)
+
+    # Whether the interrupted run already copied the file completely. copystat sets the modification date last,
+    # so a half written file does not have the one of the source yet. Files not written since that run started are always copied again.
+    def alreadyCopied(self, fromPath, toPath):
+        try:
+            sourceStat = os.stat(fromPath)
+            targetStat = os.stat(toPath)
+        except FileNotFoundError:
+            return False
+        return (targetStat.st_ctime >= self.journal.started and targetStat.st_size == sourceStat.st_size
+                and targetStat.st_mtime_ns == sourceStat.st_mtime_ns)
+
+    def execute(self, action):
+        actionType = action.type
+        source = self.sources[action.target]
+        if actionType == "copy":
+            fromPath = os.path.join(source["sourceDirectory"], action.name)
+            toPath = os.path.join(source["targetDirectory"], action.name)
+            logging.debug('copy from "' + fromPath + '" to "' + toPath + '"')
+
+            if isDirectory(action, fromPath):
+                self.ensureDirectory(toPath)
+                metrics.count("directories_created")
+            elif self.resuming and self.alreadyCopied(fromPath, toPath):
+                logging.debug('"' + toPath + '" was already copied')
+                metrics.count("bytes_already_copied", action.size or 0)
+            else:
+                self.ensureDirectory(os.path.dirname(toPath))
+                self.copyFile(fromPath, toPath)
+                metrics.count("files_copied")
+        elif actionType == "delta":
+            fromPath = os.path.join(source["sourceDirectory"], action.name)
+            basePath = os.path.join(source["compareDirectory"], action.name)
+            toPath = os.path.join(source["targetDirectory"], action.name)
+            logging.debug('update changed blocks from "' + fromPath + '" to "' + toPath + '"')
+
+            if self.resuming and self.alreadyCopied(fromPath, toPath):
+                logging.debug('"' + toPath + '" was already updated')
+                metrics.count("bytes_already_copied", action.size or 0)
+                return
+            self.ensureDirectory(os.path.dirname(toPath))
+            digests = None
+            if self.deltaBlockSize is not None and os.path.isfile(basePath):
+                baseDigests = self.blockHashes.get(basePath, self.deltaBlockSize) if self.blockHashes is not None else None
+                digests = deltaCopy(fromPath, toPath, basePath, self.deltaBlockSize, baseDigests)
+            if digests is None:
+                logging.debug('"' + toPath + '" can not share blocks with "' + basePath + '", copying it completely')
+                # Copying over the old version in place would change it in the backups it is hardlinked into as well
+                if os.path.lexists(toPath):
+                    os.remove(toPath)
+                self.copyFile(fromPath, toPath)
+                metrics.count("files_copied")
+            else:
+                if self.blockHashes is not None:
+                    self.blockHashes.set(toPath, self.deltaBlockSize, digests)
+                metrics.count("files_delta_updated")
+        elif actionType == "delete":
+            path = os.path.join(source["targetDirectory"], action.name)
+            logging.debug('delete file "' + path + '"')
+
+            if self.resuming and not os.path.lexists(path):
+                logging.debug('"' + path + '" was already deleted')
+            elif isDirectory(action, path):
+                shutil.rmtree(path)
+                metrics.count("deletes")
+            else:
+                os.remove(path)
+                metrics.count("deletes")
+        elif actionType == "hardlink":
+            fromPath = os.path.join(source["compareDirectory"], action.name)
+            toPath = os.path.join(source["targetDirectory"], action.name)
+            logging.debug('hardlink from "' + fromPath + '" to "' + toPath + '"')
+            if self.resuming and os.path.lexists(toPath):
+                if os.path.samefile(fromPath, toPath):
+                    logging.debug('"' + toPath + '" was already hardlinked')
+                    return
+                os.remove(toPath)
+            self.ensureDirectory(os.path.dirname(toPath))
+            hardlink(fromPath, toPath)
+            metrics.count("hardlinks_created")
+        elif actionType == "hardlink2":
+            fromPath = os.path.join(source["compareDirectory"], action.fromName)
+            toPath = os.path.join(source["targetDirectory"], action.name)
+            logging.debug('hardlink moved file from "' + fromPath + '" to "' + toPath + '"')
+            if self.resuming and os.path.lexists(toPath):
+                if os.path.samefile(fromPath, toPath):
+                    logging.debug('"' + toPath + '" was already hardlinked')
+                    return
+                os.remove(toPath)
+            self.ensureDirectory(os.path.dirname(toPath))
+            hardlink(fromPath, toPath)
+            metrics.count("hardlinks_created")
+        elif actionType == "dedup":
+            fromPath = os.path.join(self.backupRootDirectory, action.fromName)
+            toPath = os.path.join(source["targetDirectory"], action.name)
+            logging.debug('hardlink identical file from "' + fromPath + '" to "' + toPath + '"')
+            if self.resuming and os.path.lexists(toPath):
+                if os.path.exists(fromPath) and os.path.samefile(fromPath, toPath):
+                    logging.debug('"' + toPath + '" was already hardlinked')
+                    return
+                os.remove(toPath)
+            self.ensureDirectory(os.path.dirname(toPath))
+            try:
+                # The index only knows what the file was like when its backup was finished
+                if os.stat(fromPath).st_size != action.size:
+                    raise OSError("the file changed since it was added to the content index")
+                hardlink(fromPath, toPath)
+                metrics.count("hardlinks_created")
+                metrics.count("bytes_deduplicated", action.size or 0)
+            except OSError as e:
+                # For example because the file has as many links as the file system allows
+                logging.warning('Could not hardlink "' + fromPath + '", copying the file instead: ' + str(e))
+                self.copyFile(os.path.join(source["sourceDirectory"], action.name), toPath)
+                metrics.count("files_copied")
+        elif actionType == "rename":
+            fromPath = os.path.join(source["targetDirectory"], action.fromName)
+            toPath = os.path.join(source["targetDirectory"], action.name)
+            logging.debug('rename "' + fromPath + '" to "' + toPath + '"')
+            if self.resuming and not os.path.lexists(fromPath) and os.path.lexists(toPath):
+                logging.debug('"' + fromPath + '" was already renamed')
+                return
+            self.ensureDirectory(os.path.dirname(toPath))
+            os.replace(fromPath, toPath)
+            metrics.count("renames")
+        else:
+            raise ValueError("Unknown action type: " + actionType)
+
+    # The paths in the target directory applying the action changes, so they can be synced before it is recorded in the journal
+    def changedPaths(self, action):
+        targetDirectory = self.sources[action.target]["targetDirectory"]
+        if action.type == "rename":
+            return [os.path.join(targetDirectory, action.name), os.path.join(targetDirectory, action.fromName)]
+        return [os.path.join(targetDirectory, action.name)]
+
+    def run(self, index, action):
+        try:
+            self.execute(action)
+            failed = False
+            self.journal.add(index, self.changedPaths(action))
+        except (OSError, ValueError) as e:
+            logging.error(action.type + " '" + action.name + "' failed: " + str(e))
+            metrics.count("failed_actions")
+            failed = True
+        except Exception:
+            # Anything else (an sqlite error of the block hash cache, an unknown target, ...) fails the action as well instead of getting lost in a worker
+            logging.exception(action.type + " '" + action.name + "' failed")
+            metrics.count("failed_actions")
+            failed = True
+        with self.lock:
+            self.completed += 1
+            if failed:
+                self.errors += 1
+
+    def finished(self, actionId, isSmall, future):
+        # run catches the errors of the action itself, but nothing a worker raises may go unnoticed
+        error = future.exception() if not future.cancelled() else None
+        with self.lock:
+            del self.running[actionId]
+            if error is not None:
+                self.completed += 1
+                self.errors += 1
+        if error is not None:
+            logging.error("Applying an action failed: " + repr(error))
+        if isSmall:
+            self.smallSlots.release()
+
+    def submit(self, index, action):
+        targetDirectory = self.sources[action.target]["targetDirectory"]
+        path = os.path.join(targetDirectory, action.name)
+        isDelete = action.type == "delete"
+        # A rename changes two paths
+        paths = [path] if action.type != "rename" else [path, os.path.join(targetDirectory, action.fromName)]
+
+        if isDelete:
+            # Everything in a deleted directory is already gone with it
+            lastDeletedDirectory = self.lastDeletedDirectories.get(action.target)
+            if lastDeletedDirectory is not None and path.startswith(lastDeletedDirectory + os.sep):
+                self.journal.add(index)
+                with self.lock:
+                    self.completed += 1
+                return
+            if isDirectory(action, path):
+                self.lastDeletedDirectories[action.target] = path
+
+        if self.smallPool is None:
+            self.run(index, action)
+            return
+
+        # Deletes have to wait for everything running in the same subtree, everything else only for deletes
+        with self.lock:
+            conflicts = [future for otherPaths, otherIsDelete, future in self.running.values()
+                         if (isDelete or otherIsDelete) and any(pathsOverlap(a, b) for a in paths for b in otherPaths)]
+        wait(conflicts)
+
+        isSmall = (action.type != "copy" and action.type != "delta") or (action.size or 0) < LARGE_FILE_SIZE
+        if isSmall:
+            self.smallSlots.acquire()
+        with self.lock:
+            actionId = self.nextId
+            self.nextId += 1
+            future = (self.smallPool if isSmall else self.largePool).submit(self.run, index, action)
+            self.running[actionId] = (paths, isDelete, future)
+        future.add_done_callback(lambda future: self.finished(actionId, isSmall, future))
+
+    # cancel drops the actions that did not start yet, running ones are always finished
+    def close(self, cancel = False):
+        if self.smallPool is not None:
+            self.smallPool.shutdown(cancel_futures = cancel)
+            self.largePool.shutdown(cancel_futures = cancel)
+
+# actions can be any iterable of Actions, also one that is still being generated. actionCount and totalBytes (the size of the copied files)
+# are only used to show the progress. With resume, the actions recorded in the journal of an earlier, interrupted call are skipped.
+# Returns whether all actions were applied successfully.
+def executeActionList(metadataDirectory, actions, threads = 1, copyMethod = "auto", actionCount = None, totalBytes = None, resume = False):
     logging.info("Apply actions.")
 
     with open(os.path.join(metadataDirectory, METADATA_FILENAME)) as inFile:
         metadata = json.load(inFile)
 
-    sourceDirectory = metadata["sourceDirectory"]
-    compareDirectory = metadata["compareDirectory"]
-    targetDirectory = metadata["targetDirectory"]
+    # The manifest will not match the target directory anymore once we start modifying it
+    manifest.invalidateManifest(metadataDirectory)
+
+    journalPath = os.path.join(metadataDirectory, JOURNAL_FILENAME)
+    journal = ActionJournal(journalPath, resume)
+    if resume:
+        logging.info("Resuming, " + str(len(journal.done)) + " actions were already applied")
 
-    lastProgress = 0
-    percentSteps = 5
-    for i, action in enumerate(actions):
-        progress = int(i/len(actions)*100.0/percentSteps + 0.5) * percentSteps
-        if lastProgress != progress:
-            print(str(progress) + "%  ", end="", flush = True)
-        lastProgress = progress
+    blockHashes = None
+    if metadata.get("deltaBlockSize") is not None and metadata.get("backupRootDirectory") is not None:
+        blockHashes = BlockHashCache(os.path.join(metadata["backupRootDirectory"], BLOCKHASHES_FILENAME))
+    executor = ActionExecutor(backupSources(metadata), threads, getCopyFunction(copyMethod), journal, resume, metadata.get("backupRootDirectory"),
+                              metadata.get("deltaBlockSize"), blockHashes)
+    submitted = 0
+    skipped = 0
+    skippedBytes = 0
+    def describe(elapsed):
+        copied = metrics.counter("bytes_copied")
+        # delta actions count their whole size in totalBytes, but only write the changed blocks
+        done = copied + metrics.counter("bytes_delta_unchanged") + metrics.counter("bytes_already_copied") + skippedBytes
+        return metrics.describeApply(executor.completed + skipped, actionCount, done, totalBytes, elapsed, copied)
 
-        actionType = action["type"]
-        params = action["params"]
+    with metrics.phase("apply_actions"), metrics.progress(describe):
         try:
-            if actionType == "copy":
-                fromPath = os.path.join(sourceDirectory, params["name"])
-                toPath = os.path.join(targetDirectory, params["name"])
-                logging.debug('copy from "' + fromPath + '" to "' + toPath + '"')
-
-                if os.path.isfile(fromPath):
-                    os.makedirs(os.path.dirname(toPath), exist_ok = True)
-                    shutil.copy2(fromPath, toPath)
-                elif os.path.isdir(fromPath):
-                    os.makedirs(toPath, exist_ok = True)
-            elif actionType == "delete":
-                path = os.path.join(targetDirectory, params["name"])
-                logging.debug('delete file "' + path + '"')
-
-                if os.path.isfile(path):
-                    os.remove(path)
-                elif os.path.isdir(path):
-                    shutil.rmtree(path)
-            elif actionType == "hardlink":
-                fromPath = os.path.join(compareDirectory, params["name"])
-                toPath = os.path.join(targetDirectory, params["name"])
-                logging.debug('hardlink from "' + fromPath + '" to "' + toPath + '"')
-                toDirectory = os.path.dirname(toPath)
-                os.makedirs(toDirectory, exist_ok = True)
-                hardlink(fromPath, toPath)
-            else:
-                logging.error("Unknown action type: " + actionType)
-        except OSError as e:
-            logging.error(e)
-        except IOError as e:
-            logging.error(e)
+            for index, action in enumerate(actions):
+                if index in journal.done:
+                    skipped += 1
+                    skippedBytes += copiedBytes(action)
+                    continue
+                executor.submit(index, action)
+                submitted += 1
+            executor.close()
+        except BaseException:
+            executor.close(cancel = True)
+            raise
+        finally:
+            # Even when interrupted, the actions that were applied are recorded, so they can be skipped when resuming
+            journal.close()
+            if blockHashes is not None:
+                blockHashes.close()
 
-    metadata["successful"] = True # TODO: Find a more accurate condition
+    if executor.errors > 0:
+        logging.error(str(executor.errors) + " of " + str(submitted) + " actions failed, so the backup is not marked as successful")
+    metadata["successful"] = executor.errors == 0
+    metadata["finished"] = time.time()
+    metadata["actions"] = submitted + skipped
+    metadata["failedActions"] = executor.errors
 
     with open(os.path.join(metadataDirectory, METADATA_FILENAME), "w") as outFile:
         json.dump(metadata, outFile, indent=4)
 
+    if metadata["successful"]:
+        manifest.commitManifest(metadataDirectory)
+        os.remove(journalPath)
+
+    catalogPath = catalog.backupCatalog(metadata, metadataDirectory)
+    if catalogPath is not None:
+        catalog.addBackup(catalogPath, metadata, metadataDirectory)
+    return metadata["successful"]
+
 if __name__ == '__main__':
     if len(sys.argv) < 2:
-        quit("Please specify a backup metadata directory path")
+        quit("Please specify a backup metadata directory path (and optionally the number of threads to use)")
 
     metadataDirectory = sys.argv[1]
+    threads = int(sys.argv[2]) if len(sys.argv) > 2 else 1
 
     fileHandler = logging.FileHandler(os.path.join(metadataDirectory, LOG_FILENAME))
     fileHandler.setFormatter(LOGFORMAT)
     logging.getLogger().addHandler(fileHandler)
+    logging.getLogger().addHandler(metrics.ErrorCounter())
 
     logging.info("Apply action file in backup directory " + metadataDirectory)
 
-    with open(os.path.join(metadataDirectory, ACTIONS_FILENAME)) as actionFile:
-        actions = json.load(actionFile)
+    try:
+        totals = actionTotals(metadataDirectory)
+    except FileNotFoundError as e:
+        logging.critical(str(e) + ", so its actions can not be applied anymore. Please run the backup again.")
+        quit()
+    if totals is None:
+        logging.critical("The action file in " + metadataDirectory + " is incomplete, because generating the actions was interrupted. Please run the backup again.")
+        quit()
 
-    executeActionList(metadataDirectory, actions)
+    # Continues where an interrupted run stopped, if there was one. Failed actions are tried again.
+    actionCount, totalBytes = totals
+    executeActionList(metadataDirectory, readActionFile(metadataDirectory), threads, actionCount = actionCount, totalBytes = totalBytes, resume = True)
+    metrics.export(metadataDirectory)
 
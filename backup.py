@@ -1,24 +1,47 @@
 import os, sys
 
-from collections import OrderedDict, defaultdict
-import fnmatch
+from collections import defaultdict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
 import importlib.util
 import json
-import locale
 import logging
+import queue
+import threading
 import time
+import webbrowser
 
-from applyActions import executeActionList
+from actionFile import Action, ActionFileWriter, actionTotals, readActionFile
+from actionHtml import writeActionHtml
+from applyActions import backupSources, executeActionList
+import catalog
 from constants import *
+from contentIndex import ContentIndex
+from hashCache import HashCache
+import manifest
+import metrics
+from metrics import formatBytes, formatDuration
+from scanner import ExcludeMatcher, UnchangedEntry, pathKey, relativeWalk
+import watcher
 # TODO: Fix json errors being incomprehensible, because the location specified does not match the minified json
 import strip_comments_json as configjson
 
 class FileDirectory:
-    def __init__(self, path, *, isDirectory, inSourceDir, inCompareDir):
+    __slots__ = ("path", "isDirectory", "sourceEntry", "compareEntry")
+
+    # sourceEntry and compareEntry are the FileEntries in the source and compare directory or None
+    def __init__(self, path, *, isDirectory, sourceEntry, compareEntry):
         self.path = path
-        self.inSourceDir = inSourceDir
-        self.inCompareDir = inCompareDir
         self.isDirectory = isDirectory
+        self.sourceEntry = sourceEntry
+        self.compareEntry = compareEntry
+
+    @property
+    def inSourceDir(self):
+        return self.sourceEntry is not None
+
+    @property
+    def inCompareDir(self):
+        return self.compareEntry is not None
 
     def __str__(self):
         inStr = []
@@ -28,68 +51,75 @@ class FileDirectory:
             inStr.append("compare dir")
         return self.path + ("(directory)" if self.isDirectory else "") + " (" + ",".join(inStr) + ")"
 
-# os.walk is not used since files would always be processed separate from directories
-# But os.walk will just ignore errors, if no error callback is given, scandir will not.
-def relativeWalk(path, startPath = None):
-    if startPath == None: startPath = path
-    # strxfrm -> local aware sorting - https://docs.python.org/3/howto/sorting.html#odd-and-ends
-    for entry in sorted(os.scandir(path), key = lambda x: locale.strxfrm(x.name)):
-        try:
-            #print(entry.path, " ----- ",  entry.name)
-            if entry.is_file():
-                yield os.path.relpath(entry.path, startPath), False
-            elif entry.is_dir():
-                yield os.path.relpath(entry.path, startPath), True
-                yield from relativeWalk(entry.path, startPath)
-            else:
-                logging.error("Encountered an object which is neither directory nor file: " + entry.path)
-        except OSError as e:
-            logging.error(e)
-
-# Possible actions:
-# copy (always from source to target),
-# delete (always in target)
-# hardlink (always from compare directory to target directory)
-# rename (always in target) (2-variate) (only needed for move detection)
-# hardlink2 (alway from compare directory to target directory) (2-variate) (only needed for move detection)
-def Action(type, **params):
-    return OrderedDict(type=type, params=params)
-
-def fileBytewiseCmp(a, b):
-    BUFSIZE = 8192 # http://stackoverflow.com/questions/236861/how-do-you-determine-the-ideal-buffer-size-when-using-fileinputstream
-    with open(a, "rb") as file1, open(b, "rb") as file2:
-        while True:
-            buf1 = file1.read(BUFSIZE)
-            buf2 = file2.read(BUFSIZE)
-            if buf1 != buf2: return False
-            if not buf1: return True
-
-def filesEq(a, b):
-    try:
-        aStat = os.stat(a)
-        bStat = os.stat(b)
-
-        equal = True
-        for method in config["compare_method"]:
-            if method == "moddate":
-                if aStat.st_mtime != bStat.st_mtime:
-                    break
-            elif method == "size":
-                if aStat.st_size != bStat.st_size:
-                    break
-            elif method == "bytes":
-                if not fileBytewiseCmp(a, b):
-                    break
-            else:
-                logging.critical("Compare method '" + method + "' does not exist")
-                quit()
+# Merges the sorted walks (FileEntries) of the source directory and the compare directory
+# and yields a FileDirectory for every path in either of them, in the same order.
+# Nothing but the current entry of each walk is held in memory, so this works for arbitrarily large trees.
+def mergeWalks(sourceEntries, compareEntries):
+    sourceEntries, compareEntries = iter(sourceEntries), iter(compareEntries)
+    source = next(sourceEntries, None)
+    compare = next(compareEntries, None)
+    sourceKey = pathKey(source.path) if source is not None else None
+    compareKey = pathKey(compare.path) if compare is not None else None
+
+    while source is not None or compare is not None:
+        if compare is None or (source is not None and sourceKey < compareKey):
+            yield FileDirectory(source.path, isDirectory = source.isDirectory, sourceEntry = source, compareEntry = None)
+            advanceSource, advanceCompare = True, False
+        elif source is None or compareKey < sourceKey:
+            yield FileDirectory(compare.path, isDirectory = compare.isDirectory, sourceEntry = None, compareEntry = compare)
+            advanceSource, advanceCompare = False, True
+        elif source.isDirectory != compare.isDirectory:
+            # A file became a directory or vice versa, so these are two different objects that happen to have the same path
+            yield FileDirectory(compare.path, isDirectory = compare.isDirectory, sourceEntry = None, compareEntry = compare)
+            yield FileDirectory(source.path, isDirectory = source.isDirectory, sourceEntry = source, compareEntry = None)
+            advanceSource, advanceCompare = True, True
         else:
-            return True
+            yield FileDirectory(source.path, isDirectory = source.isDirectory, sourceEntry = source, compareEntry = compare)
+            advanceSource, advanceCompare = True, True
+
+        if advanceSource:
+            source = next(sourceEntries, None)
+            sourceKey = pathKey(source.path) if source is not None else None
+        if advanceCompare:
+            compare = next(compareEntries, None)
+            compareKey = pathKey(compare.path) if compare is not None else None
+
+# Reads into buffer until it is full or the file ends, returns the number of bytes read
+def readFull(file, buffer):
+    view = memoryview(buffer)
+    length = 0
+    while length < len(buffer):
+        read = file.readinto(view[length:])
+        if not read:
+            break
+        length += read
+    return length
+
+# Large reads into preallocated buffers, which are compared with memcmp (comparing bytearrays is a lot faster than comparing memoryviews)
+def fileBytewiseCmp(a, b, size):
+    BUFSIZE = 1024 * 1024
+    with open(a, "rb", buffering = 0) as file1, open(b, "rb", buffering = 0) as file2:
+        for file in (file1, file2):
+            if hasattr(os, "posix_fadvise"):
+                os.posix_fadvise(file.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        buf1 = bytearray(min(BUFSIZE, size + 1))
+        buf2 = bytearray(len(buf1))
+        compared = 0
+        try:
+            while True:
+                length1 = readFull(file1, buf1)
+                length2 = readFull(file2, buf2)
+                compared += length1 + length2
+                if length1 != length2: return False
+                if length1 == len(buf1):
+                    if buf1 != buf2: return False
+                else:
+                    return buf1[:length1] == buf2[:length2]
+        finally:
+            metrics.count("bytes_compared", compared)
 
-        return False # This will be executed if break was called from the loop
-    except Exception as e: # Why is there no proper list of exceptions that may be thrown by filecmp.cmp and os.stat?
-        logging.error("For files '" + a + "'' and '" + b + "'' either 'stat'-ing or comparing the files failed: " + str(e))
-        return False # If we don't know, it has to be assumed they are different, even if this might result in more file operatiosn being scheduled
+# The compare methods that only need the FileEntries, everything else reads the files
+STAT_COMPARE_METHODS = ["moddate", "size"]
 
 def dirEmpty(path):
     try:
@@ -101,143 +131,301 @@ def dirEmpty(path):
         logging.error("Scanning directory '" + path + "' failed: " + str(e))
         return True
 
-if __name__ == '__main__':
-    logger = logging.getLogger()
-
-    stderrHandler = logging.StreamHandler(stream=sys.stderr)
-    stderrHandler.setFormatter(LOGFORMAT)
-    logger.addHandler(stderrHandler)
-
-    if len(sys.argv) < 2:
-        logging.critical("Please specify the configuration file for your backup.")
-        quit()
-
-    if not os.path.isfile(sys.argv[1]):
-        logging.critical("Configuration '" + sys.argv[1] + "' does not exist.")
-        quit()
-
-    with open(DEFAULT_CONFIG_FILENAME) as configFile:
+def moveKey(entry):
+    return entry.size, entry.mtime_ns
+
+# Yields the actions of several generators, which run on threads of their own, at most threads at the same time.
+# The actions of every generator stay in order, but those of different generators are interleaved in the order they are generated,
+# so the source directories on a fast disk do not wait for those on a slow one.
+def interleaveActions(generators, threads):
+    if len(generators) == 1:
+        yield from generators[0]
+        return
+
+    # (True, action) or (False, the exception the generator raised or None) once a generator ended
+    items = queue.Queue(maxsize = 1024)
+    stopped = threading.Event()
+    def run(generator):
+        error = None
+        try:
+            if not stopped.is_set():
+                for action in generator:
+                    items.put((True, action))
+                    if stopped.is_set():
+                        break
+        except BaseException as e:
+            error = e
+        finally:
+            generator.close()
+        items.put((False, error))
+
+    executor = ThreadPoolExecutor(max_workers = threads, thread_name_prefix = "source")
+    for generator in generators:
+        executor.submit(run, generator)
+    running = len(generators)
+    try:
+        while running > 0:
+            isAction, item = items.get()
+            if isAction:
+                yield item
+            else:
+                running -= 1
+                if item is not None:
+                    raise item
+    finally:
+        stopped.set()
+        # The other generators stop once they can put their next action
+        while running > 0:
+            isAction, item = items.get()
+            if not isAction:
+                running -= 1
+        executor.shutdown()
+
+# Passes the actions through, while writing them to the action file
+def recordActions(actions, actionWriter):
+    for action in actions:
+        actionWriter.write(action)
+        yield action
+    actionWriter.close()
+
+# Opens a file with the program associated with it. os.startfile only exists on Windows, elsewhere it is opened like a web page
+# (in the browser or, through xdg-open, in the associated program). A file that can not be opened does not stop the backup.
+def openFile(path):
+    try:
+        if hasattr(os, "startfile"):
+            os.startfile(path)
+        elif not webbrowser.open("file://" + os.path.abspath(path)):
+            logging.warning("Could not find a program to open " + path)
+    except OSError as e:
+        logging.warning("Could not open " + path + ": " + str(e))
+
+# The name of the directory the backup of sourceDirectory is in
+def targetName(sourceDirectory):
+    return os.path.basename(os.path.normpath(sourceDirectory))
+
+# Raised for problems with the configuration or the directories of a backup, which stop it before anything is done
+class BackupError(Exception):
+    pass
+
+# Returns the default configuration, updated with userConfig (a dictionary like a configuration file). source_dir is always a list.
+# origin describes where userConfig is from, for the error messages.
+def makeConfig(userConfig, origin = "the configuration"):
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), DEFAULT_CONFIG_FILENAME)) as configFile:
         config = configjson.load(configFile)
 
-    userConfigPath = sys.argv[1]
-    with open(userConfigPath) as userConfigFile:
-        userConfig = configjson.load(userConfigFile)
-
     for k, v in userConfig.items():
         if k not in config:
-            logging.critical("Unknown key '" + k + "' in the passed configuration file '" + userConfigPath + "'")
-            quit()
+            raise BackupError("Unknown key '" + k + "' in " + origin)
         else:
             config[k] = v
     for mandatory in ["source_dir", "backup_root_dir"]:
         if mandatory not in userConfig:
-            logging.critical("Please specify the mandatory key '" + mandatory + "' in the passed configuration file '" + userConfigPath + "'")
-            quit()
-
-    logger.setLevel(config["log_level"])
+            raise BackupError("Please specify the mandatory key '" + mandatory + "' in " + origin)
+
+    if isinstance(config["source_dir"], str):
+        config["source_dir"] = [config["source_dir"]]
+    names = [targetName(sourceDirectory) for sourceDirectory in config["source_dir"]]
+    for sourceDirectory, name in zip(config["source_dir"], names):
+        if name in ["", ".", ".."] or names.count(name) > 1:
+            raise BackupError("The backup of every source directory is saved in a directory named like it, so '" + sourceDirectory
+                              + "' needs a unique name (like /home/ and /etc/ in source_dir)")
+    for method in config["compare_method"]:
+        if method not in STAT_COMPARE_METHODS + ["bytes", "hash"]:
+            raise BackupError("Compare method '" + method + "' does not exist")
+    # A moved file is only recognized by its size and modification date, which many different files share
+    if config["detect_moves"] and "hash" not in config["compare_method"] and "bytes" not in config["compare_method"]:
+        raise BackupError("detect_moves needs \"hash\" or \"bytes\" in compare_method, so only files with the same contents are taken for moved ones")
 
     if config["mode"] == "hardlink":
         config["versioned"] = True
         config["compare_with_last_backup"] = True
+    return config
 
-    # Setup target and metadata directories and metadata file
-    os.makedirs(config["backup_root_dir"], exist_ok = True)
-    if config["versioned"]:
-        backupDirectory = os.path.join(config["backup_root_dir"], time.strftime(config["version_name"]))
+# Returns the default configuration, updated with the one in userConfigPath, see makeConfig
+def loadConfig(userConfigPath):
+    with open(userConfigPath) as userConfigFile:
+        userConfig = configjson.load(userConfigFile)
+    return makeConfig(userConfig, "the passed configuration file '" + userConfigPath + "'")
 
-        suffixNumber = 1
-        while True:
-            try:
-                path = backupDirectory
-                if suffixNumber > 1: path = path + "_" + str(suffixNumber)
-                os.makedirs(path)
-                backupDirectory = path
-                break
-            except FileExistsError as e:
-                suffixNumber += 1
-                logging.error("Target Backup directory '" + path + "' already exists. Appending suffix '_" + str(suffixNumber) + "'")
-    else:
-        backupDirectory = config["backup_root_dir"]
-
-    # Create backupDirectory and targetDirectory
-    targetDirectory = os.path.join(backupDirectory, os.path.basename(config["source_dir"]))
-    compareDirectory = targetDirectory
-    os.makedirs(targetDirectory, exist_ok = True)
-
-    # Init log file
-    fileHandler = logging.FileHandler(os.path.join(backupDirectory, LOG_FILENAME))
-    fileHandler.setFormatter(LOGFORMAT)
-    logger.addHandler(fileHandler)
-
-    # update compare directory
-    if config["versioned"] and config["compare_with_last_backup"]:
-        oldBackups = []
-        for entry in os.scandir(config["backup_root_dir"]):
-            if entry.is_dir() and os.path.join(config["backup_root_dir"], entry.name) != backupDirectory:
-                metadataFile = os.path.join(config["backup_root_dir"], entry.name, METADATA_FILENAME)
-                if os.path.isfile(metadataFile):
-                    with open(metadataFile) as inFile:
-                        oldBackups.append(json.load(inFile))
-
-        logging.debug("Found " + str(len(oldBackups)) + " old backups: " + str(oldBackups))
-
-        for backup in sorted(oldBackups, key = lambda x: x['started'], reverse = True):
-            if backup["successful"]:
-                compareDirectory = os.path.join(config["backup_root_dir"], backup['name'], os.path.basename(config["source_dir"]))
-                break
+# Identifies the version of the manifest file in backupDirectory, or None if there is none
+def manifestSignature(backupDirectory):
+    try:
+        stat = os.stat(os.path.join(backupDirectory, MANIFEST_FILENAME))
+    except FileNotFoundError:
+        return None
+    return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+# Backs up the source directories of a configuration (see makeConfig), from Python or the command line (backup.py) or service.py.
+# The stages can be used on their own: readDirectories (reading the source directory and the compare directory), compare, generateActions,
+# run (all of them for every source directory, writing the action file) and apply.
+# The hash cache, the content index and the exclude matcher stay open until close, so running several backups with the same engine does
+# not set them up again. With keepManifests, the manifest a backup wrote is also kept in memory for the next one, instead of reading it again.
+class BackupEngine:
+    def __init__(self, config, keepManifests = False):
+        self.config = config
+        self.keepManifests = keepManifests
+        self.exclude = ExcludeMatcher(config["exclude_paths"])
+        self.hashCache = None
+        self.contentIndex = None
+        # (backup directory, manifestSignature, {target name: [FileEntry, ...]}) of the last backup applied by this engine
+        self.manifestCache = None
+        # (backup directory, {target name: [FileEntry, ...]}) of the last backup planned by this engine, until it is applied
+        self.plannedManifest = None
+
+    # The number of threads of the given kind (source_scan_threads, compare_scan_threads, compare_threads) for every source directory.
+    # They are a budget for all the source directories read at the same time, so the load on a disk they share does not grow with their number.
+    def threads(self, key):
+        sourcesAtOnce = max(1, min(self.config["parallel_sources"], len(self.config["source_dir"])))
+        return max(1, self.config[key] // sourcesAtOnce)
+
+    def close(self):
+        if self.hashCache is not None:
+            self.hashCache.close()
+            self.hashCache = None
+        if self.contentIndex is not None:
+            self.contentIndex.close()
+            self.contentIndex = None
+
+    # Opens the caches a backup needs, unless they are open already, and prepares them for the next backup
+    def openCaches(self):
+        if self.config["mode"] == "hardlink" and self.config["content_index"]:
+            if self.contentIndex is None:
+                self.contentIndex = ContentIndex(self.config["backup_root_dir"])
+            with metrics.phase("update_content_index"):
+                self.contentIndex.update()
+
+        # The content index needs the hashes of the new files
+        if "hash" in self.config["compare_method"] or self.contentIndex is not None:
+            if self.hashCache is None:
+                self.hashCache = HashCache(os.path.join(self.config["backup_root_dir"], HASHCACHE_FILENAME))
+            self.hashCache.startRun()
+
+    # manifest.readManifest, but the manifest of the last backup applied by this engine is taken from memory, if it was kept and did not change
+    def readManifest(self, backupDirectory, targetName):
+        if self.manifestCache is not None:
+            cachedDirectory, signature, entries = self.manifestCache
+            if (cachedDirectory == backupDirectory and targetName in entries and manifestSignature(backupDirectory) == signature
+                    and not os.path.exists(os.path.join(backupDirectory, MANIFEST_INVALID_FILENAME))):
+                logging.debug("Taking the manifest of " + os.path.join(backupDirectory, targetName) + " from memory")
+                return iter(entries[targetName])
+        return manifest.readManifest(backupDirectory, targetName)
+
+    # Keeps the entries of the manifest of a backup after applying its actions, if that was successful
+    def keepManifest(self, backupDirectory, entries, successful):
+        if entries is not None and successful:
+            self.manifestCache = (backupDirectory, manifestSignature(backupDirectory), entries)
+        elif self.manifestCache is not None and self.manifestCache[0] == backupDirectory:
+            self.manifestCache = None
+
+    # aEntry and bEntry are the FileEntries of a and b. Their stat data is used instead of stat-ing the files again.
+    # methods defaults to compare_method from the config
+    def filesEq(self, a, b, aEntry, bEntry, methods = None):
+        if methods is None: methods = self.config["compare_method"]
+        # The file was not read from the source directory, because it did not change since the compare directory was backed up
+        if isinstance(aEntry, UnchangedEntry):
+            return True
+        try:
+            for method in methods:
+                if method == "moddate":
+                    if aEntry.mtime_ns != bEntry.mtime_ns:
+                        break
+                elif method == "size":
+                    if aEntry.size != bEntry.size:
+                        break
+                elif method == "bytes":
+                    # Files of different size can not be equal, so there is no need to open them
+                    if aEntry.size != bEntry.size or not fileBytewiseCmp(a, b, aEntry.size):
+                        break
+                elif method == "hash":
+                    # The hash of the compare file is usually known from the manifest of the last backup
+                    bHash = bEntry.hash
+                    if bHash is None:
+                        bHash = self.hashCache.hash(b, bEntry.size, bEntry.mtime_ns, bEntry.inode)
+                    if self.hashCache.hash(a, aEntry.size, aEntry.mtime_ns, aEntry.inode) != bHash:
+                        break
+                else:
+                    raise BackupError("Compare method '" + method + "' does not exist")
             else:
-                logging.error("It seems the last backup failed, so it will be skipped and the new backup will compare the source to the backup '" + backup["name"] + "'. The failed backup should probably be deleted.")
-        else:
-            logging.warning("No old backup found. Creating first backup.")
-
-    # Prepare metadata.json
-    with open(os.path.join(backupDirectory, METADATA_FILENAME), "w") as outFile:
-        json.dump({
-            'name': os.path.basename(backupDirectory),
-            'successful': False,
-            'started': time.time(),
-            'sourceDirectory': config["source_dir"],
-            'compareDirectory': compareDirectory,
-            'targetDirectory': targetDirectory,
-        }, outFile, indent=4)
-
-    logging.info("Source directory: " + config["source_dir"])
-    logging.info("Backup directory: " + backupDirectory)
-    logging.info("Target directory: " + targetDirectory)
-    logging.info("Compare directory: " + compareDirectory)
-    logging.info("Starting backup in " + config["mode"] + " mode")
-
-    # Build a list of all files in source directory and compare directory
-    # TODO: Include/exclude empty folders
-    logging.info("Building file set.")
-    logging.info("Reading source directory")
-    fileDirSet = []
-    for name, isDir in relativeWalk(config["source_dir"]):
-        for exclude in config["exclude_paths"]:
-            if fnmatch.fnmatch(name, exclude):
-                break
-        else:
-            fileDirSet.append(FileDirectory(name, isDirectory = isDir, inSourceDir = True, inCompareDir = False))
-
-    logging.info("Comparing with compare directory")
-    insertIndex = 0
-    for name, isDir in relativeWalk(compareDirectory):
-        while insertIndex < len(fileDirSet) and locale.strcoll(name, fileDirSet[insertIndex].path) > 0:
-            insertIndex += 1
-
-        if insertIndex < len(fileDirSet) and locale.strcoll(name, fileDirSet[insertIndex].path) == 0:
-            fileDirSet[insertIndex].inCompareDir = True
-        else:
-            fileDirSet.insert(insertIndex, FileDirectory(name, isDirectory = isDir, inSourceDir = False, inCompareDir = True))
-
-        insertIndex += 1
+                return True
+
+            return False # This will be executed if break was called from the loop
+        except Exception as e: # Why is there no proper list of exceptions that may be thrown by filecmp.cmp and os.stat?
+            logging.error("For files '" + a + "'' and '" + b + "'' either 'stat'-ing or comparing the files failed: " + str(e))
+            return False # If we don't know, it has to be assumed they are different, even if this might result in more file operatiosn being scheduled
+
+    # Yields (element, equal) for the FileDirectories in elements, in the same order. equal is only set for files in the source and compare directory.
+    # Comparisons that have to read the files ("bytes" and "hash") are run on a pool of threads, while the elements before and after them are processed.
+    # At most threads * 64 elements are held back waiting for the comparison of an earlier one.
+    # source are the directories of the elements, like in the metadata ({"name", "sourceDirectory", "compareDirectory", "targetDirectory"}).
+    def compareElements(self, elements, source, threads):
+        def paths(element):
+            return os.path.join(source["sourceDirectory"], element.path), os.path.join(source["compareDirectory"], element.path)
+
+        if threads <= 1:
+            for element in elements:
+                if element.inSourceDir and element.inCompareDir and not element.isDirectory:
+                    yield element, self.filesEq(*paths(element), element.sourceEntry, element.compareEntry)
+                else:
+                    yield element, None
+            return
 
-    for file in fileDirSet:
-        logging.debug(file)
+        statMethods = [method for method in self.config["compare_method"] if method in STAT_COMPARE_METHODS]
+        readMethods = [method for method in self.config["compare_method"] if method not in STAT_COMPARE_METHODS]
+        executor = ThreadPoolExecutor(max_workers = threads, thread_name_prefix = "compare")
+        pending = deque()
+        try:
+            for element in elements:
+                equal = None
+                if element.inSourceDir and element.inCompareDir and not element.isDirectory:
+                    # The cheap methods are checked right away, so files only have to be read if they could still be equal
+                    equal = self.filesEq(*paths(element), element.sourceEntry, element.compareEntry, statMethods)
+                    if equal and len(readMethods) > 0:
+                        equal = executor.submit(self.filesEq, *paths(element), element.sourceEntry, element.compareEntry, readMethods)
+                pending.append((element, equal))
+
+                while len(pending) > 0 and (len(pending) > threads * 64 or not isinstance(pending[0][1], Future) or pending[0][1].done()):
+                    element, equal = pending.popleft()
+                    yield element, equal.result() if isinstance(equal, Future) else equal
+
+            for element, equal in pending:
+                yield element, equal.result() if isinstance(equal, Future) else equal
+        finally:
+            executor.shutdown(wait = False, cancel_futures = True)
+
+    # The hash of a file in sourceDirectory, if hashes are used for comparison. sourceEntry is its FileEntry.
+    def sourceHash(self, sourceDirectory, sourceEntry):
+        if self.hashCache is None or sourceEntry.isDirectory or sourceEntry.size is None:
+            return None
+        if sourceEntry.hash is not None:
+            return sourceEntry.hash
+        path = os.path.join(sourceDirectory, sourceEntry.path)
+        try:
+            return self.hashCache.hash(path, sourceEntry.size, sourceEntry.mtime_ns, sourceEntry.inode)
+        except OSError as e:
+            logging.error("Hashing '" + path + "' failed: " + str(e))
+            return None
+
+    # Returns the FileEntry the element will have in the target directory after the given actions were applied to it
+    # or None if it will not be in the target directory (or only as a parent directory of another entry).
+    def targetManifestEntry(self, element, actionTypes, sourceDirectory, keepCompareEntries):
+        if "copy" in actionTypes or "delta" in actionTypes or "hardlink" in actionTypes:
+            if "copy" in actionTypes or "delta" in actionTypes:
+                # The inode of new files in the target directory is not known before they are created
+                inode = None
+            else:
+                inode = element.compareEntry.inode
+                # An unchanged file has the hash it had in the compare directory
+                if element.compareEntry.hash is not None:
+                    return element.sourceEntry._replace(inode = inode, hash = element.compareEntry.hash)
+            return element.sourceEntry._replace(inode = inode, hash = self.sourceHash(sourceDirectory, element.sourceEntry))
+        elif keepCompareEntries and element.inCompareDir and "delete" not in actionTypes:
+            if element.inSourceDir and element.compareEntry.hash is None:
+                # The file was found to be equal to the one in the source directory, so they have the same hash
+                return element.compareEntry._replace(hash = self.sourceHash(sourceDirectory, element.sourceEntry))
+            return element.compareEntry
+        return None
 
     # Determine what to do with these files
-    actions = []
-
     # ============== SAVE
     # Write all files that are in source, but are not already existing in compare (in that version)
     # source\compare: copy
@@ -248,7 +436,7 @@ if __name__ == '__main__':
 
     # --- move detection:
     # The same, except if files in source\compare and compare\source are equal, don't copy,
-    # but rather rename compare\source (old backup) to source\compare (new backup)
+    # but rather hardlink from compare\source (old backup, which stays as it is) to source\compare (new backup)
 
     # ============== MIRROR
     # End up with a complete copy of source in compare
@@ -260,6 +448,7 @@ if __name__ == '__main__':
 
     # --- move detection:
     # The same, except if files in source\compare and compare\source are equal, don't delete and copy, but rename
+    # (or hardlink from compare\source to source\compare, if compare is an older backup)
 
 
     # ============== HARDLINK
@@ -274,102 +463,439 @@ if __name__ == '__main__':
     # The same, except if files in source\compare and compare\source are equal, don't copy,
     # but rather hardlink from compare\source (old backup) to source\compare (new backup)
 
-    logging.info("Generating actions for " + str(len(fileDirSet)) + " files.. ")
-    lastProgress = 0
-    percentSteps = 5
-    inNewDir = None
-    for i, element in enumerate(fileDirSet):
-        progress = int(i/len(fileDirSet)*100.0/percentSteps + 0.5) * percentSteps
-        if lastProgress != progress:
-            print(str(progress) + "%  ", end="", flush = True)
-        lastProgress = progress
-
-        # source\compare
-        if element.inSourceDir and not element.inCompareDir:
-            if inNewDir != None and element.path.startswith(inNewDir):
-                actions.append(Action("copy", name=element.path, htmlFlags="inNewDir"))
+    # With the content index (hardlink mode with content_index), the copy of a file becomes a hardlink to an identical file
+    # in any version in backup_root_dir, if there is one. Returns the action to use instead of action.
+    def dedupAction(self, action, element, source):
+        if self.contentIndex is None or action.type != "copy" or action.isDirectory or (action.size or 0) < self.config["content_index_min_size"]:
+            return action
+        digest = self.sourceHash(source["sourceDirectory"], element.sourceEntry)
+        if digest is None:
+            return action
+        path = self.contentIndex.lookup(digest, action.size)
+        if path is None:
+            return action
+        return Action("dedup", name=action.name, isDirectory=False, size=action.size, fromName=path, target=action.target)
+
+    # Move detection: the copies of files in source\compare of at least move_detection_min_size bytes are held back until all files in
+    # compare\source are known. A held back file is moved if one of those has the same size and modification date and is equal to it
+    # (with compare_method, which compares the contents, see makeConfig). Deletes are held back as well, so a moved file is still there.
+    # Yields the actions for the held back copies (candidates: (element, copy action)) and the held back deletes.
+    # movedFrom maps the moveKey of the files in compare\source to their elements.
+    def movedFileActions(self, candidates, movedFrom, deletes, source, renameInPlace):
+        target = source["name"]
+        renamed = set()
+        movedBytes = 0
+        for element, action in candidates:
+            sourceEntry = element.sourceEntry
+            sourcePath = os.path.join(source["sourceDirectory"], element.path)
+            # Files with the same name are the most likely ones
+            matches = sorted(movedFrom.get(moveKey(sourceEntry), []),
+                             key = lambda match: os.path.basename(match.path) != os.path.basename(element.path))
+            for match in matches:
+                if renameInPlace and match.path in renamed:
+                    continue
+                if self.filesEq(sourcePath, os.path.join(source["compareDirectory"], match.path), sourceEntry, match.compareEntry):
+                    if renameInPlace:
+                        renamed.add(match.path)
+                        yield Action("rename", name=element.path, isDirectory=False, fromName=match.path, target=target)
+                    else:
+                        yield Action("hardlink2", name=element.path, isDirectory=False, fromName=match.path, target=target)
+                    movedBytes += sourceEntry.size
+                    break
             else:
-                actions.append(Action("copy", name=element.path))
-                if element.isDirectory:
-                    inNewDir = element.path
+                yield self.dedupAction(action, element, source)
+        if len(renamed) > 0 or movedBytes > 0:
+            logging.info("Detected moved files in " + source["sourceDirectory"] + ", " + formatBytes(movedBytes) + " do not have to be copied")
+        metrics.count("bytes_moved", movedBytes)
+        # The renamed files are moved away before their directories are deleted
+        for action in deletes:
+            if action.name not in renamed:
+                yield action
+
+    # Yields the actions for the (element, equal) pairs from compareElements for the directories of source.
+    # While doing that, the manifest of the target directory as it will be after applying them is written to manifestWriter.
+    # If the target is the compare directory, the entries of the compare directory stay, otherwise the target starts out empty.
+    # compareEmpty tells that there is no compare directory, so nothing can have been moved.
+    def generateActions(self, comparedElements, source, manifestWriter, compareEmpty = False):
+        target = source["name"]
+        keepCompareEntries = source["compareDirectory"] == source["targetDirectory"]
+        # Directories from the source that are not in the target yet, but will be created implicitly as parent of another entry
+        pendingDirs = []
+
+        # See movedFileActions. Without a compare directory, holding back the copies would only keep every large file in memory.
+        detectMoves = self.config["detect_moves"] and not compareEmpty
+        # Files in compare\source are only deleted if the compare directory is the target directory, so they can be renamed there
+        renameInPlace = self.config["mode"] == "mirror" and keepCompareEntries
+        heldCopies = []
+        heldDeletes = []
+        movedFrom = defaultdict(list)
+        # A held back delete that had to be applied right away, because the path is in the source directory as well
+        # (a file became a directory or the other way around). What is in it can not be moved anymore.
+        flushedDelete = None
+
+        inNewDir = None
+        elementCount = 0
+        actionCount = 0
+        for elementCount, (element, equal) in enumerate(comparedElements, 1):
+            logging.debug(element)
+            actions = []
+
+            # source\compare
+            if element.inSourceDir and not element.inCompareDir:
+                if inNewDir != None and element.path.startswith(inNewDir + os.sep):
+                    actions.append(Action("copy", name=element.path, isDirectory=element.isDirectory, size=element.sourceEntry.size, htmlFlags="inNewDir", target=target))
+                else:
+                    actions.append(Action("copy", name=element.path, isDirectory=element.isDirectory, size=element.sourceEntry.size, target=target))
+                    if element.isDirectory:
+                        inNewDir = element.path
 
 
 
-        # source&compare
-        elif element.inSourceDir and element.inCompareDir:
-            if element.isDirectory:
-                if config["versioned"] and config["compare_with_last_backup"]:
-                    # only explicitly create empty directories, so the action list is not cluttered with every directory in the source
-                    if dirEmpty(os.path.join(config["source_dir"], element.path)):
-                        actions.append(Action("copy", name=element.path, htmlFlags="emptyFolder"))
+            # source&compare
+            elif element.inSourceDir and element.inCompareDir:
+                if element.isDirectory:
+                    if self.config["versioned"] and self.config["compare_with_last_backup"]:
+                        # only explicitly create empty directories, so the action list is not cluttered with every directory in the source
+                        if dirEmpty(os.path.join(source["sourceDirectory"], element.path)):
+                            actions.append(Action("copy", name=element.path, isDirectory=element.isDirectory, size=element.sourceEntry.size, htmlFlags="emptyFolder", target=target))
+                else:
+                    # same
+                    if equal:
+                        if self.config["mode"] == "hardlink":
+                            actions.append(Action("hardlink", name=element.path, target=target))
+
+                    # different
+                    elif self.config["delta_min_size"] > 0 and (element.sourceEntry.size or 0) >= self.config["delta_min_size"]:
+                        # Only the blocks that changed are written
+                        actions.append(Action("delta", name=element.path, isDirectory=False, size=element.sourceEntry.size, target=target))
+                    else:
+                        actions.append(Action("copy", name=element.path, isDirectory=element.isDirectory, size=element.sourceEntry.size, target=target))
+
+            # compare\source
+            elif not element.inSourceDir and element.inCompareDir:
+                if self.config["mode"] == "mirror":
+                    if not self.config["compare_with_last_backup"] or not self.config["versioned"]:
+                        actions.append(Action("delete", name=element.path, isDirectory=element.isDirectory, target=target))
+
+            while len(pendingDirs) > 0 and not element.path.startswith(pendingDirs[-1].path + os.sep):
+                pendingDirs.pop()
+            targetEntry = self.targetManifestEntry(element, set(action.type for action in actions), source["sourceDirectory"], keepCompareEntries)
+            if targetEntry is not None:
+                for directory in pendingDirs:
+                    manifestWriter.add(directory.sourceEntry._replace(inode = None))
+                pendingDirs = []
+                manifestWriter.add(targetEntry)
+            elif element.inSourceDir and element.isDirectory:
+                pendingDirs.append(element)
+
+            if detectMoves:
+                if element.inSourceDir and not element.inCompareDir:
+                    if len(heldDeletes) > 0 and heldDeletes[-1][0].path == element.path:
+                        deletedElement, flushedDelete = heldDeletes.pop()
+                        candidates = movedFrom.get(moveKey(deletedElement.compareEntry), [])
+                        if deletedElement in candidates:
+                            candidates.remove(deletedElement)
+                        actionCount += 1
+                        yield flushedDelete
+                    if not element.isDirectory and (element.sourceEntry.size or 0) >= self.config["move_detection_min_size"]:
+                        heldCopies.extend((element, action) for action in actions)
+                        continue
+                elif element.inCompareDir and not element.inSourceDir:
+                    if flushedDelete is not None and element.path.startswith(flushedDelete.name + os.sep):
+                        actionCount += len(actions)
+                        yield from actions
+                        continue
+                    if not element.isDirectory and (element.compareEntry.size or 0) >= self.config["move_detection_min_size"]:
+                        movedFrom[moveKey(element.compareEntry)].append(element)
+                    heldDeletes.extend((element, action) for action in actions)
+                    continue
+            actionCount += len(actions)
+            for action in actions:
+                yield self.dedupAction(action, element, source)
+        if detectMoves:
+            for action in self.movedFileActions(heldCopies, movedFrom, [action for element, action in heldDeletes], source, renameInPlace):
+                actionCount += 1
+                yield action
+        logging.info("Generated " + str(actionCount) + " actions for " + str(elementCount) + " files and directories in " + source["sourceDirectory"])
+
+    # Returns the FileEntries of the source directory and the compare directory of source and whether the latter are known without walking
+    # the compare directory (read from a manifest, or none at all because it does not exist, like on a first backup or for a new source directory).
+    # compareMetadata is the metadata of the backup in compareBackupDirectory or None.
+    def readDirectories(self, source, compareBackupDirectory, compareMetadata):
+        sourceDirectory = source["sourceDirectory"]
+        sourceEntries = None
+        if self.config["use_dirty_journal"]:
+            # Only the directories that changed since the compare directory was backed up are read, everything else is taken from its manifest.
+            # That only works if the compare directory ended up containing exactly what was in the source directory.
+            compareSources = backupSources(compareMetadata).values() if compareMetadata is not None else []
+            if not (self.config["mode"] == "hardlink" or (self.config["mode"] == "mirror" and source["compareDirectory"] == source["targetDirectory"])):
+                logging.warning("use_dirty_journal only works in hardlink mode and in mirror mode without versioning, reading the whole source directory")
+            elif (compareMetadata is None or not compareMetadata["successful"] or compareMetadata.get("excludePaths") != self.config["exclude_paths"]
+                  or not any(compareSource["sourceDirectory"] == sourceDirectory for compareSource in compareSources)):
+                logging.info("The compare directory is not a complete backup of " + sourceDirectory + " with the same exclude_paths, reading the whole source directory")
             else:
-                # same
-                if filesEq(os.path.join(config["source_dir"], element.path), os.path.join(compareDirectory, element.path)):
-                    if config["mode"] == "hardlink":
-                        actions.append(Action("hardlink", name=element.path))
+                dirty = watcher.readDirtyJournal(self.config["backup_root_dir"], source["name"], sourceDirectory, compareMetadata["started"])
+                unchangedEntries = self.readManifest(compareBackupDirectory, source["name"]) if dirty is not None else None
+                if unchangedEntries is not None:
+                    logging.info(str(len(dirty)) + " directories changed in " + sourceDirectory + " since the last backup, only reading those")
+                    sourceEntries = watcher.dirtyWalk(sourceDirectory, unchangedEntries, dirty, self.threads("source_scan_threads"), self.exclude)
+        if sourceEntries is None:
+            sourceEntries = relativeWalk(sourceDirectory, self.threads("source_scan_threads"), self.exclude)
+
+        if not os.path.isdir(source["compareDirectory"]):
+            logging.info(source["compareDirectory"] + " does not exist, there is nothing to compare with")
+            return sourceEntries, iter(()), True
+        compareEntries = None
+        if self.config["use_manifest"]:
+            compareEntries = self.readManifest(compareBackupDirectory, source["name"])
+        if compareEntries is None:
+            logging.info("No manifest found for " + source["compareDirectory"] + ", reading the directory itself")
+            return sourceEntries, relativeWalk(source["compareDirectory"], self.threads("compare_scan_threads")), False
+        logging.info("Reading " + source["compareDirectory"] + " from the manifest of " + compareBackupDirectory)
+        return sourceEntries, compareEntries, True
+
+    # Yields (element, equal) for every file and directory in the source directory or compare directory of source, see readDirectories and compareElements
+    def compare(self, source, sourceEntries, compareEntries):
+        sourceEntries = metrics.stage("walk_source", sourceEntries)
+        compareEntries = metrics.stage("read_compare", compareEntries)
+        mergedElements = metrics.stage("merge", mergeWalks(sourceEntries, compareEntries), ["walk_source", "read_compare"])
+        return metrics.stage("compare", self.compareElements(mergedElements, source, self.threads("compare_threads")), ["merge"])
+
+    # Yields the actions for source, see compare and generateActions.
+    # The time spent in every stage is measured, summed over all sources.
+    def sourceActions(self, source, sourceEntries, compareEntries, manifestWriter, compareEmpty = False):
+        return metrics.stage("generate_actions", self.generateActions(self.compare(source, sourceEntries, compareEntries), source, manifestWriter, compareEmpty),
+                             ["compare"])
+
+    # Creates the directory of a new backup (backup_root_dir, if it is not versioned) and returns it
+    def createBackupDirectory(self):
+        os.makedirs(self.config["backup_root_dir"], exist_ok = True)
+        if not self.config["versioned"]:
+            return self.config["backup_root_dir"]
+
+        backupDirectory = os.path.join(self.config["backup_root_dir"], time.strftime(self.config["version_name"]))
+        suffixNumber = 1
+        while True:
+            try:
+                path = backupDirectory
+                if suffixNumber > 1: path = path + "_" + str(suffixNumber)
+                os.makedirs(path)
+                return path
+            except FileExistsError as e:
+                suffixNumber += 1
+                logging.error("Target Backup directory '" + path + "' already exists. Appending suffix '_" + str(suffixNumber) + "'")
 
-                # different
-                else:
-                    actions.append(Action("copy", name=element.path))
+    # Backs up the source directories into a new backup and returns its directory.
+    # apply decides whether the actions are applied (apply_actions by default), otherwise only the action file is written, see plan.
+    def run(self, apply = None):
+        if apply is None:
+            apply = self.config["apply_actions"]
+        for sourceDirectory in self.config["source_dir"]:
+            if not os.path.isdir(sourceDirectory):
+                raise BackupError("Source directory '" + sourceDirectory + "' does not exist.")
+
+        metrics.reset()
+        backupDirectory = self.createBackupDirectory()
+
+        # Init log file
+        logger = logging.getLogger()
+        fileHandler = logging.FileHandler(os.path.join(backupDirectory, LOG_FILENAME))
+        fileHandler.setFormatter(LOGFORMAT)
+        logger.addHandler(fileHandler)
+        try:
+            self.backup(backupDirectory, apply)
+        finally:
+            logger.removeHandler(fileHandler)
+            fileHandler.close()
+        return backupDirectory
+
+    # Generates the actions of a new backup without applying them and returns its directory, so they can be checked before calling apply
+    def plan(self):
+        return self.run(apply = False)
+
+    # Applies the actions of the backup in backupDirectory. With resume, the actions an interrupted earlier call applied are skipped.
+    def apply(self, backupDirectory, resume = False):
+        try:
+            totals = actionTotals(backupDirectory)
+        except FileNotFoundError as e:
+            raise BackupError(str(e) + ", so its actions can not be applied anymore. Please run the backup again.")
+        if totals is None:
+            raise BackupError("The action file in " + backupDirectory + " is incomplete, because generating the actions was interrupted. Please run the backup again.")
+        metrics.reset()
+        actionCount, totalBytes = totals
+        successful = executeActionList(backupDirectory, readActionFile(backupDirectory), self.config["apply_threads"], self.config["copy_method"],
+                                       actionCount, totalBytes, resume)
+        if self.plannedManifest is not None and self.plannedManifest[0] == backupDirectory:
+            self.keepManifest(backupDirectory, self.plannedManifest[1], successful)
+            self.plannedManifest = None
+        metrics.export(backupDirectory)
+
+    def backup(self, backupDirectory, apply):
+        config = self.config
+        # update compare directory
+        compareBackupDirectory = backupDirectory
+        if config["versioned"] and config["compare_with_last_backup"]:
+            lastBackup = catalog.lastSuccessfulBackup(config["backup_root_dir"])
+            if lastBackup is not None:
+                compareBackupDirectory = os.path.join(config["backup_root_dir"], lastBackup["name"])
+            else:
+                logging.warning("No old backup found. Creating first backup.")
+
+        sources = []
+        for sourceDirectory in config["source_dir"]:
+            name = targetName(sourceDirectory)
+            sources.append({
+                'name': name,
+                'sourceDirectory': sourceDirectory,
+                'compareDirectory': os.path.join(compareBackupDirectory, name),
+                'targetDirectory': os.path.join(backupDirectory, name),
+            })
+
+        # The metadata of the compare directory's backup, which is overwritten below if that is this backup directory
+        compareMetadata = None
+        compareMetadataPath = os.path.join(compareBackupDirectory, METADATA_FILENAME)
+        if os.path.isfile(compareMetadataPath):
+            with open(compareMetadataPath) as inFile:
+                compareMetadata = json.load(inFile)
+
+        # Prepare metadata.json
+        metadata = {
+            'name': os.path.basename(backupDirectory),
+            'successful': False,
+            'started': time.time(),
+            'sources': sources,
+            'excludePaths': config["exclude_paths"],
+            # Files are hardlinked from other versions in it (dedup actions) and the block digests are saved in it (delta actions)
+            'backupRootDirectory': config["backup_root_dir"],
+            'deltaBlockSize': config["delta_block_size"] if config["delta_min_size"] > 0 else None,
+            # Only versions are listed in the catalog, see catalog.backupCatalog
+            'catalog': CATALOG_FILENAME if config["versioned"] else None,
+            # So applyActions.py exports its metrics too
+            'metricsTextfile': config["metrics_textfile"] or None,
+        }
+        with open(os.path.join(backupDirectory, METADATA_FILENAME), "w") as outFile:
+            json.dump(metadata, outFile, indent=4)
+        # Until applying the actions ends, the backup is listed as not successful
+        if metadata["catalog"] is not None:
+            catalog.addBackup(catalog.backupCatalog(metadata, backupDirectory), metadata, backupDirectory)
+
+        logging.info("Backup directory: " + backupDirectory)
+        for source in sources:
+            logging.info("Source directory: " + source["sourceDirectory"] + ", target directory: " + source["targetDirectory"]
+                         + ", compare directory: " + source["compareDirectory"])
+        logging.info("Starting backup in " + config["mode"] + " mode")
+
+        self.openCaches()
+
+        # While generating the actions, the manifest of the target directories after applying them is written
+        manifestWriter = manifest.ManifestWriter(os.path.join(backupDirectory, MANIFEST_PENDING_FILENAME), self.keepManifests)
+        # The actions are streamed to the action file instead of being kept in memory
+        actionFilePath = os.path.join(backupDirectory, ACTIONS_FILENAME)
+        actionWriter = ActionFileWriter(actionFilePath)
+
+        # Walk the source directory and compare directory of every source at the same time and merge them into one stream of files and directories
+        # TODO: Include/exclude empty folders
+        applyWhileGenerating = apply and config["apply_while_generating"]
+        generators = []
+        for source in sources:
+            # A target directory that does not exist yet is an empty compare directory, so it is only created once it was not walked
+            compareEmpty = not os.path.isdir(source["compareDirectory"])
+            sourceEntries, compareEntries, withoutWalk = self.readDirectories(source, compareBackupDirectory, compareMetadata)
+            # Create the target directory
+            os.makedirs(source["targetDirectory"], exist_ok = True)
+            if applyWhileGenerating and source["compareDirectory"] == source["targetDirectory"] and not withoutWalk:
+                # The walk of the compare directory would see the changes made by the actions
+                logging.warning("apply_while_generating needs a manifest when the compare directory is the target directory, applying the actions afterwards")
+                applyWhileGenerating = False
+            if len(sources) == 1:
+                manifestWriter.beginSection(source["name"])
+                sourceManifestWriter = manifestWriter
+            else:
+                sourceManifestWriter = manifestWriter.openSection(source["name"])
+            generators.append(self.sourceActions(source, sourceEntries, compareEntries, sourceManifestWriter, compareEmpty))
+
+        logging.info("Reading the source directories and compare directories and generating actions.. ")
+        def allActions():
+            yield from interleaveActions(generators, config["parallel_sources"])
+            manifestWriter.close()
+        actions = metrics.stage("write_action_file", recordActions(allActions(), actionWriter), ["generate_actions"])
+        successful = None
+        if applyWhileGenerating:
+            logging.info("Applying the actions while they are generated")
+            successful = executeActionList(backupDirectory, actions, config["apply_threads"], config["copy_method"])
+        else:
+            def describe(elapsed):
+                return (str(metrics.counter("entries_scanned")) + " entries read, " + formatBytes(metrics.counter("bytes_compared") + metrics.counter("bytes_hashed"))
+                        + " compared, " + str(actionWriter.count) + " actions, " + formatDuration(elapsed))
+            with metrics.phase("scan_and_generate"), metrics.progress(describe):
+                for action in actions:
+                    pass
+
+        if self.hashCache is not None:
+            self.hashCache.prune([source["sourceDirectory"] for source in sources] + [source["compareDirectory"] for source in sources])
+            self.hashCache.commit()
+        if self.contentIndex is not None:
+            self.contentIndex.commit()
+
+        if config["save_actionfile"]:
+            logging.info("Saved the action file to " + actionFilePath)
+            if config["open_actionfile"]:
+                openFile(actionFilePath)
+
+        if config["save_actionhtml"]:
+            # Write HTML actions
+            actionHtmlFilePath = os.path.join(backupDirectory, ACTIONSHTML_FILENAME)
+            logging.info("Generating and writing action HTML file to " + actionHtmlFilePath)
+            with metrics.phase("write_action_html"):
+                writeActionHtml(actionHtmlFilePath, readActionFile(backupDirectory), actionWriter.histogram, config["exclude_actionhtml_actions"])
+
+            if config["open_actionhtml"]:
+                openFile(actionHtmlFilePath)
+
+        if apply and not applyWhileGenerating:
+            successful = executeActionList(backupDirectory, readActionFile(backupDirectory), config["apply_threads"], config["copy_method"],
+                                           actionWriter.count, actionWriter.bytes)
+
+        if successful is not None:
+            self.keepManifest(backupDirectory, manifestWriter.entries, successful)
+            # The action file is needed to resume applying the actions
+            if not config["save_actionfile"] and successful:
+                os.remove(actionFilePath)
+        else:
+            # apply needs the action file
+            self.plannedManifest = (backupDirectory, manifestWriter.entries)
 
-        # compare\source
-        elif not element.inSourceDir and element.inCompareDir:
-            if config["mode"] == "mirror":
-                if not config["compare_with_last_backup"] or not config["versioned"]:
-                    actions.append(Action("delete", name=element.path))
-    print("") # so the progress output from before ends with a new line
+        metrics.export(backupDirectory)
 
-    if config["save_actionfile"]:
-        # Write the action file
-        actionFilePath = os.path.join(backupDirectory, ACTIONS_FILENAME)
-        logging.info("Saving the action file to " + actionFilePath)
-        actionJson = "[\n" + ",\n".join(map(json.dumps, actions)) + "\n]"
-        with open(actionFilePath, "w") as actionFile:
-            actionFile.write(actionJson)
-
-        if config["open_actionfile"]:
-            os.startfile(actionFilePath)
-
-    if config["save_actionhtml"]:
-        # Write HTML actions
-        actionHtmlFilePath = os.path.join(backupDirectory, ACTIONSHTML_FILENAME)
-        logging.info("Generating and writing action HTML file to " + actionHtmlFilePath)
-        templatePath = os.path.join(os.path.dirname(os.path.abspath(__file__)), "template.html")
-        with open(templatePath, "r") as templateFile:
-            template = templateFile.read()
-
-        with open(actionHtmlFilePath, "w", encoding = "utf-8") as actionHTMLFile:
-            templateParts = template.split("<!-- ACTIONTABLE -->")
-
-            actionHist = defaultdict(int)
-            for action in actions:
-                actionHist[action["type"]] += 1
-            actionOverviewHTML = " | ".join(map(lambda k_v: k_v[0] + "(" + str(k_v[1]) + ")", actionHist.items()))
-            actionHTMLFile.write(templateParts[0].replace("<!-- OVERVIEW -->", actionOverviewHTML))
+if __name__ == '__main__':
+    logger = logging.getLogger()
 
-            # Writing this directly is a lot faster than concatenating huge strings
-            for action in actions:
-                if action["type"] not in config["exclude_actionhtml_actions"]:
-                    # Insert zero width space, so that the line breaks at the backslashes
-                    itemClass = action["type"]
-                    itemText = action["type"]
-                    if "htmlFlags" in action["params"]:
-                        flags = action["params"]["htmlFlags"]
-                        itemClass += "_" + flags
-                        if flags == "emptyFolder":
-                            itemText += " (empty directory)"
-                        elif flags == "inNewDir":
-                            itemText += " (in new directory)"
-                        else:
-                            logging.error("Unknown html flags for action html: " + str(flags))
-                    actionHTMLFile.write("\t\t<tr class=\"" + itemClass + "\"><td class=\"type\">" + itemText
-                                         + "</td><td class=\"name\">" + action["params"]["name"].replace("\\", "\\&#8203;") + "</td>\n")
-
-            actionHTMLFile.write(templateParts[1])
-
-        if config["open_actionhtml"]:
-            os.startfile(actionHtmlFilePath)
-
-    if config["apply_actions"]:
-        executeActionList(backupDirectory, actions)
+    stderrHandler = logging.StreamHandler(stream=sys.stderr)
+    stderrHandler.setFormatter(LOGFORMAT)
+    logger.addHandler(stderrHandler)
+    logger.addHandler(metrics.ErrorCounter())
 
+    if len(sys.argv) < 2:
+        logging.critical("Please specify the configuration file for your backup.")
+        quit()
+
+    if not os.path.isfile(sys.argv[1]):
+        logging.critical("Configuration '" + sys.argv[1] + "' does not exist.")
+        quit()
+
+    try:
+        config = loadConfig(sys.argv[1])
+    except BackupError as e:
+        logging.critical(str(e))
+        quit()
+
+    logger.setLevel(config["log_level"])
+
+    engine = BackupEngine(config)
+    try:
+        engine.run()
+    except BackupError as e:
+        logging.critical(str(e))
+        quit()
+    finally:
+        engine.close()
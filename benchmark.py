@@ -0,0 +1,245 @@
+import os, sys
+
+import argparse
+import contextlib
+import json
+import logging
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import tempfile
+import time
+
+from actionFile import ActionFileWriter, readActionFile
+from actionHtml import writeActionHtml
+from applyActions import executeActionList
+import backup
+from constants import *
+from hashCache import HashCache
+import manifest
+import metrics
+from scanner import ExcludeMatcher, relativeWalk
+
+# Benchmarks the phases of a backup on a synthetic source directory and an older backup of it.
+# The trees are generated from a seed, so the same arguments always produce the same trees.
+# The results are printed as one JSON object (and appended to --output as a line), so they can be compared across versions:
+# python benchmark.py --files 100000 --output benchmarks.jsonl
+
+# Directories whose contents are excluded, to benchmark exclude_paths
+EXCLUDED_DIRECTORY_NAME = "node_modules"
+
+# Parses "size:weight,size:weight,..." into a list of sizes and a list of weights
+def parseSizes(text):
+    sizes, weights = [], []
+    for part in text.split(","):
+        size, weight = part.split(":")
+        sizes.append(int(size))
+        weights.append(float(weight))
+    return sizes, weights
+
+def writeFile(path, rng, sizes, weights, mtime):
+    with open(path, "wb") as file:
+        file.write(rng.randbytes(rng.choices(sizes, weights)[0]))
+    os.utime(path, ns = (mtime, mtime))
+
+# Creates a tree of directories (depth levels with fanout subdirectories each) and distributes the files over them.
+# excludedDirectories of the directories get a directory with excludedFiles files, which is excluded by the returned exclude_paths.
+def generateTree(root, args, rng):
+    sizes, weights = parseSizes(args.sizes)
+    directories = [""]
+    level = [""]
+    for depth in range(args.depth):
+        level = [os.path.join(parent, "dir" + str(i)) for parent in level for i in range(args.fanout)]
+        directories += level
+    for directory in directories:
+        os.makedirs(os.path.join(root, directory), exist_ok = True)
+
+    mtime = 1500000000 * 10**9
+    files = []
+    for i in range(args.files):
+        path = os.path.join(rng.choice(directories), "file" + str(i))
+        writeFile(os.path.join(root, path), rng, sizes, weights, mtime)
+        files.append(path)
+
+    for directory in rng.sample(directories, min(args.excluded_dirs, len(directories))):
+        excludedDirectory = os.path.join(root, directory, EXCLUDED_DIRECTORY_NAME)
+        os.makedirs(excludedDirectory)
+        for i in range(args.excluded_files):
+            writeFile(os.path.join(excludedDirectory, "file" + str(i)), rng, [100], [1], mtime)
+    return directories, files
+
+# Changes the source directory like it would have changed since the last backup
+def changeTree(root, directories, files, args, rng):
+    sizes, weights = parseSizes(args.sizes)
+    changed = rng.sample(files, int(len(files) * (args.modify + args.delete)))
+    modified = changed[:int(len(files) * args.modify)]
+    for path in modified:
+        writeFile(os.path.join(root, path), rng, sizes, weights, time.time_ns())
+    for path in changed[len(modified):]:
+        os.remove(os.path.join(root, path))
+    for i in range(int(len(files) * args.add)):
+        writeFile(os.path.join(root, rng.choice(directories), "added" + str(i)), rng, sizes, weights, time.time_ns())
+
+# Runs function repeat times and returns the result of the last run and the durations in seconds
+def measure(function, repeat):
+    durations = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        durations.append(time.perf_counter() - start)
+    return result, durations
+
+def gitCommit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd = os.path.dirname(os.path.abspath(__file__)),
+                              capture_output = True, text = True, check = True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run(args, workDirectory):
+    rng = random.Random(args.seed)
+    sourceDirectory = os.path.join(workDirectory, "source")
+    backupRootDirectory = os.path.join(workDirectory, "backups")
+    compareBackupDirectory = os.path.join(backupRootDirectory, "old")
+    compareDirectory = os.path.join(compareBackupDirectory, "source")
+    backupDirectory = os.path.join(backupRootDirectory, "new")
+    targetDirectory = os.path.join(backupDirectory, "source")
+    excludePaths = [EXCLUDED_DIRECTORY_NAME + os.sep + "*", "*" + os.sep + EXCLUDED_DIRECTORY_NAME + os.sep + "*"]
+    exclude = ExcludeMatcher(excludePaths)
+
+    logging.info("Generating the trees in " + workDirectory)
+    directories, files = generateTree(sourceDirectory, args, rng)
+    shutil.copytree(sourceDirectory, compareDirectory, ignore = shutil.ignore_patterns(EXCLUDED_DIRECTORY_NAME))
+    manifestWriter = manifest.ManifestWriter(os.path.join(compareBackupDirectory, MANIFEST_FILENAME))
+    manifestWriter.beginSection("source")
+    for entry in relativeWalk(compareDirectory):
+        manifestWriter.add(entry)
+    manifestWriter.close()
+    changeTree(sourceDirectory, directories, files, args, rng)
+
+    userConfig = {}
+    if args.config is not None:
+        with open(args.config) as userConfigFile:
+            userConfig = backup.configjson.load(userConfigFile)
+    userConfig.update({"source_dir": sourceDirectory, "backup_root_dir": backupRootDirectory, "mode": args.mode,
+                       "versioned": args.mode == "hardlink", "compare_with_last_backup": True, "exclude_paths": excludePaths,
+                       "content_index": False})
+    config = backup.makeConfig(userConfig)
+    engine = backup.BackupEngine(config)
+    source = {"name": "source", "sourceDirectory": sourceDirectory, "compareDirectory": compareDirectory, "targetDirectory": targetDirectory}
+
+    phases = {}
+    counts = {"directories": len(directories), "files": len(files)}
+
+    # Walking
+    sourceEntries, phases["walk_source"] = measure(lambda: list(relativeWalk(sourceDirectory, config["source_scan_threads"], exclude)), args.repeat)
+    compareEntries, phases["walk_compare"] = measure(lambda: list(relativeWalk(compareDirectory, config["compare_scan_threads"])), args.repeat)
+    _, phases["read_manifest"] = measure(lambda: list(manifest.readManifest(compareBackupDirectory, "source")), args.repeat)
+    counts["source_entries"] = len(sourceEntries)
+    counts["compare_entries"] = len(compareEntries)
+
+    elements, phases["merge"] = measure(lambda: list(backup.mergeWalks(sourceEntries, compareEntries)), args.repeat)
+    counts["elements"] = len(elements)
+
+    # Comparing with every compare method alone. The hash cache is empty for the first run of "hash" and filled for the others.
+    for method in args.compare_methods:
+        config["compare_method"] = [method]
+        if method == "hash":
+            engine.hashCache = HashCache(os.path.join(workDirectory, HASHCACHE_FILENAME))
+        compared, phases["compare_" + method] = measure(lambda: list(engine.compareElements(elements, source, config["compare_threads"])), args.repeat)
+        counts["equal_" + method] = sum(1 for element, equal in compared if equal)
+        engine.close()
+
+    config["compare_method"] = ["moddate", "size"]
+    compared = list(engine.compareElements(elements, source, 1))
+
+    # Generating the actions and writing the action file and actions.html
+    os.makedirs(targetDirectory)
+    def generate():
+        manifestWriter = manifest.ManifestWriter(os.path.join(backupDirectory, MANIFEST_PENDING_FILENAME))
+        manifestWriter.beginSection("source")
+        actions = list(engine.generateActions(compared, source, manifestWriter))
+        manifestWriter.close()
+        return actions
+    actions, phases["generate_actions"] = measure(generate, args.repeat)
+    counts["actions"] = len(actions)
+
+    def writeActionFile():
+        writer = ActionFileWriter(os.path.join(backupDirectory, ACTIONS_FILENAME))
+        for action in actions:
+            writer.write(action)
+        writer.close()
+        return writer
+    actionWriter, phases["write_action_file"] = measure(writeActionFile, args.repeat)
+    _, phases["write_action_html"] = measure(lambda: writeActionHtml(os.path.join(backupDirectory, ACTIONSHTML_FILENAME),
+                                                                     readActionFile(backupDirectory), actionWriter.histogram, []), args.repeat)
+
+    # Applying the actions to an empty target directory every time
+    phases["apply_actions"] = []
+    for i in range(args.repeat):
+        shutil.rmtree(targetDirectory)
+        os.makedirs(targetDirectory)
+        with open(os.path.join(backupDirectory, METADATA_FILENAME), "w") as outFile:
+            json.dump({"name": "new", "successful": False, "started": time.time(), "sources": [source]}, outFile)
+        # The progress of every apply only counts its own copied bytes
+        metrics.reset()
+        _, durations = measure(lambda: executeActionList(backupDirectory, readActionFile(backupDirectory), config["apply_threads"],
+                                                         config["copy_method"], actionWriter.count, actionWriter.bytes), 1)
+        phases["apply_actions"] += durations
+
+    return phases, counts
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "Benchmarks the phases of a backup on synthetic directory trees")
+    parser.add_argument("--directory", help = "directory to generate the trees in (a temporary directory by default, use a tmpfs to leave the disk out)")
+    parser.add_argument("--keep", action = "store_true", help = "do not delete the generated trees")
+    parser.add_argument("--config", help = "a configuration file for the options not set here (threads, copy_method, ...)")
+    parser.add_argument("--output", help = "JSON lines file the results are appended to")
+    parser.add_argument("--seed", type = int, default = 0)
+    parser.add_argument("--repeat", type = int, default = 3, help = "how often every phase is run")
+    parser.add_argument("--files", type = int, default = 10000)
+    parser.add_argument("--depth", type = int, default = 3, help = "levels of directories")
+    parser.add_argument("--fanout", type = int, default = 5, help = "subdirectories per directory")
+    parser.add_argument("--sizes", default = "0:0.05,1000:0.5,20000:0.35,1000000:0.1", help = "file size distribution (size:weight,...)")
+    parser.add_argument("--modify", type = float, default = 0.01, help = "share of the files changed since the old backup")
+    parser.add_argument("--delete", type = float, default = 0.005, help = "share of the files deleted since the old backup")
+    parser.add_argument("--add", type = float, default = 0.005, help = "number of files added since the old backup, relative to --files")
+    parser.add_argument("--excluded-dirs", type = int, default = 5, help = "number of excluded directories")
+    parser.add_argument("--excluded-files", type = int, default = 200, help = "files in every excluded directory")
+    parser.add_argument("--mode", default = "hardlink", choices = ["hardlink", "mirror", "save"])
+    parser.add_argument("--compare-methods", nargs = "+", default = ["moddate", "size", "bytes", "hash"])
+    args = parser.parse_args()
+
+    logger = logging.getLogger()
+    stderrHandler = logging.StreamHandler(stream=sys.stderr)
+    stderrHandler.setFormatter(LOGFORMAT)
+    logger.addHandler(stderrHandler)
+    logger.setLevel(logging.WARNING)
+
+    if args.directory is not None:
+        os.makedirs(args.directory, exist_ok = True)
+    workDirectory = tempfile.mkdtemp(prefix = "frontdown-benchmark-", dir = args.directory)
+    try:
+        # The progress output goes to stderr, so only the results are printed to stdout
+        with contextlib.redirect_stdout(sys.stderr):
+            phases, counts = run(args, workDirectory)
+    finally:
+        if not args.keep:
+            shutil.rmtree(workDirectory)
+
+    result = {
+        "time": time.time(),
+        "commit": gitCommit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "arguments": {k: v for k, v in vars(args).items() if k not in ["directory", "keep", "output"]},
+        "counts": counts,
+        # the best of the runs and all of them, in seconds
+        "phases": {name: {"min": min(durations), "median": statistics.median(durations), "runs": durations} for name, durations in phases.items()},
+    }
+    print(json.dumps(result, indent = 4))
+    if args.output is not None:
+        with open(args.output, "a") as outFile:
+            outFile.write(json.dumps(result) + "\n")
@@ -0,0 +1,155 @@
+import os
+
+import json
+import logging
+
+from constants import *
+
+# The catalog lists the versions in backup_root_dir, so the last successful backup can be found without reading the metadata of every version.
+# It is a JSON lines file with records appended when a backup is started and when applying its actions ended:
+# {"name": ..., "started": ..., "finished": ..., "successful": ..., "actions": ..., "failedActions": ..., "manifest": <path relative to backup_root_dir or null>}
+# A record is written with a single write, a torn last line (crash while appending) is ignored.
+# A backup can have several records (e.g. when it was applied again with applyActions.py), the last one counts.
+
+def catalogRecord(metadata, metadataDirectory):
+    manifestPath = None
+    if os.path.isfile(os.path.join(metadataDirectory, MANIFEST_FILENAME)):
+        manifestPath = os.path.join(metadata["name"], MANIFEST_FILENAME)
+    return {
+        "name": metadata["name"],
+        "started": metadata["started"],
+        "finished": metadata.get("finished"),
+        "successful": metadata["successful"],
+        "actions": metadata.get("actions"),
+        "failedActions": metadata.get("failedActions"),
+        "manifest": manifestPath,
+    }
+
+# Returns the path of the catalog the backup in metadataDirectory is listed in, or None if it is not listed in one (backups of older versions
+# and ones that are not versioned). The metadata has it relative to backup_root_dir, the directory the backup is in, so that can be moved.
+# Metadata of older versions has an absolute path.
+def backupCatalog(metadata, metadataDirectory):
+    if metadata.get("catalog") is None:
+        return None
+    return os.path.join(os.path.dirname(os.path.abspath(metadataDirectory)), metadata["catalog"])
+
+def addBackup(catalogPath, metadata, metadataDirectory):
+    # A new catalog has to list the older backups as well
+    if not os.path.isfile(catalogPath):
+        rebuildCatalog(os.path.dirname(catalogPath))
+    line = json.dumps(catalogRecord(metadata, metadataDirectory)) + "\n"
+    with open(catalogPath, "ab+") as file:
+        # Do not continue a torn line
+        if file.seek(0, os.SEEK_END) > 0:
+            file.seek(-1, os.SEEK_END)
+            if file.read(1) != b"\n":
+                line = "\n" + line
+        file.write(line.encode("utf-8"))
+        file.flush()
+        os.fsync(file.fileno())
+
+# Yields the lines of a file from the last to the first one
+def _readLinesReversed(file):
+    file.seek(0, os.SEEK_END)
+    end = file.tell()
+    rest = b""
+    blockSize = 4096
+    while end > 0:
+        start = max(0, end - blockSize)
+        file.seek(start)
+        lines = (file.read(end - start) + rest).split(b"\n")
+        rest = lines.pop(0)
+        for line in reversed(lines):
+            if line.strip():
+                yield line
+        end = start
+    if rest.strip():
+        yield rest
+
+# Builds the catalog by reading the metadata of every version in backupRootDirectory, like it was done before there was a catalog
+def rebuildCatalog(backupRootDirectory):
+    catalogPath = os.path.join(backupRootDirectory, CATALOG_FILENAME)
+    logging.info("No backup catalog found, reading the metadata of all backups in " + backupRootDirectory)
+    records = []
+    for entry in os.scandir(backupRootDirectory):
+        if entry.is_dir():
+            metadataDirectory = os.path.join(backupRootDirectory, entry.name)
+            metadataFile = os.path.join(metadataDirectory, METADATA_FILENAME)
+            if os.path.isfile(metadataFile):
+                with open(metadataFile) as inFile:
+                    records.append(catalogRecord(json.load(inFile), metadataDirectory))
+
+    logging.debug("Found " + str(len(records)) + " old backups: " + str(records))
+
+    # Written to a temporary file first, so an interrupted rebuild never leaves an incomplete catalog
+    with open(catalogPath + ".tmp", "w", encoding = "utf-8") as file:
+        for record in sorted(records, key = lambda x: x["started"]):
+            file.write(json.dumps(record) + "\n")
+    os.replace(catalogPath + ".tmp", catalogPath)
+
+# Returns the catalog record of the last successful backup in backupRootDirectory or None if there is none.
+# Usually this only reads the last line of the catalog.
+def lastSuccessfulBackup(backupRootDirectory):
+    catalogPath = os.path.join(backupRootDirectory, CATALOG_FILENAME)
+    if not os.path.isfile(catalogPath):
+        rebuildCatalog(backupRootDirectory)
+
+    seen = set()
+    with open(catalogPath, "rb") as file:
+        for line in _readLinesReversed(file):
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            # Only the last record of a backup counts
+            if record["name"] in seen:
+                continue
+            seen.add(record["name"])
+
+            if not os.path.isdir(os.path.join(backupRootDirectory, record["name"])):
+                logging.warning("The backup '" + record["name"] + "' from the catalog does not exist anymore and will be skipped")
+            elif record["successful"]:
+                return record
+            else:
+                logging.error("It seems the backup '" + record["name"] + "' failed or was interrupted, so it will be skipped. "
+                              + "It can be finished with 'python applyActions.py \"" + os.path.join(backupRootDirectory, record["name"]) + "\"' or should probably be deleted.")
+    return None
+
+# Returns the last catalog record of every backup in backupRootDirectory, from the oldest to the newest one
+def backupRecords(backupRootDirectory):
+    catalogPath = os.path.join(backupRootDirectory, CATALOG_FILENAME)
+    if not os.path.isfile(catalogPath):
+        rebuildCatalog(backupRootDirectory)
+
+    records = {}
+    with open(catalogPath, "rb") as file:
+        for line in file:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            # Only the last record of a backup counts
+            records[record["name"]] = record
+    return sorted(records.values(), key = lambda x: x["started"])
+
+# Returns the catalog records of the successful backups in backupRootDirectory that still exist, from the oldest to the newest one
+def successfulBackups(backupRootDirectory):
+    return [record for record in backupRecords(backupRootDirectory)
+            if record["successful"] and os.path.isdir(os.path.join(backupRootDirectory, record["name"]))]
+
+# Removes the records of the backups with the given names from the catalog, once they are deleted
+def removeBackups(backupRootDirectory, names):
+    catalogPath = os.path.join(backupRootDirectory, CATALOG_FILENAME)
+    names = set(names)
+    # Written to a temporary file first, like in rebuildCatalog
+    with open(catalogPath, "rb") as inFile, open(catalogPath + ".tmp", "wb") as outFile:
+        for line in inFile:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if record["name"] not in names:
+                outFile.write(line.rstrip(b"\n") + b"\n")
+        outFile.flush()
+        os.fsync(outFile.fileno())
+    os.replace(catalogPath + ".tmp", catalogPath)
@@ -2,7 +2,18 @@ import logging
 
 LOG_FILENAME = "log.txt"
 METADATA_FILENAME = "metadata.json"
-ACTIONS_FILENAME = "actions.json"
+ACTIONS_FILENAME = "actions.jsonl"
+LEGACY_ACTIONS_FILENAME = "actions.json"
 ACTIONSHTML_FILENAME = "actions.html"
+ACTIONSHTML_DATA_DIRNAME = "actions_files"
+MANIFEST_FILENAME = "manifest.jsonl"
+MANIFEST_PENDING_FILENAME = "manifest.pending.jsonl"
+MANIFEST_INVALID_FILENAME = "manifest.invalid"
+JOURNAL_FILENAME = "journal.jsonl"
+HASHCACHE_FILENAME = "hashcache.sqlite"
+CONTENTINDEX_FILENAME = "contentindex.sqlite"
+BLOCKHASHES_FILENAME = "blockhashes.sqlite"
+CATALOG_FILENAME = "catalog.jsonl"
+DIRTY_JOURNAL_FILENAME = "dirty.jsonl"
 LOGFORMAT = logging.Formatter(fmt='%(levelname)-8s %(asctime)-8s.%(msecs)03d: %(message)s', datefmt="%H:%M:%S")
 DEFAULT_CONFIG_FILENAME = "default.config.json"
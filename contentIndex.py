@@ -0,0 +1,113 @@
+import os
+
+import logging
+import sqlite3
+import threading
+
+import catalog
+from constants import *
+import manifest
+
+# Maps the contents of files (hash and size) to a file with that content in one of the versions in backup_root_dir,
+# so hardlink mode can link a new file to an identical one anywhere in the backup history, not only at the same path in the last backup.
+# The index is filled from the hashes in the manifests of the successful backups: every backup is read once, when the index is updated
+# the first time after it was finished. A content always maps to its newest file, so deleting old versions rarely removes entries.
+# The contents whose file was in a removed backup can only be in older backups, so only those are read again, and only for these contents.
+# Deleting the oldest versions (like retention.py does) reads no manifest at all.
+class ContentIndex:
+    def __init__(self, backupRootDirectory):
+        self.backupRootDirectory = backupRootDirectory
+        self.connection = sqlite3.connect(os.path.join(backupRootDirectory, CONTENTINDEX_FILENAME), check_same_thread = False)
+        self.lock = threading.Lock()
+        # path is relative to backupRootDirectory
+        self.connection.execute("CREATE TABLE IF NOT EXISTS contents (hash TEXT, size INTEGER, backup TEXT, path TEXT, PRIMARY KEY (hash, size))")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS contents_backup ON contents (backup)")
+        # The backups whose manifests were read, started is their start time from the catalog
+        self.connection.execute("CREATE TABLE IF NOT EXISTS backups (name TEXT PRIMARY KEY, started REAL)")
+        # Indexes of older versions do not know when the backups were started, they are treated as the newest ones
+        if "started" not in [row[1] for row in self.connection.execute("PRAGMA table_info(backups)")]:
+            self.connection.execute("ALTER TABLE backups ADD COLUMN started REAL")
+        # The contents of removed backups, which are looked up again in the older backups, and the files of the backup being read
+        self.connection.execute("CREATE TEMP TABLE orphans (hash TEXT, size INTEGER, started REAL, PRIMARY KEY (hash, size))")
+        self.connection.execute("CREATE TEMP TABLE files (hash TEXT, size INTEGER, backup TEXT, path TEXT)")
+        self.hits = 0
+
+    # Yields the (hash, size, backup, path) rows of the files in the manifest of a backup
+    def manifestRows(self, name):
+        backupDirectory = os.path.join(self.backupRootDirectory, name)
+        targets = manifest.manifestTargets(backupDirectory)
+        if targets is None:
+            logging.warning("The backup '" + name + "' has no manifest, so its files are not added to the content index")
+            return
+        for target in targets:
+            for entry in manifest.readManifest(backupDirectory, target):
+                if not entry.isDirectory and entry.hash is not None and entry.size:
+                    yield entry.hash, entry.size, name, os.path.join(name, target, entry.path)
+
+    # Adds the files in the manifest of the backup, replacing the files already known for their contents
+    def addBackup(self, name, started):
+        self.connection.executemany("INSERT OR REPLACE INTO contents VALUES (?, ?, ?, ?)", self.manifestRows(name))
+        self.connection.execute("INSERT OR REPLACE INTO backups VALUES (?, ?)", (name, started))
+
+    # Removes the backup and remembers its contents as orphans, see findOrphans
+    def removeBackup(self, name, started):
+        self.connection.execute("INSERT OR IGNORE INTO orphans SELECT hash, size, ? FROM contents WHERE backup = ?",
+                                (started if started is not None else float("inf"), name))
+        self.connection.execute("DELETE FROM contents WHERE backup = ?", (name,))
+        self.connection.execute("DELETE FROM backups WHERE name = ?", (name,))
+
+    # Looks up the orphaned contents in the indexed backups (name, started) started before the backup they were removed with,
+    # from the newest to the oldest one, until all of them are found
+    def findOrphans(self, backups):
+        for name, started in sorted(backups, key = lambda backup: backup[1], reverse = True):
+            row = self.connection.execute("SELECT COUNT(*), MAX(started) FROM orphans").fetchone()
+            if row[0] == 0 or row[1] <= started:
+                break
+            logging.info("Looking up " + str(row[0]) + " contents of removed backups in the backup '" + name + "'")
+            self.connection.execute("DELETE FROM files")
+            self.connection.executemany("INSERT INTO files VALUES (?, ?, ?, ?)", self.manifestRows(name))
+            self.connection.execute("INSERT OR IGNORE INTO contents SELECT files.hash, files.size, files.backup, files.path FROM files "
+                                    "JOIN orphans ON files.hash = orphans.hash AND files.size = orphans.size WHERE orphans.started > ?", (started,))
+            self.connection.execute("DELETE FROM orphans WHERE EXISTS (SELECT 1 FROM contents WHERE contents.hash = orphans.hash AND contents.size = orphans.size)")
+        self.connection.execute("DELETE FROM files")
+        self.connection.execute("DELETE FROM orphans")
+
+    # Adds the successful backups that were not read yet and removes the ones that were deleted (or failed when applied again) since the last update
+    def update(self):
+        with self.lock:
+            self.hits = 0
+            backups = [(record["name"], record["started"]) for record in catalog.successfulBackups(self.backupRootDirectory)]
+            names = set(name for name, started in backups)
+            indexed = dict(self.connection.execute("SELECT name, started FROM backups"))
+            removed = [name for name in indexed if name not in names]
+            for name in removed:
+                logging.info("Removing the backup '" + name + "' from the content index")
+                self.removeBackup(name, indexed[name])
+            # The contents of the removed backups might still be in older ones
+            if len(removed) > 0:
+                self.findOrphans([(name, started) for name, started in backups if name in indexed])
+            # From the oldest to the newest one, so the newest file of a content is kept
+            for name, started in backups:
+                if name in indexed and indexed[name] is None:
+                    self.connection.execute("UPDATE backups SET started = ? WHERE name = ?", (started, name))
+                elif name not in indexed:
+                    logging.info("Adding the backup '" + name + "' to the content index")
+                    self.addBackup(name, started)
+            self.connection.commit()
+
+    # Returns the path (relative to backupRootDirectory) of a file with the given hash and size or None if there is none
+    def lookup(self, digest, size):
+        with self.lock:
+            row = self.connection.execute("SELECT path FROM contents WHERE hash = ? AND size = ?", (digest, size)).fetchone()
+            if row is not None:
+                self.hits += 1
+                return row[0]
+            return None
+
+    def commit(self):
+        logging.info("Content index: " + str(self.hits) + " files found in older backups")
+        self.connection.commit()
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
@@ -0,0 +1,219 @@
+import os, sys
+
+import errno
+import hashlib
+import shutil
+
+import metrics
+
+if os.name == "nt":
+    # From here: https://github.com/sid0/ntfs/blob/master/ntfsutils/hardlink.py
+    import ctypes
+    from ctypes import WinError
+    from ctypes.wintypes import BOOL
+    CreateHardLink = ctypes.windll.kernel32.CreateHardLinkW
+    CreateHardLink.argtypes = [ctypes.c_wchar_p, ctypes.c_wchar_p, ctypes.c_void_p]
+    CreateHardLink.restype = BOOL
+
+    def hardlink(source, link_name):
+        res = CreateHardLink(link_name, source, None)
+        if res == 0:
+            raise WinError()
+else:
+    def hardlink(source, link_name):
+        os.link(source, link_name)
+
+if sys.platform.startswith("linux"):
+    import fcntl
+
+# ioctl to share all extents of one file with another (a reflink) on Btrfs, XFS and others
+FICLONE = 0x40049409
+CHUNKSIZE = 64 * 1024 * 1024
+
+# errnos meaning "this file system (combination) does not support that", so the next method has to be used
+UNSUPPORTED_ERRNOS = set(getattr(errno, name) for name in ["EXDEV", "ENOSYS", "EOPNOTSUPP", "ENOTSUP", "ENOTTY", "EINVAL", "ETXTBSY", "EBADF"]
+                         if hasattr(errno, name))
+
+# Copies files like shutil.copy2 does, but without moving the data through userspace if possible:
+# 1. A reflink (FICLONE), which shares the data with the source and is instant
+# 2. copy_file_range, which copies inside the kernel (and might be offloaded to the file system or server)
+# 3. sendfile
+# 4. pread/pwrite
+# Holes in sparse files are skipped using SEEK_DATA/SEEK_HOLE, so they stay sparse.
+# Methods that turned out not to work for a pair of devices are not tried again for it.
+class LinuxCopier:
+    def __init__(self):
+        self.noReflink = set()
+        self.noCopyFileRange = set()
+        self.noSendfile = set()
+
+    def reflink(self, source, target, devices):
+        if devices in self.noReflink:
+            return False
+        try:
+            fcntl.ioctl(target, FICLONE, source)
+            metrics.count("bytes_copied", os.fstat(source).st_size)
+            return True
+        except OSError as e:
+            if e.errno not in UNSUPPORTED_ERRNOS:
+                raise
+            self.noReflink.add(devices)
+            return False
+
+    # Copies length bytes at offset, returns the number of bytes copied (less than length only at the end of the source file)
+    def copyRange(self, source, target, offset, length, devices):
+        end = offset + length
+        if devices not in self.noCopyFileRange:
+            try:
+                while offset < end:
+                    copied = os.copy_file_range(source, target, min(end - offset, CHUNKSIZE), offset, offset)
+                    if copied == 0:
+                        return offset - (end - length)
+                    offset += copied
+                    metrics.count("bytes_copied", copied)
+                return length
+            except OSError as e:
+                if e.errno not in UNSUPPORTED_ERRNOS:
+                    raise
+                self.noCopyFileRange.add(devices)
+
+        if devices not in self.noSendfile:
+            try:
+                os.lseek(target, offset, os.SEEK_SET)
+                while offset < end:
+                    copied = os.sendfile(target, source, offset, min(end - offset, CHUNKSIZE))
+                    if copied == 0:
+                        return offset - (end - length)
+                    offset += copied
+                    metrics.count("bytes_copied", copied)
+                return length
+            except OSError as e:
+                if e.errno not in UNSUPPORTED_ERRNOS:
+                    raise
+                self.noSendfile.add(devices)
+
+        while offset < end:
+            buffer = os.pread(source, min(end - offset, 1024 * 1024), offset)
+            if not buffer:
+                break
+            written = 0
+            while written < len(buffer):
+                written += os.pwrite(target, buffer[written:], offset + written)
+            offset += len(buffer)
+            metrics.count("bytes_copied", len(buffer))
+        return offset - (end - length)
+
+    # Copies only the data regions of a sparse file, the holes stay holes
+    def copySparse(self, source, target, size, devices):
+        offset = 0
+        while offset < size:
+            try:
+                dataStart = os.lseek(source, offset, os.SEEK_DATA)
+            except OSError as e:
+                if e.errno == errno.ENXIO: # no data after offset
+                    break
+                raise
+            dataEnd = os.lseek(source, dataStart, os.SEEK_HOLE)
+            self.copyRange(source, target, dataStart, dataEnd - dataStart, devices)
+            offset = dataEnd
+        os.ftruncate(target, size)
+
+    def copy(self, source, target):
+        with open(source, "rb") as sourceFile, open(target, "wb") as targetFile:
+            sourceFd, targetFd = sourceFile.fileno(), targetFile.fileno()
+            sourceStat = os.fstat(sourceFd)
+            devices = (sourceStat.st_dev, os.fstat(targetFd).st_dev)
+
+            if not self.reflink(sourceFd, targetFd, devices):
+                # st_blocks counts 512 byte blocks, regardless of the block size of the file system
+                if sourceStat.st_blocks * 512 < sourceStat.st_size and hasattr(os, "SEEK_DATA"):
+                    try:
+                        self.copySparse(sourceFd, targetFd, sourceStat.st_size, devices)
+                    except OSError as e:
+                        if e.errno not in UNSUPPORTED_ERRNOS:
+                            raise
+                        # SEEK_DATA is not supported, so copy everything
+                        os.ftruncate(targetFd, 0)
+                        self.copyRange(sourceFd, targetFd, 0, sourceStat.st_size, devices)
+                else:
+                    # copy until the end of the file, even if it grew since it was stat-ed
+                    offset = 0
+                    while True:
+                        copied = self.copyRange(sourceFd, targetFd, offset, CHUNKSIZE, devices)
+                        offset += copied
+                        if copied < CHUNKSIZE:
+                            break
+        shutil.copystat(source, target)
+
+# The digests of the blocks of a file (see deltaCopy) are BLAKE2 hashes of this many bytes, concatenated
+BLOCK_DIGEST_SIZE = 16
+
+# Updates target to the contents of source, but only writes the blocks (of blockSize bytes) that differ from those of base, the old version of the file.
+# If target is not base, it is made a reflink of base first, so it shares the unchanged blocks with it.
+# baseDigests are the block digests of base or None, then the blocks are read from it to compare them.
+# Returns the block digests of source or None if nothing was written, because target can not share the blocks of base
+# (no reflinks, or base is hardlinked elsewhere, so it can not be changed in place).
+def deltaCopy(source, target, base, blockSize, baseDigests = None):
+    inPlace = os.path.exists(target) and os.path.samefile(base, target)
+    if inPlace:
+        if os.stat(target).st_nlink > 1:
+            return None
+        targetFile = open(target, "r+b")
+    else:
+        if not sys.platform.startswith("linux"):
+            return None
+        targetFile = open(target, "wb")
+        try:
+            with open(base, "rb") as baseFile:
+                fcntl.ioctl(targetFile.fileno(), FICLONE, baseFile.fileno())
+        except OSError as e:
+            targetFile.close()
+            os.remove(target)
+            if e.errno not in UNSUPPORTED_ERRNOS:
+                raise
+            return None
+
+    digests = bytearray()
+    with open(source, "rb", buffering = 0) as sourceFile, targetFile:
+        targetFd = targetFile.fileno()
+        offset = 0
+        index = 0
+        while True:
+            block = sourceFile.read(blockSize)
+            if not block:
+                break
+            digest = hashlib.blake2b(block, digest_size = BLOCK_DIGEST_SIZE).digest()
+            digests += digest
+            if baseDigests is not None:
+                changed = baseDigests[index * BLOCK_DIGEST_SIZE:(index + 1) * BLOCK_DIGEST_SIZE] != digest
+            else:
+                # target has the contents of base until it is written
+                changed = os.pread(targetFd, blockSize, offset) != block
+            if changed:
+                written = 0
+                while written < len(block):
+                    written += os.pwrite(targetFd, block[written:], offset + written)
+                metrics.count("bytes_copied", len(block))
+            else:
+                metrics.count("bytes_delta_unchanged", len(block))
+            offset += len(block)
+            index += 1
+        os.ftruncate(targetFd, offset)
+    shutil.copystat(source, target)
+    return bytes(digests)
+
+def copy2(source, target):
+    shutil.copy2(source, target)
+    metrics.count("bytes_copied", os.path.getsize(target))
+
+# Returns a function copying a file including its metadata (like shutil.copy2) for the given copy_method.
+# The copied bytes are counted in metrics, by the LinuxCopier while copying.
+def getCopyFunction(method):
+    if method == "copy2":
+        return copy2
+    elif method == "auto":
+        if sys.platform.startswith("linux"):
+            return LinuxCopier().copy
+        return copy2
+    else:
+        raise ValueError("Copy method '" + method + "' does not exist")
@@ -0,0 +1,114 @@
+import os
+
+import hashlib
+import logging
+import sqlite3
+import threading
+import time
+
+import metrics
+
+HASH_BUFSIZE = 1024 * 1024
+
+def fileHash(path):
+    digest = hashlib.blake2b(digest_size = 32)
+    size = 0
+    with open(path, "rb", buffering = 0) as file:
+        buffer = bytearray(HASH_BUFSIZE)
+        view = memoryview(buffer)
+        while True:
+            length = file.readinto(buffer)
+            if not length:
+                break
+            digest.update(view[:length])
+            size += length
+    metrics.count("bytes_hashed", size)
+    return digest.hexdigest()
+
+# Returns the range (lower bound, upper bound) of the paths of the files in directory
+def pathRange(directory):
+    prefix = os.path.join(os.path.abspath(directory), "")
+    # every path starting with prefix lies in this range, since os.sep is followed by the next character
+    return prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+# Stores the hashes of files, so unchanged files never have to be read again.
+# A hash is only reused if size, modification date and inode of the file are still the same as when it was hashed.
+# It can be used from several threads, only the database access is serialized.
+class HashCache:
+    def __init__(self, dbPath):
+        self.connection = sqlite3.connect(dbPath, check_same_thread = False)
+        self.lock = threading.Lock()
+        self.connection.execute("CREATE TABLE IF NOT EXISTS hashes (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, inode INTEGER, hash TEXT, used REAL)")
+        self.startRun()
+
+    # The cache can be used for several backups, prune only deletes the hashes that were not used since the last call of startRun
+    def startRun(self):
+        self.started = time.time()
+        self.hits = 0
+        self.misses = 0
+
+    def hash(self, path, size, mtime_ns, inode):
+        path = os.path.abspath(path)
+        with self.lock:
+            row = self.connection.execute("SELECT size, mtime_ns, inode, hash FROM hashes WHERE path = ?", (path,)).fetchone()
+            if row is not None and row[:3] == (size, mtime_ns, inode):
+                self.hits += 1
+                self.connection.execute("UPDATE hashes SET used = ? WHERE path = ?", (self.started, path))
+                return row[3]
+            self.misses += 1
+
+        digest = fileHash(path)
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO hashes VALUES (?, ?, ?, ?, ?, ?)", (path, size, mtime_ns, inode, digest, self.started))
+        return digest
+
+    # Removes the hashes of all files in the given directories, that were not used since this cache was opened (or startRun)
+    # Only call this for directories that were read completely, otherwise hashes that are still needed are deleted
+    def prune(self, directories):
+        for directory in directories:
+            self.connection.execute("DELETE FROM hashes WHERE path >= ? AND path < ? AND used < ?", pathRange(directory) + (self.started,))
+
+    # Removes the hashes of all files in the given directories, for example because they were deleted
+    def remove(self, directories):
+        for directory in directories:
+            self.connection.execute("DELETE FROM hashes WHERE path >= ? AND path < ?", pathRange(directory))
+
+    def commit(self):
+        logging.info("Hash cache: " + str(self.hits) + " hits, " + str(self.misses) + " files hashed")
+        self.connection.commit()
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
+
+# Stores the block digests of the files in the backups that were updated by fileOperations.deltaCopy, so the old version of a file does not
+# have to be read again to find the blocks that changed. Files are identified by their inode, which all versions a file is hardlinked into share.
+# The digests are only used if size and modification date of the file are still the same as when they were stored.
+class BlockHashCache:
+    def __init__(self, dbPath):
+        self.connection = sqlite3.connect(dbPath, check_same_thread = False)
+        self.lock = threading.Lock()
+        self.connection.execute("CREATE TABLE IF NOT EXISTS blocks (inode INTEGER PRIMARY KEY, size INTEGER, mtime_ns INTEGER, blockSize INTEGER, digests BLOB)")
+
+    # Returns the block digests of the file at path or None if they are not known
+    def get(self, path, blockSize):
+        stat = os.stat(path)
+        with self.lock:
+            row = self.connection.execute("SELECT size, mtime_ns, blockSize, digests FROM blocks WHERE inode = ?", (stat.st_ino,)).fetchone()
+        if row is not None and row[:3] == (stat.st_size, stat.st_mtime_ns, blockSize):
+            return row[3]
+        return None
+
+    def set(self, path, blockSize, digests):
+        stat = os.stat(path)
+        with self.lock:
+            self.connection.execute("INSERT OR REPLACE INTO blocks VALUES (?, ?, ?, ?, ?)", (stat.st_ino, stat.st_size, stat.st_mtime_ns, blockSize, digests))
+
+    # Removes the digests of the given inodes, for example because their files were deleted
+    def remove(self, inodes):
+        with self.lock:
+            self.connection.executemany("DELETE FROM blocks WHERE inode = ?", ((inode,) for inode in inodes))
+
+    def close(self):
+        self.connection.commit()
+        self.connection.close()
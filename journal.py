@@ -0,0 +1,97 @@
+import os
+
+import json
+import logging
+import threading
+import time
+
+# Completed actions are written to the journal at most this often (in seconds)
+JOURNAL_INTERVAL = 5
+
+# Syncs a file or directory that may not exist (anymore). Directories can not be opened (and synced) on Windows.
+def fsyncPath(path):
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+# Records which actions of the action file were applied, so an interrupted executeActionList can be resumed.
+# It is a JSON lines file:
+# {"started": <time the actions started to be applied>}    header
+# [<index>, ...]                                            indices (positions in the action file) of applied actions, one line per batch
+#
+# Before a batch is written, the files and directories its actions changed are synced, so an action in the journal is on disk even after a power loss.
+# A batch that was being written while the process died is incomplete and ignored.
+class ActionJournal:
+    def __init__(self, path, resume):
+        self.done = set()
+        self.started = time.time()
+        if resume:
+            self.read(path)
+        # Rewriting the journal drops an incomplete last line
+        self.file = open(path, "w", encoding = "utf-8")
+        self.file.write(json.dumps({"started": self.started}) + "\n")
+        if len(self.done) > 0:
+            self.file.write(json.dumps(sorted(self.done)) + "\n")
+        self.sync()
+
+        self.pending = []
+        # Paths the pending actions changed, each together with the directory it is in
+        self.pendingPaths = set()
+        self.lock = threading.Lock()
+        self.lastFlush = time.monotonic()
+
+    def read(self, path):
+        try:
+            with open(path, encoding = "utf-8") as file:
+                for line in file:
+                    try:
+                        item = json.loads(line)
+                    except ValueError:
+                        logging.warning("Ignoring the incomplete last line of the journal '" + path + "'")
+                        break
+                    if isinstance(item, dict):
+                        self.started = item["started"]
+                    else:
+                        self.done.update(item)
+        except FileNotFoundError:
+            pass
+
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    # paths are the files and directories the action created, changed or removed
+    def add(self, index, paths = ()):
+        with self.lock:
+            self.pending.append(index)
+            self.pendingPaths.update(paths)
+            if time.monotonic() - self.lastFlush >= JOURNAL_INTERVAL:
+                self.flush()
+
+    # Has to be called with the lock held
+    def flush(self):
+        if len(self.pending) > 0:
+            # Make sure the applied actions are on disk before they are recorded as applied
+            directories = set()
+            for path in self.pendingPaths:
+                fsyncPath(path)
+                directories.add(os.path.dirname(path))
+            for directory in directories:
+                fsyncPath(directory)
+            self.pendingPaths = set()
+            self.file.write(json.dumps(self.pending) + "\n")
+            self.sync()
+            self.pending = []
+        self.lastFlush = time.monotonic()
+
+    def close(self):
+        with self.lock:
+            self.flush()
+        self.file.close()
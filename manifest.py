@@ -0,0 +1,177 @@
+import os
+
+import json
+import logging
+import shutil
+
+from constants import *
+from scanner import FileEntry
+
+# The manifest lists every file and directory of the target directories of a backup, in the same order relativeWalk would yield them,
+# so the next run can read it instead of walking the old backup again.
+# It is a JSON lines file:
+# {"format": 2}                                     header
+# {"target": "<name of the target directory>"}      a section per target directory
+# ["<relative path>", <isDirectory>, <size>, <mtime_ns>, <inode>, <mode>, <hash>]   one line per FileEntry (null for unknown values)
+# {"targets": ["<name>", ...]}                      trailer, only present if the manifest was written completely
+#
+# backup.py writes the manifest of the planned target state to MANIFEST_PENDING_FILENAME while generating the actions.
+# executeActionList marks the old manifest as invalid (MANIFEST_INVALID_FILENAME) before touching the target and only promotes the pending one
+# after the actions were applied, so a valid manifest always describes the target directory correctly.
+# A marker file is used instead of deleting the manifest, because it might still be read while the actions are applied (apply_while_generating).
+MANIFEST_FORMAT = 2
+
+# Writes the entries of a section into a file of its own, so it can be written at the same time as other sections
+class ManifestSectionWriter:
+    def __init__(self, filePath, targetName, entries = None):
+        self.filePath = filePath
+        self.targetName = targetName
+        self.file = open(filePath, "w", encoding = "utf-8")
+        self.entries = entries
+
+    def add(self, entry):
+        self.file.write(json.dumps(list(entry)) + "\n")
+        if self.entries is not None:
+            self.entries.append(FileEntry(*entry))
+
+    def close(self):
+        self.file.close()
+
+# The sections are either written one after another (beginSection, add) or at the same time (openSection),
+# for example by the threads generating the actions of several source directories.
+# With keepEntries, the entries are also kept in memory, as entries ({target name: [FileEntry, ...]}), so they do not have to be read again.
+class ManifestWriter:
+    def __init__(self, filePath, keepEntries = False):
+        self.filePath = filePath
+        self.file = open(filePath, "w", encoding = "utf-8")
+        self.file.write(json.dumps({"format": MANIFEST_FORMAT}) + "\n")
+        self.targets = []
+        self.sections = []
+        self.entries = {} if keepEntries else None
+
+    def beginSection(self, targetName):
+        self.targets.append(targetName)
+        self.file.write(json.dumps({"target": targetName}) + "\n")
+        if self.entries is not None:
+            self.entries[targetName] = []
+
+    def add(self, entry):
+        self.file.write(json.dumps(list(entry)) + "\n")
+        if self.entries is not None:
+            self.entries[self.targets[-1]].append(FileEntry(*entry))
+
+    # Returns a ManifestSectionWriter for the section of targetName. Its entries are appended to the manifest when it is closed.
+    def openSection(self, targetName):
+        entries = None
+        if self.entries is not None:
+            entries = self.entries[targetName] = []
+        section = ManifestSectionWriter(self.filePath + "." + str(len(self.sections)), targetName, entries)
+        self.sections.append(section)
+        return section
+
+    # Has to be called once all sections are complete
+    def close(self):
+        for section in self.sections:
+            section.close()
+            self.targets.append(section.targetName)
+            self.file.write(json.dumps({"target": section.targetName}) + "\n")
+            with open(section.filePath, encoding = "utf-8") as sectionFile:
+                shutil.copyfileobj(sectionFile, self.file)
+            os.remove(section.filePath)
+        self.file.write(json.dumps({"targets": self.targets}) + "\n")
+        self.file.close()
+
+def _readLastLine(file):
+    file.seek(0, os.SEEK_END)
+    end = file.tell()
+    blockSize = 4096
+    while True:
+        start = max(0, end - blockSize)
+        file.seek(start)
+        block = file.read(end - start)
+        lines = block.rstrip(b"\n").split(b"\n")
+        if len(lines) > 1 or start == 0:
+            return lines[-1]
+        blockSize *= 2
+
+# Returns the opened manifest file of the backup directory and the names of the target directories it contains
+# or None if there is no complete manifest
+def _openManifest(backupDirectory):
+    path = os.path.join(backupDirectory, MANIFEST_FILENAME)
+    if os.path.exists(os.path.join(backupDirectory, MANIFEST_INVALID_FILENAME)):
+        logging.warning("Manifest '" + path + "' was invalidated, because applying the actions of that backup was not finished")
+        return None
+    try:
+        file = open(path, "rb")
+    except FileNotFoundError:
+        return None
+
+    try:
+        header = json.loads(file.readline())
+        if not isinstance(header, dict) or header.get("format") != MANIFEST_FORMAT:
+            logging.warning("Manifest '" + path + "' has an unknown format and will be ignored")
+            file.close()
+            return None
+
+        trailer = json.loads(_readLastLine(file))
+        if not isinstance(trailer, dict) or "targets" not in trailer:
+            logging.warning("Manifest '" + path + "' is incomplete and will be ignored")
+            file.close()
+            return None
+    except ValueError as e:
+        logging.warning("Manifest '" + path + "' is corrupt and will be ignored: " + str(e))
+        file.close()
+        return None
+    return file, trailer["targets"]
+
+# Returns the names of the target directories in the manifest of the backup directory or None if there is no complete manifest
+def manifestTargets(backupDirectory):
+    opened = _openManifest(backupDirectory)
+    if opened is None:
+        return None
+    file, targets = opened
+    file.close()
+    return targets
+
+def readManifest(backupDirectory, targetName):
+    """Returns a generator over the FileEntries of the target directory targetName in the backup directory
+    or None if there is no complete manifest containing it."""
+    opened = _openManifest(backupDirectory)
+    if opened is None:
+        return None
+    file, targets = opened
+    if targetName not in targets:
+        logging.warning("Manifest '" + os.path.join(backupDirectory, MANIFEST_FILENAME) + "' does not contain '" + targetName + "' and will be ignored")
+        file.close()
+        return None
+
+    def entries():
+        with file:
+            file.seek(0)
+            file.readline()
+            inSection = False
+            for line in file:
+                item = json.loads(line)
+                if isinstance(item, dict):
+                    if inSection:
+                        return
+                    inSection = item.get("target") == targetName
+                elif inSection:
+                    yield FileEntry(*item)
+
+    return entries()
+
+def invalidateManifest(backupDirectory):
+    open(os.path.join(backupDirectory, MANIFEST_INVALID_FILENAME), "w").close()
+
+def commitManifest(backupDirectory):
+    pendingPath = os.path.join(backupDirectory, MANIFEST_PENDING_FILENAME)
+    manifestPath = os.path.join(backupDirectory, MANIFEST_FILENAME)
+    if os.path.isfile(pendingPath):
+        os.replace(pendingPath, manifestPath)
+    # If the actions were applied again, the manifest of the first time is still right
+    if os.path.isfile(manifestPath):
+        try:
+            os.remove(os.path.join(backupDirectory, MANIFEST_INVALID_FILENAME))
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,198 @@
+import os, sys
+
+from collections import defaultdict
+import contextlib
+import json
+import logging
+import threading
+import time
+
+from constants import *
+
+# Counters and phase durations of the current run. They can be updated from every thread.
+#
+# Counters: entries_scanned, directories_scanned, stats, bytes_compared, bytes_hashed, bytes_copied,
+# files_copied, files_delta_updated, bytes_delta_unchanged, directories_created, hardlinks_created, deletes, renames, bytes_moved, bytes_deduplicated,
+# failed_actions, errors
+#
+# Phases are either blocks of code (phase) with wall and CPU time of the process,
+# or stages of the pipeline generating the actions (stage). Those run interleaved on one thread per source directory, so only their wall time
+# is known: the time spent in the stage itself, without the stages it pulls its items from, summed over the source directories.
+_lock = threading.Lock()
+_counters = defaultdict(int)
+_phases = {}
+_stages = {}
+_started = (time.perf_counter(), time.process_time())
+
+def reset():
+    global _started
+    with _lock:
+        _counters.clear()
+        _phases.clear()
+        _stages.clear()
+        _started = (time.perf_counter(), time.process_time())
+
+def count(name, value = 1):
+    with _lock:
+        _counters[name] += value
+
+def counter(name):
+    return _counters.get(name, 0)
+
+@contextlib.contextmanager
+def phase(name):
+    wallStart, cpuStart = time.perf_counter(), time.process_time()
+    try:
+        yield
+    finally:
+        with _lock:
+            timing = _phases.setdefault(name, {"wall": 0.0, "cpu": 0.0})
+            timing["wall"] += time.perf_counter() - wallStart
+            timing["cpu"] += time.process_time() - cpuStart
+
+# Yields the items of iterable and measures the time spent getting them. upstream are the names of the stages iterable pulls from.
+# Several iterables can be measured as the same stage at the same time.
+def stage(name, iterable, upstream = ()):
+    with _lock:
+        timing = _stages.setdefault(name, {"inclusive": 0.0, "upstream": list(upstream)})
+    iterator = iter(iterable)
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            with _lock:
+                timing["inclusive"] += time.perf_counter() - start
+            return
+        with _lock:
+            timing["inclusive"] += time.perf_counter() - start
+        yield item
+
+def snapshot():
+    with _lock:
+        phases = {name: dict(timing) for name, timing in _phases.items()}
+        for name, timing in _stages.items():
+            exclusive = timing["inclusive"] - sum(_stages[upstream]["inclusive"] for upstream in timing["upstream"] if upstream in _stages)
+            phases[name] = {"wall": max(0.0, exclusive)}
+        phases["total"] = {"wall": time.perf_counter() - _started[0], "cpu": time.process_time() - _started[1]}
+        return {"phases": phases, "counters": dict(_counters)}
+
+# Counts logged errors
+class ErrorCounter(logging.Handler):
+    def __init__(self):
+        super().__init__(logging.ERROR)
+
+    def emit(self, record):
+        count("errors")
+
+def formatBytes(size):
+    for unit in ["B", "KB", "MB", "GB", "TB"]:
+        if abs(size) < 1024 or unit == "TB":
+            return ("%.1f " % size if unit != "B" else str(int(size)) + " ") + unit
+        size /= 1024
+
+def formatDuration(seconds):
+    seconds = int(seconds)
+    return "%d:%02d:%02d" % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+# Shows describe(elapsed seconds) as a status line every interval seconds, while the block runs.
+# On a terminal the line is updated in place, otherwise (e.g. a log file) a new line is printed every 30 seconds.
+@contextlib.contextmanager
+def progress(describe, interval = 1):
+    interactive = sys.stdout.isatty()
+    if not interactive:
+        interval = 30
+    stop = threading.Event()
+    start = time.perf_counter()
+
+    def show(end = ""):
+        line = describe(time.perf_counter() - start)
+        if interactive:
+            print("\r" + line + "\033[K", end = end, flush = True)
+        else:
+            print(line, flush = True)
+
+    def run():
+        while not stop.wait(interval):
+            show()
+
+    thread = threading.Thread(target = run, name = "progress", daemon = True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+        show("\n")
+
+# Progress of applying actions: weighted by bytes, with every action counting like this many bytes more, so many small files and hardlinks are not free
+ACTION_WEIGHT = 64 * 1024
+
+# The totals are None if they are not known yet (apply_while_generating).
+# copiedBytes are the bytes copied by this run, without those a resumed run skipped.
+def describeApply(doneActions, totalActions, doneBytes, totalBytes, elapsed, copiedBytes):
+    if totalActions is None or totalBytes is None:
+        line = str(doneActions) + " actions, " + formatBytes(doneBytes)
+        total = 0
+    else:
+        line = str(doneActions) + " of " + str(totalActions) + " actions, " + formatBytes(doneBytes) + " of " + formatBytes(totalBytes)
+        total = totalBytes + totalActions * ACTION_WEIGHT
+    if total > 0:
+        done = doneBytes + doneActions * ACTION_WEIGHT
+        line = "%.1f%%  " % (100.0 * done / total) + line
+        if done > 0:
+            line += ", ETA " + formatDuration(elapsed * (total - done) / done)
+    if elapsed > 0:
+        line += ", " + formatBytes(copiedBytes / elapsed) + "/s"
+    return line
+
+# Adds the metrics of this run to metadata.json in backupDirectory, replacing the ones with the same names (e.g. of an earlier, interrupted apply),
+# and writes them to the Prometheus textfile of the backup, if it has one (metrics_textfile)
+def export(backupDirectory):
+    metadataPath = os.path.join(backupDirectory, METADATA_FILENAME)
+    with open(metadataPath) as inFile:
+        metadata = json.load(inFile)
+    current = snapshot()
+    saved = metadata.setdefault("metrics", {"phases": {}, "counters": {}})
+    saved["phases"].update(current["phases"])
+    saved["counters"].update(current["counters"])
+    with open(metadataPath, "w") as outFile:
+        json.dump(metadata, outFile, indent=4)
+
+    if metadata.get("metricsTextfile"):
+        try:
+            sources = ",".join(source["sourceDirectory"] for source in metadata["sources"])
+            writePrometheus(metadata["metricsTextfile"], {"source": sources}, metadata["successful"])
+        except OSError as e:
+            logging.error("Could not write the metrics to " + metadata["metricsTextfile"] + ": " + str(e))
+
+def _escapeLabel(value):
+    return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+# Writes the metrics of this run in the Prometheus text format, for the textfile collector of the node exporter.
+# The file is replaced atomically, so it is never read half written.
+def writePrometheus(path, labels, successful):
+    current = snapshot()
+    labelText = ",".join(key + "=\"" + _escapeLabel(value) + "\"" for key, value in sorted(labels.items()))
+    lines = []
+    # samples is a list of (extra labels, value)
+    def metric(name, help, samples):
+        lines.append("# HELP " + name + " " + help)
+        lines.append("# TYPE " + name + " gauge")
+        for extraLabels, value in samples:
+            allLabels = ",".join(part for part in [labelText, extraLabels] if part)
+            lines.append(name + "{" + allLabels + "} " + repr(float(value)))
+
+    metric("frontdown_last_run_timestamp_seconds", "Time the last backup run ended", [("", time.time())])
+    metric("frontdown_last_run_successful", "Whether the last backup run was successful", [("", 1 if successful else 0)])
+    phases = sorted(current["phases"].items())
+    metric("frontdown_phase_wall_seconds", "Wall time of a phase of the last backup run",
+           [("phase=\"" + _escapeLabel(name) + "\"", timing["wall"]) for name, timing in phases])
+    metric("frontdown_phase_cpu_seconds", "CPU time of the process during a phase of the last backup run",
+           [("phase=\"" + _escapeLabel(name) + "\"", timing["cpu"]) for name, timing in phases if "cpu" in timing])
+    for name, value in sorted(current["counters"].items()):
+        metric("frontdown_" + name, "Counter " + name + " of the last backup run", [("", value)])
+
+    with open(path + ".tmp", "w") as outFile:
+        outFile.write("\n".join(lines) + "\n")
+    os.replace(path + ".tmp", path)
@@ -0,0 +1,223 @@
+import os, sys
+
+import argparse
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+import logging
+import threading
+import time
+
+from backup import BackupError, loadConfig
+import catalog
+from constants import *
+from contentIndex import ContentIndex
+from hashCache import BlockHashCache, HashCache
+from metrics import formatBytes, formatDuration
+
+# Deletes the versions in backup_root_dir the retention policy (keep_last, keep_daily, keep_weekly, keep_monthly, keep_yearly) does not keep:
+# python retention.py <configuration file> [--dry-run]
+# Before deleting anything, the space that will really be freed is reported. In hardlink mode most files are shared with the versions
+# that are kept, so only files whose links are all in deleted versions count.
+# This should not run at the same time as a backup into the same backup_root_dir.
+
+# A version being deleted is renamed to its name with this suffix, so an interrupted deletion is never taken for a backup and is finished next time
+PRUNING_SUFFIX = ".pruning"
+
+# The time.strftime formats of the periods of the policies, every period keeps its newest backup
+RETENTION_PERIODS = [("keep_daily", "%Y-%m-%d"), ("keep_weekly", "%G-%V"), ("keep_monthly", "%Y-%m"), ("keep_yearly", "%Y")]
+
+# Splits the catalog records of the backups (oldest first, see catalog.backupRecords) into the ones to keep and the ones to delete.
+# The policies only count successful backups. Failed ones are deleted once there is a newer successful backup, newer ones might still be running.
+def expiredBackups(records, config):
+    successful = [record for record in records if record["successful"]]
+    if len(successful) == 0:
+        return records, []
+    newest = successful[-1]
+
+    kept = set([newest["name"]])
+    for record in successful[::-1][:config["keep_last"]]:
+        kept.add(record["name"])
+    for key, periodFormat in RETENTION_PERIODS:
+        periods = set()
+        for record in reversed(successful):
+            if len(periods) >= config[key]:
+                break
+            period = time.strftime(periodFormat, time.localtime(record["started"]))
+            if period not in periods:
+                periods.add(period)
+                kept.add(record["name"])
+
+    keep = [record for record in records if record["name"] in kept or record["started"] > newest["started"]]
+    expire = [record for record in records if record not in keep]
+    return keep, expire
+
+# The bytes a file takes up on the disk
+def allocatedSize(stat):
+    # st_blocks is not available on Windows
+    if hasattr(stat, "st_blocks"):
+        return stat.st_blocks * 512
+    return stat.st_size
+
+# Lists the files and directories in the given directories on a pool of threads.
+# Returns the directories (every parent before its subdirectories) and {(device, inode): [links, links in the directories, allocated bytes]}
+def scanTrees(paths, threads):
+    directories = []
+    inodes = {}
+    lock = threading.Lock()
+
+    def scan(path):
+        subdirectories = []
+        files = []
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks = False):
+                    subdirectories.append(entry.path)
+                else:
+                    files.append(entry.stat(follow_symlinks = False))
+        stat = os.stat(path, follow_symlinks = False)
+        with lock:
+            for fileStat in files:
+                key = (fileStat.st_dev, fileStat.st_ino)
+                if key in inodes:
+                    inodes[key][1] += 1
+                else:
+                    inodes[key] = [fileStat.st_nlink, 1, allocatedSize(fileStat)]
+            # Directories can not be hardlinked, so they are always freed
+            inodes[(stat.st_dev, stat.st_ino)] = [1, 1, allocatedSize(stat)]
+        return subdirectories
+
+    executor = ThreadPoolExecutor(max_workers = threads, thread_name_prefix = "retention")
+    try:
+        pending = {}
+        for path in paths:
+            directories.append(path)
+            pending[executor.submit(scan, path)] = path
+        while len(pending) > 0:
+            done, notDone = wait(pending, return_when = FIRST_COMPLETED)
+            for future in done:
+                del pending[future]
+                for subdirectory in future.result():
+                    directories.append(subdirectory)
+                    pending[executor.submit(scan, subdirectory)] = subdirectory
+    finally:
+        executor.shutdown(cancel_futures = True)
+    # The order the directories were found in is not top-down with several threads, but paths are longer than their parents'
+    directories.sort(key = len)
+    return directories, inodes
+
+# Returns the bytes the files in inodes (see scanTrees) take up and the bytes of those that are freed when all of them are deleted,
+# because no link to them is left
+def reclaimableSpace(inodes):
+    total = 0
+    freed = 0
+    for links, deletedLinks, size in inodes.values():
+        total += size
+        if deletedLinks >= links:
+            freed += size
+    return total, freed
+
+# Deletes the files in the directories (see scanTrees) on a pool of threads, then the directories themselves, the deepest ones first
+def removeTrees(directories, threads):
+    def unlinkFiles(path):
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if not entry.is_dir(follow_symlinks = False):
+                    os.unlink(entry.path)
+
+    with ThreadPoolExecutor(max_workers = threads, thread_name_prefix = "retention") as executor:
+        # list() raises the first error
+        list(executor.map(unlinkFiles, directories))
+    for path in reversed(directories):
+        os.rmdir(path)
+
+# The path a path in a version has, once the version was renamed for deleting it
+def pruningPath(backupRootDirectory, path):
+    name, separator, rest = os.path.relpath(path, backupRootDirectory).partition(os.sep)
+    return os.path.join(backupRootDirectory, name + PRUNING_SUFFIX) + separator + rest
+
+# Removes everything that refers to the backups of the given names: the catalog records, their files in the content index
+# and the hashes of their files in the hash cache
+def forgetBackups(backupRootDirectory, names):
+    catalog.removeBackups(backupRootDirectory, names)
+    if os.path.isfile(os.path.join(backupRootDirectory, CONTENTINDEX_FILENAME)):
+        contentIndex = ContentIndex(backupRootDirectory)
+        # Only the successful backups in the catalog stay in the index
+        contentIndex.update()
+        contentIndex.close()
+    if os.path.isfile(os.path.join(backupRootDirectory, HASHCACHE_FILENAME)):
+        hashCache = HashCache(os.path.join(backupRootDirectory, HASHCACHE_FILENAME))
+        hashCache.remove([os.path.join(backupRootDirectory, name) for name in names])
+        hashCache.close()
+
+# Deletes the expired versions in backup_root_dir (only reports what would be deleted with dryRun)
+def pruneBackups(config, dryRun = False, threads = 1):
+    backupRootDirectory = config["backup_root_dir"]
+    if not config["versioned"]:
+        raise BackupError("Only versioned backups can be pruned")
+    if not any(config[key] > 0 for key in ["keep_last"] + [key for key, periodFormat in RETENTION_PERIODS]):
+        raise BackupError("No retention policy is configured (keep_last, keep_daily, keep_weekly, keep_monthly, keep_yearly)")
+
+    # Versions whose deletion was interrupted
+    leftovers = [os.path.join(backupRootDirectory, name) for name in os.listdir(backupRootDirectory)
+                 if name.endswith(PRUNING_SUFFIX) and os.path.isdir(os.path.join(backupRootDirectory, name))]
+    if len(leftovers) > 0 and not dryRun:
+        logging.info("Finishing the deletion of " + ", ".join(leftovers))
+        directories, inodes = scanTrees(leftovers, threads)
+        removeTrees(directories, threads)
+
+    records = catalog.backupRecords(backupRootDirectory)
+    missing = [record["name"] for record in records if not os.path.isdir(os.path.join(backupRootDirectory, record["name"]))]
+    records = [record for record in records if record["name"] not in missing]
+    keep, expire = expiredBackups(records, config)
+    for record in records:
+        logging.info(("Deleting " if record in expire else "Keeping ") + record["name"] + " (" + time.strftime("%Y-%m-%d %H:%M", time.localtime(record["started"]))
+                     + (", failed" if not record["successful"] else "") + ")")
+    if len(expire) == 0:
+        logging.info("No backups have expired")
+        if len(missing) > 0 and not dryRun:
+            forgetBackups(backupRootDirectory, missing)
+        return
+
+    start = time.perf_counter()
+    directories, inodes = scanTrees([os.path.join(backupRootDirectory, record["name"]) for record in expire], threads)
+    total, freed = reclaimableSpace(inodes)
+    logging.info("Deleting " + str(len(expire)) + " of " + str(len(records)) + " backups frees " + formatBytes(freed) + " of the " + formatBytes(total)
+                 + " they take up, the rest is shared with the backups that are kept (" + str(len(inodes)) + " files and directories, scanned in "
+                 + formatDuration(time.perf_counter() - start) + ")")
+    if dryRun:
+        return
+
+    names = [record["name"] for record in expire]
+    # Once they are not in the catalog anymore, no backup uses them as compare directory or hardlinks files from them
+    forgetBackups(backupRootDirectory, names + missing)
+    for name in names:
+        path = os.path.join(backupRootDirectory, name)
+        os.rename(path, path + PRUNING_SUFFIX)
+    removeTrees([pruningPath(backupRootDirectory, path) for path in directories], threads)
+    if os.path.isfile(os.path.join(backupRootDirectory, BLOCKHASHES_FILENAME)):
+        blockHashes = BlockHashCache(os.path.join(backupRootDirectory, BLOCKHASHES_FILENAME))
+        blockHashes.remove([inode for (device, inode), (links, deletedLinks, size) in inodes.items() if deletedLinks >= links])
+        blockHashes.close()
+    logging.info("Deleted " + str(len(expire)) + " backups in " + formatDuration(time.perf_counter() - start))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = "Deletes the backups the retention policy of the configuration does not keep")
+    parser.add_argument("config", help = "the configuration file of the backups")
+    parser.add_argument("--dry-run", action = "store_true", help = "only report which backups would be deleted and how much space that frees")
+    args = parser.parse_args()
+
+    logger = logging.getLogger()
+    stderrHandler = logging.StreamHandler(stream=sys.stderr)
+    stderrHandler.setFormatter(LOGFORMAT)
+    logger.addHandler(stderrHandler)
+
+    if not os.path.isfile(args.config):
+        logging.critical("Configuration '" + args.config + "' does not exist.")
+        quit()
+
+    try:
+        config = loadConfig(args.config)
+        logger.setLevel(config["log_level"])
+        pruneBackups(config, args.dry_run, config["apply_threads"])
+    except BackupError as e:
+        logging.critical(str(e))
+        quit()
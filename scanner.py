@@ -0,0 +1,126 @@
+import os
+
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+import fnmatch
+import locale
+import logging
+import re
+
+import metrics
+
+# A file or directory with the stat data it had when it was read. path is relative to the walked directory.
+# Walks and manifests both yield these, so everything after them never has to stat a file again.
+# Values that are not known (e.g. the inode of a file that is still to be copied) are None. hash is only known if it was computed for a comparison.
+FileEntry = namedtuple("FileEntry", ["path", "isDirectory", "size", "mtime_ns", "inode", "mode", "hash"])
+
+# A FileEntry of the source directory that was not read from the disk, but taken from the manifest of the compare directory,
+# because it is known not to have changed since (see watcher.dirtyWalk)
+class UnchangedEntry(FileEntry):
+    __slots__ = ()
+
+# Matches relative paths against fnmatch patterns (exclude_paths), which are compiled into a single regular expression once.
+# Paths are normalized like fnmatch.fnmatch does it (case and separators on Windows).
+class ExcludeMatcher:
+    def __init__(self, patterns):
+        patterns = [os.path.normcase(pattern) for pattern in patterns]
+        self.regex = self.compile(patterns)
+        # "dir/*" matches everything inside every directory matching "dir", since * also matches separators.
+        # So these directories do not have to be read at all.
+        self.contentsRegex = self.compile([pattern[:-2] for pattern in patterns if pattern.endswith(os.sep + "*")])
+
+    @staticmethod
+    def compile(patterns):
+        if len(patterns) == 0:
+            return None
+        return re.compile("|".join(map(fnmatch.translate, patterns)))
+
+    def excluded(self, path):
+        return self.regex is not None and self.regex.match(os.path.normcase(path)) is not None
+
+    # Whether everything inside the directory path is excluded
+    def contentsExcluded(self, path):
+        return self.contentsRegex is not None and self.contentsRegex.match(os.path.normcase(path)) is not None
+
+# The order in which relativeWalk yields paths: parents before their children, siblings sorted by their locale aware name
+def pathKey(path):
+    return tuple(map(locale.strxfrm, path.split(os.sep)))
+
+# Returns the FileEntries of a directory, sorted like relativeWalk yields them. Excluded entries are skipped before they are stat-ed.
+def scanDirectory(path, relativeDirectory = "", exclude = None):
+    entries = []
+    for entry in os.scandir(path):
+        relativePath = os.path.join(relativeDirectory, entry.name)
+        if exclude is not None and exclude.excluded(relativePath):
+            continue
+        try:
+            if entry.is_file():
+                isDir = False
+            elif entry.is_dir():
+                isDir = True
+            else:
+                logging.error("Encountered an object which is neither directory nor file: " + entry.path)
+                continue
+            # DirEntry.stat is free on Windows, but always reports inode 0 there
+            stat = entry.stat()
+            fileEntry = FileEntry(relativePath, isDir, stat.st_size, stat.st_mtime_ns,
+                                  stat.st_ino or entry.inode(), stat.st_mode, None)
+            # strxfrm -> local aware sorting - https://docs.python.org/3/howto/sorting.html#odd-and-ends
+            entries.append((locale.strxfrm(entry.name), fileEntry))
+        except OSError as e:
+            logging.error(e)
+    metrics.count("directories_scanned")
+    metrics.count("entries_scanned", len(entries))
+    metrics.count("stats", len(entries))
+    entries.sort(key = lambda x: x[0])
+    return [fileEntry for _, fileEntry in entries]
+
+def scanSubdirectory(path, relativeDirectory, exclude):
+    try:
+        return scanDirectory(path, relativeDirectory, exclude)
+    except OSError as e:
+        logging.error(e)
+        return []
+
+# Yields a FileEntry for every file and directory in path, parents before their children and siblings sorted by their locale aware name.
+# os.walk is not used since files would always be processed separate from directories
+# But os.walk will just ignore errors, if no error callback is given, scandir will not.
+#
+# With more than one thread, directories are read ahead on a thread pool. Reading a directory mostly means waiting for the disk or network,
+# so several of them can be read at the same time. The subdirectories of every directory are submitted as soon as it is entered
+# and the results are consumed in walk order, so the output stays exactly the same. At most maxPrefetch directory listings are held in advance.
+#
+# Paths matched by the ExcludeMatcher exclude are left out, including everything inside excluded directories, which are never read.
+# With relativeDirectory, only that subdirectory of path is walked (paths stay relative to path).
+def relativeWalk(path, threads = 1, exclude = None, maxPrefetch = None, relativeDirectory = ""):
+    if maxPrefetch is None: maxPrefetch = threads * 64
+    executor = ThreadPoolExecutor(max_workers = threads, thread_name_prefix = "scan") if threads > 1 else None
+    prefetched = 0
+
+    def descend(entry):
+        return entry.isDirectory and (exclude is None or not exclude.contentsExcluded(entry.path))
+
+    def walk(entries):
+        nonlocal prefetched
+        futures = {}
+        if executor is not None:
+            for entry in entries:
+                if descend(entry) and prefetched < maxPrefetch:
+                    futures[entry.path] = executor.submit(scanSubdirectory, os.path.join(path, entry.path), entry.path, exclude)
+                    prefetched += 1
+
+        for entry in entries:
+            yield entry
+            if descend(entry):
+                if entry.path in futures:
+                    subEntries = futures.pop(entry.path).result()
+                    prefetched -= 1
+                else:
+                    subEntries = scanSubdirectory(os.path.join(path, entry.path), entry.path, exclude)
+                yield from walk(subEntries)
+
+    try:
+        yield from walk(scanDirectory(os.path.join(path, relativeDirectory), relativeDirectory, exclude))
+    finally:
+        if executor is not None:
+            executor.shutdown(wait = False, cancel_futures = True)
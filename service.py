@@ -0,0 +1,61 @@
+import os, sys
+
+import logging
+import time
+
+from backup import BackupEngine, BackupError, loadConfig
+from constants import *
+import metrics
+
+# Runs the backups of several configurations on a schedule in one long running process:
+# python service.py <config> [<config> ...]
+# Every configuration is backed up every service_interval seconds (the first time right away), one backup after another.
+# Unlike starting backup.py for every backup, the configurations are only read once and every configuration keeps its BackupEngine,
+# so the hash cache and the content index stay open and the manifest of the last backup is taken from memory instead of being read again.
+if __name__ == '__main__':
+    logger = logging.getLogger()
+    stderrHandler = logging.StreamHandler(stream=sys.stderr)
+    stderrHandler.setFormatter(LOGFORMAT)
+    logger.addHandler(stderrHandler)
+    logger.addHandler(metrics.ErrorCounter())
+
+    if len(sys.argv) < 2:
+        logging.critical("Please specify the configuration files of your backups.")
+        quit()
+
+    # {"configPath", "engine", "next": time the next backup starts}
+    jobs = []
+    for configPath in sys.argv[1:]:
+        if not os.path.isfile(configPath):
+            logging.critical("Configuration '" + configPath + "' does not exist.")
+            quit()
+        try:
+            config = loadConfig(configPath)
+        except BackupError as e:
+            logging.critical(str(e))
+            quit()
+        jobs.append({"configPath": configPath, "engine": BackupEngine(config, keepManifests = True), "next": time.time()})
+    logger.setLevel(min(logging.getLevelName(job["engine"].config["log_level"]) for job in jobs))
+
+    try:
+        while True:
+            job = min(jobs, key = lambda job: job["next"])
+            time.sleep(max(0, job["next"] - time.time()))
+            started = time.time()
+            logging.info("Starting the backup of " + job["configPath"])
+            try:
+                job["engine"].run()
+            except BackupError as e:
+                logging.error("The backup of " + job["configPath"] + " failed: " + str(e))
+            except Exception:
+                # Anything else (like an sqlite3.Error) only stops this backup, not the ones of the other configurations
+                logging.exception("The backup of " + job["configPath"] + " failed")
+                # The caches are opened again by the next backup, in case they were left in a broken state
+                job["engine"].close()
+            # A backup that took longer than its interval is started again right away, but only once
+            job["next"] = started + job["engine"].config["service_interval"]
+    except KeyboardInterrupt:
+        logging.info("Stopped")
+    finally:
+        for job in jobs:
+            job["engine"].close()
@@ -0,0 +1,97 @@
+import os, sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import json
+import logging
+import tempfile
+import unittest
+
+import catalog
+from constants import *
+
+class CatalogTest(unittest.TestCase):
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.directory = tempfile.TemporaryDirectory()
+        self.root = self.directory.name
+        self.catalogPath = os.path.join(self.root, CATALOG_FILENAME)
+
+    def tearDown(self):
+        self.directory.cleanup()
+        logging.disable(logging.NOTSET)
+
+    # Creates the directory and metadata.json of a backup and lists it in the catalog
+    def addBackup(self, name, started, successful, writeCatalog = True):
+        metadataDirectory = os.path.join(self.root, name)
+        os.makedirs(metadataDirectory, exist_ok = True)
+        metadata = {"name": name, "started": started, "successful": successful, "catalog": CATALOG_FILENAME}
+        with open(os.path.join(metadataDirectory, METADATA_FILENAME), "w") as outFile:
+            json.dump(metadata, outFile)
+        if writeCatalog:
+            catalog.addBackup(catalog.backupCatalog(metadata, metadataDirectory), metadata, metadataDirectory)
+
+    def test_last_successful_backup(self):
+        self.addBackup("a", 1, True)
+        self.addBackup("b", 2, True)
+        self.addBackup("c", 3, False)
+        self.assertEqual(catalog.lastSuccessfulBackup(self.root)["name"], "b")
+
+    def test_last_record_counts(self):
+        # Applied again with applyActions.py after failing
+        self.addBackup("a", 1, True)
+        self.addBackup("b", 2, False)
+        self.addBackup("b", 2, True)
+        self.assertEqual(catalog.lastSuccessfulBackup(self.root)["name"], "b")
+        self.addBackup("b", 2, False)
+        self.assertEqual(catalog.lastSuccessfulBackup(self.root)["name"], "a")
+
+    def test_deleted_backup_is_skipped(self):
+        self.addBackup("a", 1, True)
+        self.addBackup("b", 2, True)
+        os.remove(os.path.join(self.root, "b", METADATA_FILENAME))
+        os.rmdir(os.path.join(self.root, "b"))
+        self.assertEqual(catalog.lastSuccessfulBackup(self.root)["name"], "a")
+
+    def test_read_backwards_across_blocks(self):
+        # More records than fit in one block of _readLinesReversed
+        for i in range(200):
+            self.addBackup("backup%03d" % i, i, i < 150)
+        self.assertGreater(os.path.getsize(self.catalogPath), 3 * 4096)
+        self.assertEqual(catalog.lastSuccessfulBackup(self.root)["name"], "backup149")
+
+    def test_torn_last_line(self):
+        self.addBackup("a", 1, True)
+        self.addBackup("b", 2, True)
+        # A crash while appending the record of c
+        with open(self.catalogPath, "ab") as file:
+            file.write(b'{"name": "c", "started": 3, "succ')
+        self.assertEqual(catalog.lastSuccessfulBackup(self.root)["name"], "b")
+        self.assertEqual([record["name"] for record in catalog.backupRecords(self.root)], ["a", "b"])
+        # The next record does not continue the torn line
+        self.addBackup("d", 4, True)
+        self.assertEqual(catalog.lastSuccessfulBackup(self.root)["name"], "d")
+        self.assertEqual([record["name"] for record in catalog.backupRecords(self.root)], ["a", "b", "d"])
+
+    def test_rebuild_missing_catalog(self):
+        self.addBackup("b", 2, True, writeCatalog = False)
+        self.addBackup("a", 1, True, writeCatalog = False)
+        self.addBackup("c", 3, False, writeCatalog = False)
+        self.assertFalse(os.path.exists(self.catalogPath))
+        self.assertEqual(catalog.lastSuccessfulBackup(self.root)["name"], "b")
+        self.assertTrue(os.path.isfile(self.catalogPath))
+        self.assertEqual([record["name"] for record in catalog.backupRecords(self.root)], ["a", "b", "c"])
+
+    def test_catalog_path_follows_moved_backups(self):
+        self.addBackup("a", 1, True)
+        moved = os.path.join(self.root, "moved")
+        os.makedirs(moved)
+        os.rename(os.path.join(self.root, "a"), os.path.join(moved, "a"))
+        with open(os.path.join(moved, "a", METADATA_FILENAME)) as inFile:
+            metadata = json.load(inFile)
+        self.assertEqual(catalog.backupCatalog(metadata, os.path.join(moved, "a")), os.path.join(moved, CATALOG_FILENAME))
+        # Metadata of older versions has an absolute path
+        metadata["catalog"] = self.catalogPath
+        self.assertEqual(catalog.backupCatalog(metadata, os.path.join(moved, "a")), self.catalogPath)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,173 @@
+import os, sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import json
+import logging
+import random
+import tempfile
+import unittest
+
+from actionFile import readActionFile
+from backup import BackupEngine, makeConfig
+from constants import *
+from fileOperations import BLOCK_DIGEST_SIZE, deltaCopy
+from hashCache import BlockHashCache
+import metrics
+
+BLOCK_SIZE = 4096
+
+def randomBytes(size, seed):
+    return random.Random(seed).randbytes(size)
+
+def writeFile(path, data):
+    with open(path, "wb") as file:
+        file.write(data)
+
+def readFile(path):
+    with open(path, "rb") as file:
+        return file.read()
+
+# Replaces the block with the given index of data
+def changeBlock(data, index, seed):
+    return data[:index * BLOCK_SIZE] + randomBytes(BLOCK_SIZE, seed) + data[(index + 1) * BLOCK_SIZE:]
+
+class DeltaCopyTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.source = os.path.join(self.directory.name, "source")
+        self.base = os.path.join(self.directory.name, "base")
+        self.old = randomBytes(8 * BLOCK_SIZE + 100, 0)
+        writeFile(self.base, self.old)
+        metrics.reset()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_in_place(self):
+        new = changeBlock(changeBlock(self.old, 2, 1), 5, 2)
+        writeFile(self.source, new)
+        inode = os.stat(self.base).st_ino
+
+        digests = deltaCopy(self.source, self.base, self.base, BLOCK_SIZE)
+
+        self.assertEqual(readFile(self.base), new)
+        self.assertEqual(os.stat(self.base).st_ino, inode)
+        self.assertEqual(os.stat(self.base).st_mtime_ns, os.stat(self.source).st_mtime_ns)
+        self.assertEqual(len(digests), 9 * BLOCK_DIGEST_SIZE)
+        # Only the two changed blocks were written
+        self.assertEqual(metrics.counter("bytes_copied"), 2 * BLOCK_SIZE)
+        self.assertEqual(metrics.counter("bytes_delta_unchanged"), len(new) - 2 * BLOCK_SIZE)
+
+        # With the digests of the old version, it does not have to be read to find the changed blocks
+        newer = changeBlock(new, 0, 3)[:-50]
+        writeFile(self.source, newer)
+        metrics.reset()
+        newerDigests = deltaCopy(self.source, self.base, self.base, BLOCK_SIZE, digests)
+        self.assertEqual(readFile(self.base), newer)
+        self.assertEqual(len(newerDigests), 9 * BLOCK_DIGEST_SIZE)
+        # The first block and the shorter last one
+        self.assertEqual(metrics.counter("bytes_copied"), BLOCK_SIZE + 50)
+
+    def test_hardlinked_base_is_not_changed(self):
+        # The old version is shared with other backups, so it can not be changed in place
+        other = os.path.join(self.directory.name, "other")
+        os.link(self.base, other)
+        writeFile(self.source, changeBlock(self.old, 1, 1))
+        self.assertIsNone(deltaCopy(self.source, self.base, self.base, BLOCK_SIZE))
+        self.assertEqual(readFile(other), self.old)
+
+    def test_reflink(self):
+        new = changeBlock(self.old, 3, 1)
+        writeFile(self.source, new)
+        target = os.path.join(self.directory.name, "target")
+        digests = deltaCopy(self.source, target, self.base, BLOCK_SIZE)
+        if digests is None:
+            self.skipTest("the file system does not support reflinks")
+        self.assertEqual(readFile(target), new)
+        self.assertEqual(readFile(self.base), self.old)
+        self.assertEqual(metrics.counter("bytes_copied"), BLOCK_SIZE)
+
+class BlockHashCacheTest(unittest.TestCase):
+    def test_digests_are_only_used_for_the_same_file(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "file")
+            writeFile(path, b"content")
+            cache = BlockHashCache(os.path.join(directory, BLOCKHASHES_FILENAME))
+            cache.set(path, BLOCK_SIZE, b"digests")
+            self.assertEqual(cache.get(path, BLOCK_SIZE), b"digests")
+            self.assertIsNone(cache.get(path, 2 * BLOCK_SIZE))
+            os.utime(path, ns = (0, 0))
+            self.assertIsNone(cache.get(path, BLOCK_SIZE))
+            cache.set(path, BLOCK_SIZE, b"digests")
+            cache.remove([os.stat(path).st_ino])
+            self.assertIsNone(cache.get(path, BLOCK_SIZE))
+            cache.close()
+
+# delta actions of a mirror backup update the files of the last backup in place
+class MirrorDeltaTest(unittest.TestCase):
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.directory = tempfile.TemporaryDirectory()
+        self.source = os.path.join(self.directory.name, "source")
+        self.root = os.path.join(self.directory.name, "backup")
+        self.file = os.path.join(self.source, "large")
+        self.backupFile = os.path.join(self.root, "source", "large")
+        os.makedirs(self.source)
+        self.data = randomBytes(16 * BLOCK_SIZE, 0)
+        writeFile(self.file, self.data)
+
+    def tearDown(self):
+        self.directory.cleanup()
+        logging.disable(logging.NOTSET)
+
+    # Runs a backup and returns the types of its actions and its counters
+    def backup(self):
+        config = makeConfig({"source_dir": self.source, "backup_root_dir": self.root, "mode": "mirror", "versioned": False,
+                             "compare_with_last_backup": False, "open_actionhtml": False, "delta_min_size": 1, "delta_block_size": BLOCK_SIZE})
+        engine = BackupEngine(config)
+        try:
+            engine.run()
+        finally:
+            engine.close()
+        with open(os.path.join(self.root, METADATA_FILENAME)) as file:
+            metadata = json.load(file)
+        self.assertTrue(metadata["successful"])
+        self.assertEqual(readFile(self.backupFile), readFile(self.file))
+        return [action.type for action in readActionFile(self.root)], metadata["metrics"]["counters"]
+
+    def change(self, index, seed):
+        self.data = changeBlock(self.data, index, seed)
+        writeFile(self.file, self.data)
+        # A different modification date, even on file systems with a coarse one
+        os.utime(self.file, ns = (seed * 10 ** 9, seed * 10 ** 9))
+
+    def test_changed_blocks(self):
+        self.backup()
+        inode = os.stat(self.backupFile).st_ino
+        self.change(4, 1)
+        types, counters = self.backup()
+        self.assertEqual(types, ["delta"])
+        self.assertEqual(counters.get("files_delta_updated"), 1)
+        self.assertEqual(counters.get("bytes_copied"), BLOCK_SIZE)
+        self.assertEqual(os.stat(self.backupFile).st_ino, inode)
+
+        # The digests of the backup are known now, so it is not read again
+        self.change(7, 2)
+        types, counters = self.backup()
+        self.assertEqual(counters.get("bytes_copied"), BLOCK_SIZE)
+
+    def test_hardlinked_file_is_copied(self):
+        self.backup()
+        other = os.path.join(self.directory.name, "other")
+        os.link(self.backupFile, other)
+        old = readFile(other)
+        self.change(4, 1)
+        types, counters = self.backup()
+        self.assertEqual(types, ["delta"])
+        self.assertEqual(counters.get("files_copied"), 1)
+        self.assertIsNone(counters.get("files_delta_updated"))
+        # The other link still has the old contents
+        self.assertEqual(readFile(other), old)
+
+if __name__ == '__main__':
+    unittest.main()
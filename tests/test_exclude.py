@@ -0,0 +1,79 @@
+import os, sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import tempfile
+import unittest
+
+import metrics
+from scanner import ExcludeMatcher, relativeWalk
+
+def native(path):
+    return path.replace("/", os.sep)
+
+class ExcludeMatcherTest(unittest.TestCase):
+    def assertExcluded(self, patterns, excluded, kept):
+        matcher = ExcludeMatcher([native(pattern) for pattern in patterns])
+        for path in excluded:
+            self.assertTrue(matcher.excluded(native(path)), path)
+        for path in kept:
+            self.assertFalse(matcher.excluded(native(path)), path)
+
+    def test_no_patterns(self):
+        matcher = ExcludeMatcher([])
+        self.assertFalse(matcher.excluded("a"))
+        self.assertFalse(matcher.contentsExcluded("a"))
+
+    def test_extension(self):
+        # * also matches separators, like with fnmatch
+        self.assertExcluded(["*.tmp"], ["a.tmp", "dir/a.tmp", "dir/sub/a.tmp"], ["a.tmp.txt", "tmp", "dir"])
+
+    def test_name(self):
+        # A pattern without wildcards only matches the path relative to the source directory
+        self.assertExcluded(["node_modules"], ["node_modules"], ["project/node_modules", "node_modules_old", "project"])
+
+    def test_name_in_subdirectories(self):
+        self.assertExcluded(["*/node_modules"], ["project/node_modules", "a/b/node_modules"], ["node_modules", "project/node_modules_old"])
+
+    def test_contents(self):
+        matcher = ExcludeMatcher([native("AppData/Local/*")])
+        # The directory itself is kept, but nothing in it
+        self.assertFalse(matcher.excluded(native("AppData/Local")))
+        self.assertTrue(matcher.excluded(native("AppData/Local/Temp")))
+        self.assertTrue(matcher.excluded(native("AppData/Local/Temp/file")))
+        self.assertFalse(matcher.excluded(native("AppData/Roaming/file")))
+        self.assertTrue(matcher.contentsExcluded(native("AppData/Local")))
+        self.assertFalse(matcher.contentsExcluded(native("AppData")))
+        self.assertFalse(matcher.contentsExcluded(native("AppData/Roaming")))
+
+class ExcludedWalkTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        for path in ["keep.txt", "drop.tmp", "node_modules/a/b", "project/node_modules/c/d", "project/src/e.tmp", "project/src/f",
+                     "AppData/Local/Temp/g", "AppData/Roaming/h"]:
+            path = os.path.join(self.directory.name, native(path))
+            os.makedirs(os.path.dirname(path), exist_ok = True)
+            open(path, "w").close()
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def walk(self, patterns, threads):
+        metrics.reset()
+        paths = [entry.path.replace(os.sep, "/") for entry in relativeWalk(self.directory.name, threads, ExcludeMatcher([native(pattern) for pattern in patterns]))]
+        return paths, metrics.counter("directories_scanned")
+
+    def test_excluded_subtrees_are_not_read(self):
+        for threads in [1, 4]:
+            paths, scanned = self.walk(["*.tmp", "node_modules", "*/node_modules", "AppData/Local/*"], threads)
+            self.assertEqual(paths, ["AppData", "AppData/Local", "AppData/Roaming", "AppData/Roaming/h", "keep.txt",
+                                     "project", "project/src", "project/src/f"])
+            # Only the source directory, AppData, AppData/Roaming, project and project/src are read, not even AppData/Local
+            self.assertEqual(scanned, 5)
+
+    def test_without_patterns(self):
+        paths, scanned = self.walk([], 1)
+        self.assertIn("project/node_modules/c/d", paths)
+        self.assertIn("AppData/Local/Temp/g", paths)
+
+if __name__ == '__main__':
+    unittest.main()
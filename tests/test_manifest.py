@@ -0,0 +1,116 @@
+import os, sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import json
+import logging
+import tempfile
+import unittest
+
+from backup import BackupEngine, makeConfig
+from constants import *
+import manifest
+from scanner import FileEntry
+
+ENTRIES = [FileEntry("a", True, 0, 1, 2, 0o40755, None), FileEntry(os.path.join("a", "b"), False, 3, 4, 5, 0o100644, "abc")]
+
+class ManifestTest(unittest.TestCase):
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.directory = tempfile.TemporaryDirectory()
+        self.backup = self.directory.name
+
+    def tearDown(self):
+        self.directory.cleanup()
+        logging.disable(logging.NOTSET)
+
+    def writePending(self, targets = {"target": ENTRIES}):
+        writer = manifest.ManifestWriter(os.path.join(self.backup, MANIFEST_PENDING_FILENAME))
+        for name, entries in targets.items():
+            writer.beginSection(name)
+            for entry in entries:
+                writer.add(entry)
+        writer.close()
+
+    def read(self, targetName = "target"):
+        entries = manifest.readManifest(self.backup, targetName)
+        return list(entries) if entries is not None else None
+
+    def test_lifecycle(self):
+        # Only a committed manifest is read
+        self.writePending()
+        self.assertIsNone(self.read())
+        manifest.commitManifest(self.backup)
+        self.assertFalse(os.path.exists(os.path.join(self.backup, MANIFEST_PENDING_FILENAME)))
+        self.assertEqual(self.read(), ENTRIES)
+        self.assertEqual(manifest.manifestTargets(self.backup), ["target"])
+
+        # Applying actions to the backup invalidates it until they were all applied
+        manifest.invalidateManifest(self.backup)
+        self.assertIsNone(self.read())
+        self.assertIsNone(manifest.manifestTargets(self.backup))
+        # Applied again without a new pending manifest, the old one is right again
+        manifest.commitManifest(self.backup)
+        self.assertEqual(self.read(), ENTRIES)
+
+        # A new pending manifest replaces it
+        manifest.invalidateManifest(self.backup)
+        self.writePending({"target": ENTRIES[:1]})
+        manifest.commitManifest(self.backup)
+        self.assertEqual(self.read(), ENTRIES[:1])
+
+    def test_sections(self):
+        writer = manifest.ManifestWriter(os.path.join(self.backup, MANIFEST_PENDING_FILENAME), keepEntries = True)
+        first = writer.openSection("first")
+        second = writer.openSection("second")
+        second.add(ENTRIES[1])
+        first.add(ENTRIES[0])
+        writer.close()
+        self.assertEqual(writer.entries, {"first": ENTRIES[:1], "second": ENTRIES[1:]})
+        manifest.commitManifest(self.backup)
+        self.assertEqual(self.read("first"), ENTRIES[:1])
+        self.assertEqual(self.read("second"), ENTRIES[1:])
+        self.assertIsNone(self.read("third"))
+
+    def test_incomplete(self):
+        self.writePending()
+        manifest.commitManifest(self.backup)
+        path = os.path.join(self.backup, MANIFEST_FILENAME)
+        with open(path, "rb") as file:
+            lines = file.readlines()
+        # Without the trailer, like when writing it was interrupted
+        with open(path, "wb") as file:
+            file.writelines(lines[:-1])
+        self.assertIsNone(self.read())
+
+    def test_unknown_format(self):
+        # Format 1 had no header
+        with open(os.path.join(self.backup, MANIFEST_FILENAME), "w") as file:
+            file.write(json.dumps(["a", True, 0, 1]) + "\n")
+        self.assertIsNone(self.read())
+        with open(os.path.join(self.backup, MANIFEST_FILENAME), "w") as file:
+            file.write(json.dumps({"format": 1}) + "\n" + json.dumps({"targets": ["target"]}) + "\n")
+        self.assertIsNone(self.read())
+
+    def test_fallback_to_walk(self):
+        # The compare directory is walked when its manifest can not be used
+        compareDirectory = os.path.join(self.backup, "target")
+        os.makedirs(os.path.join(compareDirectory, "walked"))
+        sourceDirectory = os.path.join(self.directory.name, "source")
+        os.makedirs(sourceDirectory)
+        engine = BackupEngine(makeConfig({"source_dir": sourceDirectory, "backup_root_dir": self.directory.name}))
+        source = {"name": "target", "sourceDirectory": sourceDirectory, "compareDirectory": compareDirectory,
+                  "targetDirectory": os.path.join(self.directory.name, "new", "target")}
+
+        def compareEntries():
+            sourceEntries, compareEntries, withoutWalk = engine.readDirectories(source, self.backup, None)
+            return [entry.path for entry in compareEntries], withoutWalk
+
+        self.assertEqual(compareEntries(), (["walked"], False))
+        self.writePending()
+        manifest.commitManifest(self.backup)
+        self.assertEqual(compareEntries(), (["a", os.path.join("a", "b")], True))
+        manifest.invalidateManifest(self.backup)
+        self.assertEqual(compareEntries(), (["walked"], False))
+
+if __name__ == '__main__':
+    unittest.main()
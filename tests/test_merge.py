@@ -0,0 +1,67 @@
+import os, sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import tempfile
+import unittest
+
+from backup import mergeWalks
+from scanner import FileEntry, pathKey, relativeWalk
+
+def entry(path, isDirectory = False):
+    return FileEntry(path.replace("/", os.sep), isDirectory, 0, 0, None, None, None)
+
+# (path, in the source directory, in the compare directory, is a directory) for every FileDirectory from mergeWalks
+def merged(sourceEntries, compareEntries):
+    return [(element.path.replace(os.sep, "/"), element.inSourceDir, element.inCompareDir, element.isDirectory)
+            for element in mergeWalks(sourceEntries, compareEntries)]
+
+class PathKeyTest(unittest.TestCase):
+    def test_parents_before_children(self):
+        # As strings, "a b" < "a/x" (" " < "/"), but a walk yields everything in "a" before its sibling "a b"
+        paths = ["a b", "a/x", "a", "a/x/y", "a-b", "b"]
+        self.assertEqual(sorted(paths, key = lambda path: pathKey(path.replace("/", os.sep))), ["a", "a/x", "a/x/y", "a b", "a-b", "b"])
+
+    def test_relative_walk_order(self):
+        with tempfile.TemporaryDirectory() as directory:
+            for path in ["a/x", "a b/y", "a-b", "b/c/d"]:
+                os.makedirs(os.path.dirname(os.path.join(directory, path)), exist_ok = True)
+                open(os.path.join(directory, path), "w").close()
+            paths = [entry.path for entry in relativeWalk(directory)]
+            self.assertEqual(paths, sorted(paths, key = pathKey))
+            self.assertEqual([path.replace(os.sep, "/") for path in paths], ["a", "a/x", "a b", "a b/y", "a-b", "b", "b/c", "b/c/d"])
+
+class MergeWalksTest(unittest.TestCase):
+    def test_merge(self):
+        source = [entry("a", True), entry("a/x"), entry("a b", True), entry("a b/new"), entry("c")]
+        compare = [entry("a", True), entry("a/old"), entry("a b", True), entry("c"), entry("d")]
+        self.assertEqual(merged(source, compare), [
+            ("a", True, True, True),
+            ("a/old", False, True, False),
+            ("a/x", True, False, False),
+            ("a b", True, True, True),
+            ("a b/new", True, False, False),
+            ("c", True, True, False),
+            ("d", False, True, False),
+        ])
+
+    def test_empty_walks(self):
+        self.assertEqual(merged([], []), [])
+        self.assertEqual(merged([entry("a")], []), [("a", True, False, False)])
+        self.assertEqual(merged([], [entry("a")]), [("a", False, True, False)])
+
+    def test_file_became_directory(self):
+        # Two different objects with the same path: the old one is yielded first, so it is deleted before the new one is copied
+        source = [entry("t", True), entry("t/in"), entry("u")]
+        compare = [entry("t"), entry("u", True), entry("u/in")]
+        self.assertEqual(merged(source, compare), [
+            ("t", False, True, False),
+            ("t", True, False, True),
+            ("t/in", True, False, False),
+            ("u", False, True, True),
+            ("u", True, False, False),
+            # Deleted together with its directory, which is yielded before the new file
+            ("u/in", False, True, False),
+        ])
+
+if __name__ == '__main__':
+    unittest.main()
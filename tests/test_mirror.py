@@ -0,0 +1,117 @@
+import os, sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import json
+import logging
+import shutil
+import tempfile
+import unittest
+
+from actionFile import readActionFile
+from backup import BackupEngine, BackupError, makeConfig
+from constants import *
+
+# Mirror mode without versioning applies the actions to the last backup itself: moved files are renamed in it
+# and paths that changed between file and directory are deleted before the new object is copied.
+class MirrorTest(unittest.TestCase):
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.directory = tempfile.TemporaryDirectory()
+        self.source = os.path.join(self.directory.name, "source")
+        self.root = os.path.join(self.directory.name, "backup")
+        self.target = os.path.join(self.root, "source")
+        os.makedirs(self.source)
+
+    def tearDown(self):
+        self.directory.cleanup()
+        logging.disable(logging.NOTSET)
+
+    def write(self, name, content):
+        path = os.path.join(self.source, name)
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        with open(path, "w") as file:
+            file.write(content)
+
+    # Runs a backup and returns its actions
+    def backup(self, threads = 1, **options):
+        config = makeConfig(dict({"source_dir": self.source, "backup_root_dir": self.root, "mode": "mirror", "versioned": False,
+                                  "compare_with_last_backup": False, "open_actionhtml": False, "detect_moves": True, "compare_method": ["moddate", "size", "hash"], "move_detection_min_size": 1,
+                                  "apply_threads": threads}, **options))
+        engine = BackupEngine(config)
+        try:
+            engine.run()
+        finally:
+            engine.close()
+        with open(os.path.join(self.root, METADATA_FILENAME)) as file:
+            self.assertTrue(json.load(file)["successful"])
+        return list(readActionFile(self.root))
+
+    # {path relative to the directory: file content or None for directories}
+    def tree(self, directory):
+        result = {}
+        for parent, dirnames, filenames in os.walk(directory):
+            for name in dirnames:
+                result[os.path.relpath(os.path.join(parent, name), directory)] = None
+            for name in filenames:
+                with open(os.path.join(parent, name)) as file:
+                    result[os.path.relpath(os.path.join(parent, name), directory)] = file.read()
+        return result
+
+    def assertMirrored(self):
+        self.assertEqual(self.tree(self.target), self.tree(self.source))
+
+    def test_rename(self):
+        self.write(os.path.join("old", "moved"), "moved content")
+        self.write("kept", "kept content")
+        self.backup()
+        self.assertMirrored()
+        inode = os.stat(os.path.join(self.target, "old", "moved")).st_ino
+
+        os.makedirs(os.path.join(self.source, "new"))
+        os.rename(os.path.join(self.source, "old", "moved"), os.path.join(self.source, "new", "renamed"))
+        shutil.rmtree(os.path.join(self.source, "old"))
+        actions = self.backup()
+
+        self.assertIn(("rename", os.path.join("new", "renamed"), os.path.join("old", "moved")),
+                      [(action.type, action.name, action.fromName) for action in actions])
+        self.assertNotIn("copy", [action.type for action in actions if not action.isDirectory])
+        self.assertMirrored()
+        # The file was renamed in the backup, not copied again
+        self.assertEqual(os.stat(os.path.join(self.target, "new", "renamed")).st_ino, inode)
+
+    def test_type_changes(self):
+        self.write("becomes_directory", "a file")
+        self.write(os.path.join("becomes_file", "inside"), "in a directory")
+        self.write(os.path.join("becomes_file", "deeper", "inside"), "deeper in a directory")
+        self.backup()
+        self.assertMirrored()
+
+        os.remove(os.path.join(self.source, "becomes_directory"))
+        self.write(os.path.join("becomes_directory", "inside"), "now in a directory")
+        shutil.rmtree(os.path.join(self.source, "becomes_file"))
+        self.write("becomes_file", "now a file")
+        actions = self.backup(threads = 4)
+
+        # The old object is deleted before the new one is copied
+        types = [(action.type, action.name) for action in actions]
+        self.assertLess(types.index(("delete", "becomes_directory")), types.index(("copy", "becomes_directory")))
+        self.assertLess(types.index(("delete", "becomes_file")), types.index(("copy", "becomes_file")))
+        self.assertMirrored()
+
+    def test_moves_need_content_comparison(self):
+        # Files with the same size and modification date are not necessarily the same file
+        with self.assertRaises(BackupError):
+            makeConfig({"source_dir": self.source, "backup_root_dir": self.root, "detect_moves": True, "compare_method": ["moddate", "size"]})
+
+    def test_rename_and_type_change(self):
+        # A file is moved away and a directory takes its place
+        self.write("place", "moved content")
+        self.backup()
+
+        os.rename(os.path.join(self.source, "place"), os.path.join(self.source, "elsewhere"))
+        self.write(os.path.join("place", "inside"), "new content")
+        self.backup(threads = 4)
+        self.assertMirrored()
+
+if __name__ == '__main__':
+    unittest.main()
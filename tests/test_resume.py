@@ -0,0 +1,177 @@
+import os, sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import json
+import logging
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+from actionFile import Action, ActionFileWriter, actionTotals, readActionFile
+import applyActions
+from applyActions import executeActionList
+from backup import BackupEngine, BackupError, makeConfig
+from constants import *
+from journal import ActionJournal
+
+class JournalTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, JOURNAL_FILENAME)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_resume(self):
+        journal = ActionJournal(self.path, False)
+        started = journal.started
+        for index in [0, 2, 1]:
+            journal.add(index)
+        journal.close()
+
+        journal = ActionJournal(self.path, True)
+        self.assertEqual(journal.done, {0, 1, 2})
+        self.assertEqual(journal.started, started)
+        journal.add(3)
+        journal.close()
+        self.assertEqual(ActionJournal(self.path, True).done, {0, 1, 2, 3})
+
+    def test_torn_last_line(self):
+        journal = ActionJournal(self.path, False)
+        journal.add(0)
+        journal.close()
+        with open(self.path, "a") as file:
+            file.write("[1, 2")
+        logging.disable(logging.CRITICAL)
+        try:
+            self.assertEqual(ActionJournal(self.path, True).done, {0})
+        finally:
+            logging.disable(logging.NOTSET)
+
+    def test_without_resume(self):
+        journal = ActionJournal(self.path, False)
+        journal.add(0)
+        journal.close()
+        self.assertEqual(ActionJournal(self.path, False).done, set())
+
+# Applying the actions is interrupted after some of them and then resumed, like applyActions.py does it
+class ResumeTest(unittest.TestCase):
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.directory = tempfile.TemporaryDirectory()
+        self.source = os.path.join(self.directory.name, "source")
+        self.backup = os.path.join(self.directory.name, "backup")
+        self.target = os.path.join(self.backup, "source")
+        os.makedirs(self.source)
+        os.makedirs(self.target)
+        self.actions = []
+        for i in range(6):
+            name = "file" + str(i)
+            with open(os.path.join(self.source, name), "w") as file:
+                file.write(name * 100)
+            self.actions.append(Action("copy", name, False, os.path.getsize(os.path.join(self.source, name)), target = "source"))
+        with open(os.path.join(self.backup, METADATA_FILENAME), "w") as file:
+            json.dump({"name": "backup", "successful": False, "started": 0, "sources": [
+                {"name": "source", "sourceDirectory": self.source, "compareDirectory": self.target, "targetDirectory": self.target}]}, file)
+        # The files the copy function was called for
+        self.copied = []
+
+    def tearDown(self):
+        self.directory.cleanup()
+        logging.disable(logging.NOTSET)
+
+    def copy(self, source, target):
+        self.copied.append(os.path.basename(target))
+        shutil.copy2(source, target)
+
+    def apply(self, actions, resume):
+        with mock.patch.object(applyActions, "getCopyFunction", lambda method: self.copy):
+            return executeActionList(self.backup, actions, resume = resume)
+
+    def interrupted(self, count):
+        yield from self.actions[:count]
+        raise KeyboardInterrupt()
+
+    def metadata(self):
+        with open(os.path.join(self.backup, METADATA_FILENAME)) as file:
+            return json.load(file)
+
+    def test_resume(self):
+        with self.assertRaises(KeyboardInterrupt):
+            self.apply(self.interrupted(3), False)
+        self.assertEqual(self.copied, ["file0", "file1", "file2"])
+        self.assertTrue(os.path.isfile(os.path.join(self.backup, JOURNAL_FILENAME)))
+
+        # file3 was copied completely, but not recorded in the journal anymore
+        shutil.copy2(os.path.join(self.source, "file3"), os.path.join(self.target, "file3"))
+        # file4 was only written partly
+        with open(os.path.join(self.target, "file4"), "w") as file:
+            file.write("file4")
+        # file0 was changed after it was copied, but it is in the journal, so it is not looked at again
+        with open(os.path.join(self.target, "file0"), "w") as file:
+            file.write("changed")
+
+        self.copied = []
+        self.assertTrue(self.apply(self.actions, True))
+        self.assertEqual(self.copied, ["file4", "file5"])
+        for i in range(1, 6):
+            with open(os.path.join(self.target, "file" + str(i))) as file:
+                self.assertEqual(file.read(), ("file" + str(i)) * 100)
+        metadata = self.metadata()
+        self.assertTrue(metadata["successful"])
+        self.assertEqual(metadata["actions"], 6)
+        self.assertFalse(os.path.exists(os.path.join(self.backup, JOURNAL_FILENAME)))
+
+    def test_file_older_than_interrupted_run(self):
+        # A complete copy that is older than the interrupted run might be from anywhere, so it is copied again
+        shutil.copy2(os.path.join(self.source, "file0"), os.path.join(self.target, "file0"))
+        with open(os.path.join(self.backup, JOURNAL_FILENAME), "w") as file:
+            file.write(json.dumps({"started": os.stat(os.path.join(self.target, "file0")).st_ctime + 10}) + "\n")
+        self.assertTrue(self.apply(self.actions, True))
+        self.assertEqual(self.copied, ["file" + str(i) for i in range(6)])
+
+class ActionFileTrailerTest(unittest.TestCase):
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.directory = tempfile.TemporaryDirectory()
+        self.backup = self.directory.name
+        self.path = os.path.join(self.backup, ACTIONS_FILENAME)
+        writer = ActionFileWriter(self.path)
+        writer.write(Action("copy", "a", False, 10))
+        writer.write(Action("delete", "b", False))
+        writer.close()
+
+    def tearDown(self):
+        self.directory.cleanup()
+        logging.disable(logging.NOTSET)
+
+    def test_complete(self):
+        self.assertEqual(actionTotals(self.backup), (2, 10))
+        self.assertEqual([action.name for action in readActionFile(self.backup)], ["a", "b"])
+
+    def test_without_trailer(self):
+        # Generating the actions was interrupted
+        with open(self.path, "rb") as file:
+            lines = file.readlines()
+        with open(self.path, "wb") as file:
+            file.writelines(lines[:-1])
+        self.assertIsNone(actionTotals(self.backup))
+        engine = BackupEngine(makeConfig({"source_dir": self.backup, "backup_root_dir": self.backup}))
+        with self.assertRaises(BackupError):
+            engine.apply(self.backup, resume = True)
+
+    def test_wrong_count(self):
+        with open(self.path, "rb") as file:
+            lines = file.readlines()
+        with open(self.path, "wb") as file:
+            file.writelines(lines[:1] + lines[-1:])
+        self.assertIsNone(actionTotals(self.backup))
+
+    def test_missing(self):
+        os.remove(self.path)
+        with self.assertRaises(FileNotFoundError):
+            actionTotals(self.backup)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+import os, sys
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import logging
+import tempfile
+import time
+import unittest
+
+from backup import BackupEngine, makeConfig
+import catalog
+from constants import *
+from retention import PRUNING_SUFFIX, expiredBackups, pruneBackups
+
+POLICY_KEYS = ["keep_last", "keep_daily", "keep_weekly", "keep_monthly", "keep_yearly"]
+
+def record(name, started, successful = True):
+    return {"name": name, "started": started, "successful": successful}
+
+def policy(**keep):
+    config = {key: 0 for key in POLICY_KEYS}
+    config.update(keep)
+    return config
+
+def names(records):
+    return [record["name"] for record in records]
+
+class ExpiredBackupsTest(unittest.TestCase):
+    def test_keep_last(self):
+        records = [record("a", 1), record("b", 2), record("c", 3)]
+        keep, expire = expiredBackups(records, policy(keep_last = 2))
+        self.assertEqual(names(keep), ["b", "c"])
+        self.assertEqual(names(expire), ["a"])
+
+    def test_newest_successful_is_always_kept(self):
+        keep, expire = expiredBackups([record("a", 1), record("b", 2)], policy(keep_daily = 0))
+        self.assertEqual(names(keep), ["b"])
+
+    def test_failed_backups(self):
+        # Failed backups only expire once there is a newer successful one, newer ones might still be running
+        records = [record("a", 1), record("b", 2, False), record("c", 3), record("d", 4, False)]
+        keep, expire = expiredBackups(records, policy(keep_last = 5))
+        self.assertEqual(names(keep), ["a", "c", "d"])
+        self.assertEqual(names(expire), ["b"])
+
+    def test_only_failed_backups(self):
+        records = [record("a", 1, False), record("b", 2, False)]
+        self.assertEqual(expiredBackups(records, policy(keep_last = 1)), (records, []))
+
+    def test_periods(self):
+        day = 24 * 60 * 60
+        now = time.mktime((2026, 6, 15, 12, 0, 0, 0, 0, -1))
+        records = [record("older", now - 2 * day), record("yesterday", now - day), record("morning", now - 1000), record("now", now)]
+        keep, expire = expiredBackups(records, policy(keep_daily = 2))
+        self.assertEqual(names(keep), ["yesterday", "now"])
+        self.assertEqual(names(expire), ["older", "morning"])
+
+class PruneBackupsTest(unittest.TestCase):
+    def setUp(self):
+        logging.disable(logging.CRITICAL)
+        self.directory = tempfile.TemporaryDirectory()
+        self.source = os.path.join(self.directory.name, "source")
+        self.root = os.path.join(self.directory.name, "backups")
+        os.makedirs(self.source)
+        self.write("shared", "in every version")
+
+    def tearDown(self):
+        self.directory.cleanup()
+        logging.disable(logging.NOTSET)
+
+    def write(self, name, content):
+        with open(os.path.join(self.source, name), "w") as file:
+            file.write(content)
+
+    def config(self, **keep):
+        config = makeConfig({"source_dir": self.source, "backup_root_dir": self.root, "mode": "hardlink", "version_name": "version",
+                             "open_actionhtml": False, "apply_threads": 1})
+        config.update(policy(**keep))
+        return config
+
+    # Runs a hardlink backup, so unchanged files are hardlinked to the same file in the older versions
+    def backup(self):
+        engine = BackupEngine(self.config(keep_last = 1))
+        try:
+            return os.path.basename(engine.run())
+        finally:
+            engine.close()
+
+    def path(self, version, name):
+        return os.path.join(self.root, version, "source", name)
+
+    def test_prune_hardlinked_versions(self):
+        self.write("first", "only in the first version")
+        first = self.backup()
+        os.remove(os.path.join(self.source, "first"))
+        second = self.backup()
+        third = self.backup()
+        self.assertTrue(os.path.samefile(self.path(first, "shared"), self.path(third, "shared")))
+        self.assertEqual(os.stat(self.path(third, "shared")).st_nlink, 3)
+
+        pruneBackups(self.config(keep_last = 1), threads = 2)
+
+        self.assertEqual(sorted(name for name in os.listdir(self.root) if os.path.isdir(os.path.join(self.root, name))), [third])
+        self.assertEqual(names(catalog.backupRecords(self.root)), [third])
+        # The file the kept version shares with the deleted ones is still there, with its other links gone
+        with open(self.path(third, "shared")) as file:
+            self.assertEqual(file.read(), "in every version")
+        self.assertEqual(os.stat(self.path(third, "shared")).st_nlink, 1)
+        # The next backup compares with the kept version
+        self.write("shared", "changed")
+        fourth = self.backup()
+        self.assertEqual(catalog.lastSuccessfulBackup(self.root)["name"], fourth)
+        with open(self.path(third, "shared")) as file:
+            self.assertEqual(file.read(), "in every version")
+
+    def test_dry_run(self):
+        versions = [self.backup() for i in range(3)]
+        pruneBackups(self.config(keep_last = 1), dryRun = True)
+        for version in versions:
+            self.assertTrue(os.path.isfile(self.path(version, "shared")))
+        self.assertEqual(names(catalog.backupRecords(self.root)), versions)
+
+    def test_finish_interrupted_deletion(self):
+        first = self.backup()
+        second = self.backup()
+        # Like a deletion that was interrupted after renaming the version
+        catalog.removeBackups(self.root, [first])
+        os.rename(os.path.join(self.root, first), os.path.join(self.root, first + PRUNING_SUFFIX))
+
+        pruneBackups(self.config(keep_last = 1))
+
+        self.assertFalse(os.path.exists(os.path.join(self.root, first + PRUNING_SUFFIX)))
+        self.assertTrue(os.path.isfile(self.path(second, "shared")))
+
+if __name__ == '__main__':
+    unittest.main()
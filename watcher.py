@@ -0,0 +1,388 @@
+import os, sys
+
+import errno
+import json
+import logging
+import struct
+import threading
+import time
+
+from constants import *
+from scanner import UnchangedEntry, pathKey, relativeWalk, scanSubdirectory
+
+if os.name == "posix":
+    import fcntl
+
+if sys.platform.startswith("linux"):
+    import ctypes
+    import ctypes.util
+    libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno = True)
+
+# From <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_EXCL_UNLINK = 0x04000000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+              | IN_ONLYDIR | IN_EXCL_UNLINK)
+
+# A directory changing again within this many seconds is not recorded again. Backups therefore take all changes
+# recorded up to this long before the compare directory was backed up into account.
+DIRTY_INTERVAL = 10
+
+# The dirty journal lists the directories of the source directory that changed while the watcher was running.
+# Every source directory has one in backup_root_dir (see dirtyJournalPath). It is a JSON lines file:
+# {"source": <source directory>, "validSince": <time>}     header, every change since validSince is listed
+# [<time>, "<relative directory path>", <recursive>]       a changed directory, recursive if everything in it might be new (e.g. it was moved here)
+#
+# The watcher holds an exclusive lock on the journal as long as it is running. If the journal is not locked, changes might have been missed.
+# When events are lost (the kernel queue overflowed), the journal starts over with a new validSince.
+class DirtyJournal:
+    def __init__(self, path, sourceDirectory, lastBackupStarted):
+        self.path = path
+        self.sourceDirectory = sourceDirectory
+        # Returns the time the last backup was started, older changes do not need to be kept
+        self.lastBackupStarted = lastBackupStarted
+        self.file = None
+        self.reset()
+
+    # Starts over, listing the changes from now on
+    def reset(self):
+        self.validSince = time.time()
+        # relative path -> [last change, last change of everything in it or None]
+        self.recorded = {}
+        self.rewrite()
+
+    # Writes the journal anew from recorded. The new file is locked before the old one is unlocked.
+    def rewrite(self):
+        temporaryPath = self.path + ".tmp"
+        with open(temporaryPath, "w", encoding = "utf-8") as file:
+            file.write(json.dumps({"source": self.sourceDirectory, "validSince": self.validSince}) + "\n")
+            for path, (changed, recursiveChanged) in self.recorded.items():
+                file.write(json.dumps([changed, path, False]) + "\n")
+                if recursiveChanged is not None:
+                    file.write(json.dumps([recursiveChanged, path, True]) + "\n")
+        os.replace(temporaryPath, self.path)
+        newFile = open(self.path, "a", encoding = "utf-8")
+        fcntl.flock(newFile, fcntl.LOCK_EX)
+        if self.file is not None:
+            self.file.close()
+        self.file = newFile
+        self.lines = len(self.recorded)
+
+    def add(self, path, recursive):
+        now = time.time()
+        record = self.recorded.setdefault(path, [None, None])
+        if recursive:
+            if record[1] is not None and now - record[1] < DIRTY_INTERVAL:
+                return
+            record[0] = record[1] = now
+        else:
+            if record[0] is not None and now - record[0] < DIRTY_INTERVAL:
+                return
+            record[0] = now
+        self.file.write(json.dumps([now, path, recursive]) + "\n")
+        self.lines += 1
+
+    def flush(self):
+        self.file.flush()
+        # Drop the changes the last backup already saw, once there are a lot of lines
+        if self.lines > max(10000, 2 * len(self.recorded)):
+            started = self.lastBackupStarted()
+            if started is not None:
+                cutoff = started - DIRTY_INTERVAL
+                self.recorded = {path: [changed, recursiveChanged if recursiveChanged is not None and recursiveChanged >= cutoff else None]
+                                 for path, (changed, recursiveChanged) in self.recorded.items() if changed >= cutoff}
+            self.rewrite()
+
+    def close(self):
+        self.file.close()
+
+# The path of the dirty journal of the source directory saved in the target directory targetName
+def dirtyJournalPath(backupRootDirectory, targetName):
+    base, extension = os.path.splitext(DIRTY_JOURNAL_FILENAME)
+    return os.path.join(backupRootDirectory, base + "." + targetName + extension)
+
+# Returns {relative path: recursive} for the directories of sourceDirectory (saved in the target directory targetName) that changed
+# since the time since or None if the watcher was not running all the time or the journal is about another source directory.
+def readDirtyJournal(backupRootDirectory, targetName, sourceDirectory, since):
+    if os.name != "posix":
+        logging.info("The watcher is only supported on Linux, reading the whole source directory")
+        return None
+    path = dirtyJournalPath(backupRootDirectory, targetName)
+    try:
+        file = open(path, "rb")
+    except FileNotFoundError:
+        logging.info("No dirty journal found (watcher.py is not running), reading the whole source directory")
+        return None
+
+    with file:
+        try:
+            fcntl.flock(file, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        except BlockingIOError:
+            pass # locked by the running watcher
+        else:
+            logging.warning("watcher.py is not running anymore, reading the whole source directory")
+            return None
+        lines = file.read().split(b"\n")
+
+    try:
+        header = json.loads(lines[0])
+    except ValueError:
+        logging.warning("The dirty journal is incomplete, reading the whole source directory")
+        return None
+    if os.path.abspath(header["source"]) != os.path.abspath(sourceDirectory):
+        logging.info("The dirty journal is about another source directory, reading the whole source directory")
+        return None
+    if header["validSince"] > since:
+        logging.info("watcher.py was not running since the last backup, reading the whole source directory")
+        return None
+
+    cutoff = since - DIRTY_INTERVAL
+    dirty = {}
+    for line in lines[1:]:
+        try:
+            changed, relativePath, recursive = json.loads(line)
+        except ValueError:
+            continue # empty or still being written
+        if changed >= cutoff:
+            dirty[relativePath] = dirty.get(relativePath, False) or recursive
+    return dirty
+
+# Yields the FileEntries of sourceDirectory like relativeWalk, but only reads the directories in dirty (see readDirtyJournal).
+# Everything else is taken from manifestEntries, the entries of the source directory when the journal started listing changes
+# (the manifest of the compare directory). These are yielded as UnchangedEntries.
+def dirtyWalk(sourceDirectory, manifestEntries, dirty, threads = 1, exclude = None):
+    # Directories containing changed directories, which have to be walked through instead of taking all of their entries from the manifest
+    dirtyParents = set()
+    for path in dirty:
+        while path != "":
+            path = os.path.dirname(path)
+            if path in dirtyParents:
+                break
+            dirtyParents.add(path)
+
+    manifestEntries = iter(manifestEntries)
+    current = next(manifestEntries, None)
+
+    def advance():
+        nonlocal current
+        entry = current
+        current = next(manifestEntries, None)
+        return entry
+
+    def inside(directory):
+        return current is not None and (directory == "" or current.path.startswith(directory + os.sep))
+
+    def scanTree(directory):
+        while inside(directory):
+            advance()
+        yield from relativeWalk(sourceDirectory, threads, exclude, relativeDirectory = directory)
+
+    # Yields everything in directory, the next manifest entry is the first one in it (if there is any)
+    def walk(directory):
+        if exclude is not None and directory != "" and exclude.contentsExcluded(directory):
+            return
+        if dirty.get(directory):
+            yield from scanTree(directory)
+        elif directory in dirty:
+            for entry in scanSubdirectory(os.path.join(sourceDirectory, directory), directory, exclude):
+                key = pathKey(entry.path)
+                # Skip what was deleted since
+                while inside(directory) and pathKey(current.path) < key:
+                    advance()
+                if inside(directory) and current.path == entry.path and current.isDirectory == entry.isDirectory:
+                    advance()
+                    yield entry
+                    if entry.isDirectory:
+                        yield from walk(entry.path)
+                else:
+                    yield entry
+                    if entry.isDirectory and (exclude is None or not exclude.contentsExcluded(entry.path)):
+                        yield from scanTree(entry.path)
+            while inside(directory):
+                advance()
+        elif directory in dirtyParents:
+            while inside(directory):
+                entry = advance()
+                yield UnchangedEntry(*entry)
+                if entry.isDirectory:
+                    yield from walk(entry.path)
+        else:
+            while inside(directory):
+                yield UnchangedEntry(*advance())
+
+    yield from walk("")
+
+# Watches every directory in the source directory with inotify and records the changed ones in a DirtyJournal
+class Watcher:
+    def __init__(self, sourceDirectory, exclude):
+        self.sourceDirectory = sourceDirectory
+        self.exclude = exclude
+        self.fd = libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, "inotify_init1 failed: " + os.strerror(error))
+        # watch descriptor -> relative path and back
+        self.watches = {}
+        self.paths = {}
+        self.journal = None
+
+    def addWatch(self, relativePath):
+        wd = libc.inotify_add_watch(self.fd, os.fsencode(os.path.join(self.sourceDirectory, relativePath)), WATCH_MASK)
+        if wd < 0:
+            error = ctypes.get_errno()
+            if error in (errno.ENOENT, errno.ENOTDIR):
+                return False # already gone again
+            if error == errno.ENOSPC:
+                raise OSError(error, "Too many directories to watch, increase /proc/sys/fs/inotify/max_user_watches")
+            raise OSError(error, "Watching '" + relativePath + "' failed: " + os.strerror(error))
+        # A moved directory keeps its watch descriptor
+        oldPath = self.watches.get(wd)
+        if oldPath is not None and self.paths.get(oldPath) == wd:
+            del self.paths[oldPath]
+        self.watches[wd] = relativePath
+        self.paths[relativePath] = wd
+        return True
+
+    # Watches relativePath and every directory in it, the same ones relativeWalk would read
+    def addTree(self, relativePath):
+        if not self.addWatch(relativePath):
+            return
+        try:
+            entries = list(os.scandir(os.path.join(self.sourceDirectory, relativePath)))
+        except OSError as e:
+            logging.error(e)
+            return
+        for entry in entries:
+            path = os.path.join(relativePath, entry.name)
+            try:
+                isDirectory = entry.is_dir()
+            except OSError:
+                continue
+            if isDirectory and not self.exclude.excluded(path) and not self.exclude.contentsExcluded(path):
+                self.addTree(path)
+
+    # Stops watching everything in a directory that was moved away. If it was moved inside the source directory, it is watched again under its new name.
+    def removeTree(self, relativePath):
+        for path in [path for path in self.paths if path == relativePath or path.startswith(relativePath + os.sep)]:
+            wd = self.paths.pop(path)
+            del self.watches[wd]
+            libc.inotify_rm_watch(self.fd, wd)
+
+    def handle(self, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            logging.warning("The kernel dropped events, the next backup will read the whole source directory")
+            self.journal.reset()
+            return
+        directory = self.watches.get(wd)
+        if directory is None:
+            return
+        if mask & IN_IGNORED:
+            del self.watches[wd]
+            if self.paths.get(directory) == wd:
+                del self.paths[directory]
+            return
+        if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+            if directory == "":
+                raise OSError("The source directory was deleted or moved")
+            return # the parent directory gets an event as well
+
+        path = os.path.join(directory, name)
+        if self.exclude.excluded(path):
+            return
+        if mask & IN_ISDIR:
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                if not self.exclude.contentsExcluded(path):
+                    self.addTree(path)
+                self.journal.add(path, True)
+            elif mask & IN_MOVED_FROM:
+                self.removeTree(path)
+        self.journal.add(directory, False)
+
+    def run(self, journalPath, lastBackupStarted):
+        logging.info("Watching " + self.sourceDirectory)
+        self.addTree("")
+        # Everything that changed while the watches were added is in the queue already, so the journal is valid from here
+        self.journal = DirtyJournal(journalPath, self.sourceDirectory, lastBackupStarted)
+        logging.info("Watching " + str(len(self.watches)) + " directories, the changes are written to " + journalPath)
+        try:
+            while True:
+                data = os.read(self.fd, 1024 * 1024)
+                offset = 0
+                while offset < len(data):
+                    # struct inotify_event
+                    wd, mask, cookie, length = struct.unpack_from("iIII", data, offset)
+                    name = data[offset + 16:offset + 16 + length].rstrip(b"\0")
+                    offset += 16 + length
+                    self.handle(wd, mask, os.fsdecode(name))
+                self.journal.flush()
+        finally:
+            self.journal.close()
+            os.close(self.fd)
+
+if __name__ == '__main__':
+    from backup import BackupError, loadConfig, targetName
+    import catalog
+    from scanner import ExcludeMatcher
+
+    logger = logging.getLogger()
+    stderrHandler = logging.StreamHandler(stream=sys.stderr)
+    stderrHandler.setFormatter(LOGFORMAT)
+    logger.addHandler(stderrHandler)
+
+    if len(sys.argv) < 2:
+        logging.critical("Please specify the configuration file for your backup.")
+        quit()
+    if not sys.platform.startswith("linux"):
+        logging.critical("The watcher uses inotify, which is only available on Linux.")
+        quit()
+
+    try:
+        config = loadConfig(sys.argv[1])
+    except BackupError as e:
+        logging.critical(str(e))
+        quit()
+    logger.setLevel(config["log_level"])
+    os.makedirs(config["backup_root_dir"], exist_ok = True)
+
+    def lastBackupStarted():
+        if config["versioned"]:
+            backup = catalog.lastSuccessfulBackup(config["backup_root_dir"])
+            return backup["started"] if backup is not None else None
+        metadataPath = os.path.join(config["backup_root_dir"], METADATA_FILENAME)
+        if os.path.isfile(metadataPath):
+            with open(metadataPath) as inFile:
+                metadata = json.load(inFile)
+            if metadata["successful"]:
+                return metadata["started"]
+        return None
+
+    # Every source directory is watched on a thread of its own. If one of them fails, the others keep going.
+    def watch(sourceDirectory):
+        try:
+            Watcher(sourceDirectory, ExcludeMatcher(config["exclude_paths"])).run(
+                dirtyJournalPath(config["backup_root_dir"], targetName(sourceDirectory)), lastBackupStarted)
+        except OSError as e:
+            logging.error("Stopped watching " + sourceDirectory + ": " + str(e))
+
+    threads = [threading.Thread(target = watch, args = (sourceDirectory,), daemon = True) for sourceDirectory in config["source_dir"]]
+    for thread in threads:
+        thread.start()
+    try:
+        for thread in threads:
+            # With a timeout, so KeyboardInterrupt is not held up
+            while thread.is_alive():
+                thread.join(1)
+    except KeyboardInterrupt:
+        logging.info("Stopped watching")